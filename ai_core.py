@@ -2,182 +2,1873 @@
 
 import os
 import asyncio
-import google.generativeai as genai
-from openai import OpenAI
+import logging
+import threading
+import concurrent.futures
+import json
+import time
+import hashlib
+import random
+import copy
+import sqlite3
+import email.utils
+from collections import OrderedDict, deque
 from dotenv import load_dotenv
 import datetime
-import textwrap
+from conversation_logger import conversation_logger
 
 # --- 1. CARGAR VARIABLES DE ENTORNO ---
 load_dotenv()
-GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 
-# --- 2. CONFIGURACIÓN DE LAS APIS ---
-gemini_model = None
-if GEMINI_API_KEY:
-    try:
-        genai.configure(api_key=GEMINI_API_KEY)
-        # Lógica robusta para seleccionar un modelo disponible
-        available_models = [m.name for m in genai.list_models() if 'generateContent' in m.supported_generation_methods]
-        
-        # Lista de modelos preferidos en orden de preferencia
-        preferred_models = ['models/gemini-2.5-flash-lite', 'models/gemini-2.5-flash-lite']
-        
-        model_to_use = None
-        for model in preferred_models:
-            if model in available_models:
-                model_to_use = model
-                break
-        
-        if not model_to_use and available_models:
-            model_to_use = available_models[0] # Usar el primero disponible como último recurso
+# Avisos operativos (caché no disponible, pasos respondidos por una reserva, resúmenes fallidos...):
+# van por logging (nivel con LOG_LEVEL) y, los que importan en producción, también a /metrics
+logger = logging.getLogger(__name__)
+
+# --- 2. PROVEEDORES ---
+# La configuración de cada IA vive en providers.py (registro de adaptadores). Los SDK se
+# importan y configuran la primera vez que se usan, así que importar este módulo es casi instantáneo.
+from providers import PROVIDERS, get_provider, active_providers, prefix_cache, prepare_providers, ProviderResponseError
+# Grabación y reproducción del tráfico con los proveedores (CASSETTE_MODE=record|replay): con un
+# cassette grabado, todo funciona sin claves ni red
+import cassettes
+if cassettes.CASSETTE_MODE:
+    cassettes.install()
+# Los presets se ejecutan como grafos de pasos (workflow.py)
+from workflow import compile_workflow, run_workflow, critical_path, steps_to_end, SKIPPED, WorkflowError
+# Medición (tokenizador local) y recorte del contexto que pasa de un paso a otro
+from compaction import count_tokens, truncate_tokens, compact_text, COMPACTION_STRATEGIES
+# Métricas (ruta /metrics de app.py) y ganchos de trazas
+from metrics import registry as metrics_registry, span
+# Historial consultable (SQLite + índice de texto completo) que alimenta el hilo del log
+from history import history_store, HISTORY_ENABLED
+# Reutilización de resultados para preguntas casi idénticas (MinHash + LSH, opcional)
+from similarity import similarity_cache, SIMILARITY_CACHE_ENABLED
+# Checkpoints por paso de las cadenas: al repetir una ejecución se reanuda donde falló o cambió
+from checkpoints import checkpoint_store, step_hash, CHAIN_CHECKPOINTS_ENABLED
+# Sesiones de varios turnos: historial por sesión y ventana deslizante de turnos recientes
+from sessions import session_store
+
+
+# --- 3. CACHÉ DE RESPUESTAS (LRU EN MEMORIA + SQLITE EN DISCO) ---
+# Clave: (proveedor, modelo, instrucción de sistema, prompt y, si lo hay, límite de tokens de salida).
+# Un acierto evita una llamada de varios segundos.
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "1") != "0"
+RESPONSE_CACHE_PATH = os.getenv("RESPONSE_CACHE_PATH", "response_cache.sqlite3")
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", 7 * 24 * 3600))  # segundos
+RESPONSE_CACHE_MEMORY_ITEMS = int(os.getenv("RESPONSE_CACHE_MEMORY_ITEMS", 512))
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+
+class ResponseCache:
+    """Caché de dos niveles: LRU acotado en memoria delante de un almacén SQLite con TTL y límite de tamaño."""
+
+    def __init__(self, path, ttl, max_memory_items, max_disk_bytes):
+        self.path = path
+        self.ttl = ttl
+        self.max_memory_items = max_memory_items
+        self.max_disk_bytes = max_disk_bytes
+        self._memory = OrderedDict()  # clave -> (expira_en, texto)
+        self._lock = threading.Lock()
+        self._db = None
+        self._disk_bytes = None
+        self.counters = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "stores": 0, "evictions": 0, "errors": 0}
+
+    @staticmethod
+    def make_key(provider, model, system_prompt, prompt, max_tokens=None):
+        parts = [provider, model, system_prompt or "", prompt]
+        if max_tokens:
+            parts.append(max_tokens)  # sin límite la clave no cambia: las entradas ya guardadas siguen valiendo
+        raw = json.dumps(parts, ensure_ascii=False)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _connect(self):
+        if self._db is None:
+            self._db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, "
+                "expires_at REAL NOT NULL, last_access REAL NOT NULL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)")
+            self._disk_bytes = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        return self._db
+
+    def _remember(self, key, expires_at, value):
+        self._memory[key] = (expires_at, value)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_items:
+            self._memory.popitem(last=False)
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry and entry[0] > now:
+                self._memory.move_to_end(key)
+                self.counters["memory_hits"] += 1
+                return entry[1]
+            self._memory.pop(key, None)
+            try:
+                db = self._connect()
+                row = db.execute("SELECT value, expires_at FROM responses WHERE key = ?", (key,)).fetchone()
+                if row and row[1] > now:
+                    db.execute("UPDATE responses SET last_access = ? WHERE key = ?", (now, key))
+                    self._remember(key, row[1], row[0])
+                    self.counters["disk_hits"] += 1
+                    return row[0]
+            except sqlite3.Error as e:
+                self.counters["errors"] += 1
+                logger.warning("Caché de respuestas no disponible: %s", e)
+            self.counters["misses"] += 1
+            return None
+
+    def set(self, key, value):
+        now = time.time()
+        expires_at = now + self.ttl
+        size = len(value.encode("utf-8"))
+        with self._lock:
+            self._remember(key, expires_at, value)
+            self.counters["stores"] += 1
+            try:
+                db = self._connect()
+                db.execute(
+                    "INSERT OR REPLACE INTO responses (key, value, size, expires_at, last_access) VALUES (?, ?, ?, ?, ?)",
+                    (key, value, size, expires_at, now),
+                )
+                self._disk_bytes += size
+                if self._disk_bytes > self.max_disk_bytes:
+                    self._evict(db, now)
+            except sqlite3.Error as e:
+                self.counters["errors"] += 1
+                logger.warning("Caché de respuestas no disponible: %s", e)
+
+    def _evict(self, db, now):
+        # Primero lo caducado; después lo menos usado hasta bajar al 90% del límite
+        evicted = db.execute("DELETE FROM responses WHERE expires_at <= ?", (now,)).rowcount
+        total = db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        target = self.max_disk_bytes * 0.9
+        if total > target:
+            rows = db.execute("SELECT key, size FROM responses ORDER BY last_access").fetchall()
+            doomed = []
+            for key, size in rows:
+                if total <= target:
+                    break
+                doomed.append((key,))
+                total -= size
+            db.executemany("DELETE FROM responses WHERE key = ?", doomed)
+            evicted += len(doomed)
+        self._disk_bytes = total
+        self.counters["evictions"] += evicted
+
+    def stats(self):
+        with self._lock:
+            lookups = self.counters["memory_hits"] + self.counters["disk_hits"] + self.counters["misses"]
+            hits = lookups - self.counters["misses"]
+            return {
+                **self.counters,
+                "hit_ratio": hits / lookups if lookups else 0.0,
+                "memory_items": len(self._memory),
+                "disk_bytes": self._disk_bytes or 0,
+            }
 
-        if model_to_use:
-            gemini_model = genai.GenerativeModel(model_to_use)
-            print(f"Gemini configurado con éxito usando: {model_to_use}")
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            self._connect().execute("DELETE FROM responses")
+            self._disk_bytes = 0
+
+response_cache = ResponseCache(RESPONSE_CACHE_PATH, RESPONSE_CACHE_TTL, RESPONSE_CACHE_MEMORY_ITEMS, RESPONSE_CACHE_MAX_BYTES)
+
+async def _cached_response(provider, model, prompt, system_prompt, use_cache, fetch, max_tokens=None):
+    """Devuelve la respuesta en caché o llama a fetch() y guarda el resultado.
+    Las excepciones de fetch() se propagan sin guardarse: los errores nunca se cachean."""
+    if not RESPONSE_CACHE_ENABLED:
+        return await fetch()
+    key = ResponseCache.make_key(provider, model, system_prompt, prompt, max_tokens)
+    if use_cache:
+        cached = response_cache.get(key)
+        if cached is not None:
+            return cached
+    text = await fetch()
+    # Con use_cache=False se salta la lectura pero se refresca la entrada
+    if text:
+        response_cache.set(key, text)
+    return text
+
+async def _cached_stream(provider, model, prompt, system_prompt, use_cache, stream, max_tokens=None):
+    """Versión en streaming de _cached_response: un acierto se entrega como un único fragmento."""
+    if not RESPONSE_CACHE_ENABLED:
+        async for text in stream():
+            yield text
+        return
+    key = ResponseCache.make_key(provider, model, system_prompt, prompt, max_tokens)
+    if use_cache:
+        cached = response_cache.get(key)
+        if cached is not None:
+            yield cached
+            return
+    parts = []
+    async for text in stream():
+        parts.append(text)
+        yield text
+    if parts:
+        response_cache.set(key, "".join(parts))
+
+# Agrupación de llamadas idénticas en vuelo (single-flight): si llega una llamada con la misma
+# clave (proveedor, modelo, instrucción de sistema, prompt) que otra que aún no ha terminado, espera
+# el resultado de la primera en lugar de lanzar otra. Los errores llegan a todos los que esperan y
+# la llamada se cancela cuando ya no queda ninguno. En streaming, quien se une tarde recibe primero
+# los fragmentos ya llegados.
+SINGLE_FLIGHT_ENABLED = os.getenv("SINGLE_FLIGHT_ENABLED", "1") != "0"
+
+class _Flight:
+    __slots__ = ("task", "waiters", "chunks", "event")
+
+    def __init__(self):
+        self.task = None
+        self.waiters = 0
+        self.chunks = []
+        self.event = asyncio.Event()
+
+    def notify(self):
+        # Despierta a los suscriptores actuales; los siguientes esperarán un evento nuevo
+        self.event.set()
+        self.event = asyncio.Event()
+
+class SingleFlight:
+    """Llamadas en vuelo por clave. Solo se usa desde el bucle de ai_core, así que no necesita locks."""
+
+    def __init__(self):
+        self._flights = {}
+        self.counters = {"leaders": 0, "coalesced": 0, "cancelled": 0}
+
+    def _join(self, key, start):
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = self._flights[key] = _Flight()
+            flight.task = asyncio.create_task(start(flight))
+            flight.task.add_done_callback(lambda _: self._forget(key, flight))
+            self.counters["leaders"] += 1
         else:
-            print("Advertencia: No se encontró ningún modelo de Gemini compatible.")
-            
-    except Exception as e:
-        print(f"Error al configurar Gemini: {e}")
-else:
-    print("Advertencia: GEMINI_API_KEY no encontrada.")
+            self.counters["coalesced"] += 1
+        flight.waiters += 1
+        return flight
+
+    def _leave(self, key, flight):
+        flight.waiters -= 1
+        if flight.waiters == 0 and not flight.task.done():
+            # Ya no espera nadie: se corta la llamada para no seguir pagándola
+            flight.task.cancel()
+            self._forget(key, flight)
+            self.counters["cancelled"] += 1
+
+    def _forget(self, key, flight):
+        if self._flights.get(key) is flight:
+            del self._flights[key]
 
+    async def call(self, key, fetch):
+        """Resultado de fetch(), compartido con las llamadas de la misma clave que estén en vuelo."""
+        flight = self._join(key, lambda flight: fetch())
+        try:
+            # shield: si cancelan a este llamador, la llamada sigue para los demás
+            return await asyncio.shield(flight.task)
+        finally:
+            self._leave(key, flight)
 
-openai_client = None
-if OPENAI_API_KEY:
+    async def stream(self, key, make_stream):
+        """Versión en streaming: un único stream real y cada suscriptor recibe todos sus fragmentos."""
+        async def produce(flight):
+            try:
+                async for text in make_stream():
+                    flight.chunks.append(text)
+                    flight.notify()
+            finally:
+                flight.notify()
+
+        flight = self._join(key, produce)
+        try:
+            sent = 0
+            while True:
+                while sent < len(flight.chunks):
+                    sent += 1
+                    yield flight.chunks[sent - 1]
+                if flight.task.done():
+                    flight.task.result()  # propaga el error (o la cancelación) del stream real
+                    return
+                await flight.event.wait()
+        finally:
+            self._leave(key, flight)
+
+    def stats(self):
+        return {**self.counters, "in_flight": len(self._flights)}
+
+single_flight = SingleFlight()
+
+# Nivel superior a la caché de respuestas: el resultado completo de un modo (todas las respuestas
+# de la comparación o todos los pasos de la cadena) para una pregunta casi igual a otra reciente.
+def _similar_result(prompt, mode, preset=None, use_cache=True):
+    """Resultado guardado de una pregunta parecida del mismo modo y preset: (resultado, metadatos) o (None, None)."""
+    if not SIMILARITY_CACHE_ENABLED or not use_cache:
+        return None, None
+    found = similarity_cache.lookup(prompt, (mode, preset))
+    if found is None:
+        return None, None
+    result, reused = found
+    return copy.deepcopy(result), reused
+
+def _remember_result(prompt, mode, result, preset=None):
+    if SIMILARITY_CACHE_ENABLED:
+        similarity_cache.store(prompt, (mode, preset), copy.deepcopy(result))
+
+# Con sesión, cada proveedor recibe la pregunta precedida de los turnos recientes que le tocan.
+# Una pregunta de seguimiento depende de ese historial, así que no se reutiliza por similitud.
+def _session_prompt(session_id, provider_name, prompt):
+    return session_store.build_prompt(session_id, provider_name, prompt) if session_id else prompt
+
+def _is_follow_up(session_id):
+    return bool(session_id) and session_store.has_history(session_id)
+
+def _session_append(session_id, prompt, answers):
+    """Guarda la pregunta y las respuestas válidas (lista de (proveedor o None, texto)) en la sesión."""
+    if session_id:
+        session_store.append(session_id, prompt, [(name, text) for name, text in answers if text])
+
+
+# --- 4. PLANIFICADOR POR PROVEEDOR (CONCURRENCIA, CUOTAS Y REINTENTOS) ---
+# Cada proveedor tiene un máximo de llamadas en vuelo, cubos de fichas de peticiones y tokens por
+# minuto, y reintentos con backoff exponencial + jitter que respetan Retry-After. Configuración por
+# entorno: <PROVEEDOR>_MAX_IN_FLIGHT, <PROVEEDOR>_RPM, <PROVEEDOR>_TPM (0 = sin límite).
+PROVIDER_MAX_IN_FLIGHT = int(os.getenv("PROVIDER_MAX_IN_FLIGHT", 8))
+PROVIDER_MAX_RETRIES = int(os.getenv("PROVIDER_MAX_RETRIES", 4))
+PROVIDER_BACKOFF_BASE = float(os.getenv("PROVIDER_BACKOFF_BASE", 0.5))  # segundos
+PROVIDER_BACKOFF_MAX = float(os.getenv("PROVIDER_BACKOFF_MAX", 30.0))
+
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504, 529}
+RETRYABLE_ERRORS = {"APIConnectionError", "APITimeoutError", "ResourceExhausted", "ServiceUnavailable",
+                    "DeadlineExceeded", "InternalServerError", "TooManyRequests"}
+
+def _error_status(e):
+    status = getattr(e, "status_code", None) or getattr(e, "code", None)
+    return status if isinstance(status, int) else None
+
+def is_retryable(e):
+    return (_error_status(e) in RETRYABLE_STATUS or type(e).__name__ in RETRYABLE_ERRORS
+            or isinstance(e, (asyncio.TimeoutError, ConnectionError)))
+
+def retry_after_seconds(e):
+    """Segundos indicados por el proveedor en Retry-After / retry-after-ms, o None."""
+    headers = getattr(getattr(e, "response", None), "headers", None)
+    if not headers:
+        return None
+    if headers.get("retry-after-ms"):
+        try:
+            return float(headers["retry-after-ms"]) / 1000
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if not value:
+        return None
     try:
-        openai_client = OpenAI(api_key=OPENAI_API_KEY)
-        print("OpenAI (ChatGPT) configurado con éxito.")
-    except Exception as e:
-        print(f"Error al configurar OpenAI: {e}")
-else:
-    print("Advertencia: OPENAI_API_KEY no encontrada.")
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    # Fecha HTTP; una cabecera mal formada no debe tapar el error real: se aplica el backoff normal
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, retry_at.timestamp() - time.time()) if retry_at else None
+
+# Plazos: cada intento contra un proveedor tiene un límite propio (PROVIDER_CALL_TIMEOUT para una
+# respuesta completa, PROVIDER_STREAM_TIMEOUT hasta el primer fragmento y entre fragmentos) y cuenta
+# como un fallo transitorio más (se reintenta y penaliza la salud del proveedor). Aparte, una
+# petición puede traer su plazo total ("deadline", instante de time.monotonic()): al agotarse se
+# cancelan las llamadas en vuelo y se lanza DeadlineExceededError, que no dice nada del proveedor.
+PROVIDER_CALL_TIMEOUT = float(os.getenv("PROVIDER_CALL_TIMEOUT", 120.0))    # segundos; 0 = sin límite
+PROVIDER_STREAM_TIMEOUT = float(os.getenv("PROVIDER_STREAM_TIMEOUT", 60.0))  # segundos; 0 = sin límite
+REQUEST_TIMEOUT = float(os.getenv("REQUEST_TIMEOUT", 180.0))  # plazo por defecto de /api/query y /api/stream; 0 = sin plazo
+
+class ProviderTimeoutError(asyncio.TimeoutError):
+    """Un intento contra el proveedor superó su límite de tiempo."""
+
+class DeadlineExceededError(asyncio.TimeoutError):
+    """Se agotó el plazo total de la petición."""
+
+    def __init__(self, message="plazo de la petición agotado"):
+        super().__init__(message)
+
+def make_deadline(timeout):
+    """Plazo absoluto (time.monotonic()) para una petición de 'timeout' segundos; None si no hay plazo."""
+    return time.monotonic() + float(timeout) if timeout else None
 
+def time_left(deadline):
+    return None if deadline is None else deadline - time.monotonic()
 
-# --- 3. FUNCIONES ASÍNCRONAS DE IA ---
-async def get_gemini_response(prompt, system_prompt=None):
-    if not gemini_model:
-        return "Gemini no configurado o modelo no disponible."
+async def _await_within(aw, timeout=None, deadline=None):
+    """Espera aw como mucho 'timeout' segundos (ProviderTimeoutError) y sin pasar de 'deadline'
+    (DeadlineExceededError). Al vencer cualquiera de los dos, aw se cancela."""
+    left = time_left(deadline)
+    if left is not None and left <= 0:
+        aw.close()
+        raise DeadlineExceededError()
+    limit = min((t for t in (timeout or None, left) if t is not None), default=None)
+    if limit is None:
+        return await aw
     try:
-        full_prompt = prompt
-        if system_prompt:
-            full_prompt = f"INSTRUCCIÓN DE SISTEMA: {system_prompt}\n\nTAREA: {prompt}"
-        response = await asyncio.to_thread(gemini_model.generate_content, full_prompt)
-        return response.text
-    except Exception as e:
-        return f"Gemini Error: {e}"
+        return await asyncio.wait_for(aw, limit)
+    except asyncio.TimeoutError as e:
+        if isinstance(e, (ProviderTimeoutError, DeadlineExceededError)):
+            raise  # viene de un nivel inferior, ya clasificado
+        if deadline is not None and time.monotonic() >= deadline:
+            raise DeadlineExceededError() from None
+        raise ProviderTimeoutError(f"sin respuesta en {limit:g} s") from None
 
-async def get_openai_response(prompt, system_prompt=None):
-    if not openai_client:
-        return "OpenAI no configurado."
+async def _iter_within(agen, timeout=None, deadline=None):
+    """Recorre agen aplicando _await_within a cada fragmento: 'timeout' es el máximo de espera entre fragmentos."""
     try:
-        messages = []
-        if system_prompt:
-            messages.append({"role": "system", "content": system_prompt})
-        messages.append({"role": "user", "content": prompt})
-        response = await asyncio.to_thread(
-            openai_client.chat.completions.create,
-            model="o4-mini-2025-04-16",
-            messages=messages
+        while True:
+            try:
+                item = await _await_within(_anext(agen), timeout, deadline)
+            except StopAsyncIteration:
+                return
+            yield item
+    finally:
+        await agen.aclose()
+
+def estimate_tokens(*texts):
+    # Aproximación barata (~4 caracteres por token) para el cubo de tokens por minuto
+    return sum(len(t) for t in texts if t) // 4 + 1
+
+class TokenBucket:
+    """Cubo de fichas: 'rate_per_minute' fichas por minuto con ráfagas de hasta un minuto de cuota."""
+
+    def __init__(self, rate_per_minute):
+        self.capacity = float(rate_per_minute)
+        self.rate = rate_per_minute / 60.0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    async def acquire(self, amount=1):
+        amount = min(amount, self.capacity)
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= amount:
+                self.tokens -= amount
+                return
+            await asyncio.sleep((amount - self.tokens) / self.rate)
+
+class ProviderScheduler:
+    def __init__(self, name, max_in_flight, rpm=0, tpm=0, max_retries=PROVIDER_MAX_RETRIES):
+        self.name = name
+        self.max_in_flight = max_in_flight
+        self.max_retries = max_retries
+        self._semaphore = asyncio.Semaphore(max_in_flight)
+        self._requests = TokenBucket(rpm) if rpm else None
+        self._tokens = TokenBucket(tpm) if tpm else None
+        self.waiting = 0
+        self.in_flight = 0
+        self.counters = {"calls": 0, "retries": 0, "rate_limited": 0, "failures": 0,
+                         "wait_ms_total": 0.0, "wait_ms_max": 0.0}
+
+    async def _acquire(self, tokens):
+        start = time.perf_counter()
+        self.waiting += 1
+        try:
+            await self._semaphore.acquire()
+            try:
+                if self._requests:
+                    await self._requests.acquire(1)
+                if self._tokens:
+                    await self._tokens.acquire(tokens)
+            except BaseException:
+                self._semaphore.release()
+                raise
+        finally:
+            self.waiting -= 1
+        waited = (time.perf_counter() - start) * 1000
+        self.counters["wait_ms_total"] += waited
+        self.counters["wait_ms_max"] = max(self.counters["wait_ms_max"], waited)
+        self.in_flight += 1
+
+    def _release(self):
+        self.in_flight -= 1
+        self._semaphore.release()
+
+    def _backoff(self, attempt, e):
+        if _error_status(e) == 429:
+            self.counters["rate_limited"] += 1
+        retry_after = retry_after_seconds(e)
+        if retry_after is not None:
+            return min(retry_after, PROVIDER_BACKOFF_MAX)
+        # Backoff exponencial con "full jitter"
+        return random.uniform(0, min(PROVIDER_BACKOFF_MAX, PROVIDER_BACKOFF_BASE * 2 ** attempt))
+
+    def _retry_delay(self, attempt, e, deadline):
+        """Segundos hasta el siguiente intento, o None si no se reintenta (tampoco si empezaría después del plazo)."""
+        if attempt == self.max_retries or not is_retryable(e):
+            return None
+        delay = self._backoff(attempt, e)
+        if deadline is not None and time.monotonic() + delay >= deadline:
+            return None
+        return delay
+
+    async def run(self, call, tokens=1, deadline=None):
+        """Ejecuta call() (función que devuelve una corrutina) respetando límites y reintentando errores transitorios."""
+        for attempt in range(self.max_retries + 1):
+            await self._acquire(tokens)
+            self.counters["calls"] += 1
+            try:
+                return await call()
+            except Exception as e:
+                delay = self._retry_delay(attempt, e, deadline)
+                if delay is None:
+                    self.counters["failures"] += 1
+                    raise
+            finally:
+                self._release()
+            self.counters["retries"] += 1
+            await asyncio.sleep(delay)
+
+    async def stream(self, make_stream, tokens=1, deadline=None):
+        """Como run() para streams: solo se reintenta si el fallo llega antes del primer fragmento."""
+        for attempt in range(self.max_retries + 1):
+            await self._acquire(tokens)
+            self.counters["calls"] += 1
+            started = False
+            try:
+                async for text in make_stream():
+                    started = True
+                    yield text
+                return
+            except Exception as e:
+                delay = None if started else self._retry_delay(attempt, e, deadline)
+                if delay is None:
+                    self.counters["failures"] += 1
+                    raise
+            finally:
+                self._release()
+            self.counters["retries"] += 1
+            await asyncio.sleep(delay)
+
+    def stats(self):
+        calls = self.counters["calls"]
+        return {
+            "max_in_flight": self.max_in_flight,
+            "in_flight": self.in_flight,
+            "queue_depth": self.waiting,
+            "calls": calls,
+            "retries": self.counters["retries"],
+            "rate_limited": self.counters["rate_limited"],
+            "failures": self.counters["failures"],
+            "wait_ms_avg": round(self.counters["wait_ms_total"] / calls, 1) if calls else 0.0,
+            "wait_ms_max": round(self.counters["wait_ms_max"], 1),
+        }
+
+class LatencyTracker:
+    """Últimas latencias (ms) de cada proveedor, para estimar percentiles sin guardar todo el historial."""
+
+    def __init__(self, window=200):
+        self.window = window
+        self._samples = {}
+
+    def record(self, provider_name, elapsed_ms):
+        samples = self._samples.setdefault(provider_name, deque(maxlen=self.window))
+        samples.append(elapsed_ms)
+
+    def percentile(self, provider_name, q):
+        samples = sorted(self._samples.get(provider_name, ()))
+        if not samples:
+            return None
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+    def count(self, provider_name):
+        return len(self._samples.get(provider_name, ()))
+
+latency_tracker = LatencyTracker()
+
+# Enrutador por salud: media móvil exponencial (EWMA) de la latencia y de la tasa de errores de
+# cada proveedor y modelo, y un cortocircuito (circuit breaker) por proveedor. Tras
+# ROUTER_BREAKER_FAILURES fallos seguidos el circuito se abre y las llamadas fallan al instante
+# (sin esperar timeouts ni reintentos); pasados ROUTER_BREAKER_COOLDOWN segundos queda medio abierto
+# y deja pasar una llamada de prueba: si sale bien se cierra y, si no, vuelve a abrirse.
+# Solo cuentan como fallos los que dicen algo de la salud del proveedor (timeouts, 5xx, 429,
+# errores de conexión); un 400 por un prompt no válido no abre el circuito.
+ROUTER_EWMA_ALPHA = float(os.getenv("ROUTER_EWMA_ALPHA", 0.2))
+ROUTER_BREAKER_FAILURES = int(os.getenv("ROUTER_BREAKER_FAILURES", 5))
+ROUTER_BREAKER_COOLDOWN = float(os.getenv("ROUTER_BREAKER_COOLDOWN", 30.0))  # segundos
+ROUTER_EXPLORE_RATE = float(os.getenv("ROUTER_EXPLORE_RATE", 0.05))  # modo auto: a veces se prueba otro proveedor sano
+ROUTER_ERROR_PENALTY = 4.0  # una tasa de errores del 25% "cuesta" como duplicar la latencia
+
+class CircuitOpenError(Exception):
+    """El circuito del proveedor está abierto: la llamada se rechaza sin llegar a hacerse."""
+
+def is_health_failure(e):
+    if isinstance(e, (asyncio.CancelledError, DeadlineExceededError)):
+        return False  # la llamada se cortó desde fuera: no dice nada del proveedor
+    if isinstance(e, ProviderResponseError):
+        return False  # respondió bien; lo que no se pudo usar es el contenido
+    if isinstance(e, cassettes.CassetteMissError):
+        return False  # falta la grabación: abrir el circuito cambiaría el enrutado que se reproduce
+    return _error_status(e) is None or is_retryable(e)
+
+class ProviderHealth:
+    __slots__ = ("latency_ms", "error_rate", "samples", "consecutive_failures", "state", "opened_at", "probing")
+
+    def __init__(self):
+        self.latency_ms = None
+        self.error_rate = 0.0
+        self.samples = 0
+        self.consecutive_failures = 0
+        self.state = "closed"  # closed, open o half_open
+        self.opened_at = 0.0
+        self.probing = False
+
+class ProviderRouter:
+    def __init__(self, alpha=ROUTER_EWMA_ALPHA, failures=ROUTER_BREAKER_FAILURES, cooldown=ROUTER_BREAKER_COOLDOWN):
+        self.alpha = alpha
+        self.failures = failures
+        self.cooldown = cooldown
+        self._models = {}    # (proveedor, modelo) -> ProviderHealth (EWMA)
+        self._breakers = {}  # proveedor -> ProviderHealth (estado del circuito)
+        self.counters = {"opened": 0, "rejected": 0, "probes": 0}
+
+    def _breaker(self, provider_name):
+        health = self._breakers.get(provider_name)
+        if health is None:
+            health = self._breakers[provider_name] = ProviderHealth()
+        return health
+
+    def _refresh(self, health):
+        if health.state == "open" and time.monotonic() - health.opened_at >= self.cooldown:
+            health.state = "half_open"
+            health.probing = False
+        return health.state
+
+    def available(self, provider):
+        """True si el circuito deja pasar una llamada ahora (no consume la llamada de prueba)."""
+        health = self._breaker(provider.name)
+        state = self._refresh(health)
+        return state == "closed" or (state == "half_open" and not health.probing)
+
+    def acquire(self, provider):
+        """Antes de cada llamada real. Devuelve True si es la llamada de prueba; lanza CircuitOpenError si se rechaza."""
+        health = self._breaker(provider.name)
+        state = self._refresh(health)
+        if state == "closed":
+            return False
+        if state == "half_open" and not health.probing:
+            health.probing = True
+            self.counters["probes"] += 1
+            return True
+        self.counters["rejected"] += 1
+        retry_in = max(0.0, self.cooldown - (time.monotonic() - health.opened_at))
+        raise CircuitOpenError(f"circuito abierto tras {health.consecutive_failures} fallos seguidos; "
+                               f"se volverá a probar en {retry_in:.0f} s")
+
+    def record(self, provider, elapsed_ms, e=None, probe=False):
+        """Resultado de una llamada real: actualiza las medias y el circuito."""
+        breaker = self._breaker(provider.name)
+        if probe:
+            breaker.probing = False
+        if isinstance(e, asyncio.CancelledError):
+            return  # una llamada cancelada (perdedora de una carrera...) no dice nada del proveedor
+        failed = e is not None and is_health_failure(e)
+        key = (provider.name, provider.model_name)
+        health = self._models.get(key)
+        if health is None:
+            health = self._models[key] = ProviderHealth()
+        health.samples += 1
+        health.error_rate += self.alpha * ((1.0 if failed else 0.0) - health.error_rate)
+        if e is None:
+            health.latency_ms = elapsed_ms if health.latency_ms is None else health.latency_ms + self.alpha * (elapsed_ms - health.latency_ms)
+        if not failed:
+            breaker.consecutive_failures = 0
+            breaker.state = "closed"
+            return
+        breaker.consecutive_failures += 1
+        if breaker.state == "half_open" or breaker.consecutive_failures >= self.failures:
+            if breaker.state != "open":
+                self.counters["opened"] += 1
+            breaker.state = "open"
+            breaker.opened_at = time.monotonic()
+
+    def score(self, provider):
+        """Coste estimado en ms (menor es mejor); None si aún no hay latencias medidas."""
+        health = self._models.get((provider.name, provider.model_name))
+        if health is None or health.latency_ms is None:
+            return None
+        return health.latency_ms * (1 + ROUTER_ERROR_PENALTY * health.error_rate)
+
+    def rank(self, providers):
+        """Proveedores con el circuito cerrado (o listos para la prueba) del más rápido al más lento;
+        los que aún no tienen medidas van detrás, en orden de registro. Con probabilidad
+        ROUTER_EXPLORE_RATE se adelanta uno al azar para seguir midiendo a los demás."""
+        healthy = [p for p in providers if self.available(p)]
+        ranked = sorted(healthy, key=lambda p: (self.score(p) is None, self.score(p) or 0.0))
+        if len(ranked) > 1 and random.random() < ROUTER_EXPLORE_RATE:
+            ranked.insert(0, ranked.pop(random.randrange(1, len(ranked))))
+        return ranked
+
+    def stats(self):
+        stats = {}
+        for (name, model), health in self._models.items():
+            stats.setdefault(name, {"models": {}})["models"][model or ""] = {
+                "latency_ms_ewma": round(health.latency_ms, 1) if health.latency_ms is not None else None,
+                "error_rate_ewma": round(health.error_rate, 3),
+                "samples": health.samples,
+            }
+        for name, breaker in self._breakers.items():
+            self._refresh(breaker)
+            stats.setdefault(name, {"models": {}}).update(
+                circuit=breaker.state, consecutive_failures=breaker.consecutive_failures)
+        return {"providers": stats, **self.counters}
+
+router = ProviderRouter()
+
+_schedulers = {}
+
+def get_scheduler(provider_name):
+    scheduler = _schedulers.get(provider_name)
+    if scheduler is None:
+        prefix = provider_name.upper()
+        scheduler = _schedulers[provider_name] = ProviderScheduler(
+            provider_name,
+            max_in_flight=int(os.getenv(f"{prefix}_MAX_IN_FLIGHT", PROVIDER_MAX_IN_FLIGHT)),
+            rpm=int(os.getenv(f"{prefix}_RPM", 0)),
+            tpm=int(os.getenv(f"{prefix}_TPM", 0)),
         )
-        return response.choices[0].message.content
+    return scheduler
+
+def scheduler_stats():
+    """Estado de las colas por proveedor: en vuelo, en espera, tiempos de espera, reintentos..."""
+    return {name: scheduler.stats() for name, scheduler in _schedulers.items()}
+
+
+# --- 5. FUNCIONES ASÍNCRONAS DE IA (clientes async nativos, sin asyncio.to_thread) ---
+# Métricas por proveedor. Solo cuentan las llamadas reales (los aciertos de caché no llegan aquí);
+# la latencia incluye las esperas en cola y los reintentos del planificador.
+PROVIDER_LATENCY = metrics_registry.histogram(
+    "ai_provider_request_seconds", "Duración de las llamadas a cada proveedor.", ["provider", "outcome"])
+PROVIDER_TTFT = metrics_registry.histogram(
+    "ai_provider_time_to_first_token_seconds", "Tiempo hasta el primer fragmento en streaming.", ["provider"])
+PROVIDER_REQUESTS = metrics_registry.counter(
+    "ai_provider_requests_total", "Llamadas a cada proveedor por resultado (ok, error, timeout, cancelled, rejected).", ["provider", "outcome"])
+PROVIDER_ERRORS = metrics_registry.counter(
+    "ai_provider_errors_total", "Errores de cada proveedor por tipo de excepción.", ["provider", "error"])
+PROVIDER_TOKENS = metrics_registry.counter(
+    "ai_provider_tokens_total", "Tokens enviados (prompt), recibidos (completion) y leídos de la caché del proveedor (cached), "
+    "según el proveedor o, si no los informa, el tokenizador local.", ["provider", "kind"])
+
+TIMEOUT_ERRORS = {"APITimeoutError", "DeadlineExceeded", "ReadTimeout", "TimeoutException", "ProviderTimeoutError"}
+
+def _outcome(e):
+    if e is None:
+        return "ok"
+    if isinstance(e, asyncio.CancelledError):
+        return "cancelled"  # p. ej. las llamadas perdedoras del modo carrera
+    if isinstance(e, asyncio.TimeoutError) or type(e).__name__ in TIMEOUT_ERRORS:
+        return "timeout"
+    return "error"
+
+# Uso de tokens: el que informa el proveedor en cada llamada real (input, output y la parte del
+# input leída de su caché de prefijos). Si no lo informa, se estima con el tokenizador local y el
+# uso queda marcado con "estimated"; una respuesta cortada al llegar al límite de tokens de salida
+# queda marcada con "truncated". Los aciertos de la caché de respuestas y las llamadas
+# agrupadas con otra idéntica no suman nada: no se han pagado.
+MAX_OUTPUT_TOKENS = int(os.getenv("MAX_OUTPUT_TOKENS", 0))  # límite por defecto de cada respuesta; 0 = el del proveedor
+USAGE_KEYS = ("input_tokens", "output_tokens", "cached_tokens", "calls")
+
+def new_usage():
+    return dict.fromkeys(USAGE_KEYS, 0)
+
+def add_usage(total, usage):
+    for key in USAGE_KEYS:
+        total[key] += usage.get(key, 0)
+    for flag in ("estimated", "truncated"):
+        if usage.get(flag):
+            total[flag] = True
+    return total
+
+def _call_usage(reported, prompt, system_prompt, text):
+    """Uso de una llamada real: el informado por el proveedor o, si no lo hizo, la estimación local."""
+    reported = reported or {}
+    if "input_tokens" in reported:
+        return dict(reported, calls=1)
+    return dict(reported, input_tokens=count_tokens(prompt) + count_tokens(system_prompt), output_tokens=count_tokens(text),
+                cached_tokens=0, calls=1, estimated=True)
+
+class UsageTracker:
+    """Uso acumulado por proveedor (todas las llamadas) y por preset y paso de las cadenas."""
+
+    def __init__(self):
+        self._providers = {}  # proveedor -> uso
+        self._steps = {}      # (preset, paso, proveedor) -> uso
+        self._lock = threading.Lock()  # se lee desde los hilos de Flask
+
+    def record(self, provider_name, usage):
+        with self._lock:
+            add_usage(self._providers.setdefault(provider_name, new_usage()), usage)
+
+    def record_step(self, preset, step, provider_name, usage):
+        with self._lock:
+            add_usage(self._steps.setdefault((preset, step, provider_name), new_usage()), usage)
+
+    def stats(self):
+        with self._lock:
+            presets = {}
+            for (preset, step, name), usage in self._steps.items():
+                entry = presets.setdefault(preset, {"total": new_usage(), "steps": {}})
+                add_usage(entry["total"], usage)
+                entry["steps"].setdefault(step, {})[name] = dict(usage)
+            return {"providers": {name: dict(usage) for name, usage in self._providers.items()}, "presets": presets}
+
+usage_tracker = UsageTracker()
+
+def _record_call(provider, start, prompt, system_prompt, text, e=None, probe=False, usage=None):
+    """Métricas, salud y uso de una llamada real. Devuelve su uso (ver _call_usage)."""
+    outcome = _outcome(e)
+    elapsed = time.perf_counter() - start
+    router.record(provider, elapsed * 1000, e, probe)
+    PROVIDER_LATENCY.observe(elapsed, provider=provider.name, outcome=outcome)
+    PROVIDER_REQUESTS.inc(provider=provider.name, outcome=outcome)
+    if outcome in ("error", "timeout"):
+        PROVIDER_ERRORS.inc(provider=provider.name, error=type(e).__name__)
+    call_usage = _call_usage(usage, prompt, system_prompt, text)
+    PROVIDER_TOKENS.inc(call_usage["input_tokens"], provider=provider.name, kind="prompt")
+    if call_usage["output_tokens"]:
+        PROVIDER_TOKENS.inc(call_usage["output_tokens"], provider=provider.name, kind="completion")
+    if call_usage["cached_tokens"]:
+        PROVIDER_TOKENS.inc(call_usage["cached_tokens"], provider=provider.name, kind="cached")
+    usage_tracker.record(provider.name, call_usage)
+    if outcome == "ok":
+        latency_tracker.record(provider.name, elapsed * 1000)
+    return call_usage
+
+# Caché, colas del planificador y log se leen al renderizar /metrics
+metrics_registry.callback(
+    "ai_cache_events_total", "Eventos de la caché de respuestas (aciertos en memoria/disco, fallos, expulsiones...).", "counter",
+    lambda: [({"event": k}, v) for k, v in response_cache.stats().items() if k not in ("hit_ratio", "memory_items", "disk_bytes")])
+metrics_registry.callback(
+    "ai_cache_entries", "Entradas de la caché en memoria.", "gauge",
+    lambda: [({}, response_cache.stats()["memory_items"])])
+metrics_registry.callback(
+    "ai_similarity_cache_events_total", "Reutilización de preguntas casi idénticas (hits, misses, stores, evictions).", "counter",
+    lambda: [({"event": k}, v) for k, v in similarity_cache.stats().items() if k in similarity_cache.counters])
+metrics_registry.callback(
+    "ai_single_flight_events_total", "Llamadas idénticas en vuelo: lanzadas (leaders), agrupadas (coalesced) y canceladas.", "counter",
+    lambda: [({"event": k}, v) for k, v in single_flight.counters.items()])
+metrics_registry.callback(
+    "ai_router_latency_ewma_ms", "Latencia media móvil (EWMA) por proveedor y modelo.", "gauge",
+    lambda: [({"provider": name, "model": model}, m["latency_ms_ewma"])
+             for name, p in router.stats()["providers"].items() for model, m in p["models"].items() if m["latency_ms_ewma"] is not None])
+metrics_registry.callback(
+    "ai_router_circuit_open", "1 si el circuito del proveedor está abierto, 0.5 si está medio abierto.", "gauge",
+    lambda: [({"provider": name}, {"open": 1, "half_open": 0.5}.get(p.get("circuit"), 0))
+             for name, p in router.stats()["providers"].items()],
+    multiprocess_mode="max")  # con varios workers: abierto si lo está en alguno
+metrics_registry.callback(
+    "ai_scheduler_in_flight", "Llamadas en vuelo por proveedor.", "gauge",
+    lambda: [({"provider": name}, stats["in_flight"]) for name, stats in scheduler_stats().items()])
+metrics_registry.callback(
+    "ai_scheduler_queue_depth", "Llamadas esperando turno por proveedor.", "gauge",
+    lambda: [({"provider": name}, stats["queue_depth"]) for name, stats in scheduler_stats().items()])
+metrics_registry.callback(
+    "ai_scheduler_retries_total", "Reintentos por proveedor.", "counter",
+    lambda: [({"provider": name}, stats["retries"]) for name, stats in scheduler_stats().items()])
+metrics_registry.callback(
+    "ai_scheduler_rate_limited_total", "Respuestas 429 por proveedor.", "counter",
+    lambda: [({"provider": name}, stats["rate_limited"]) for name, stats in scheduler_stats().items()])
+metrics_registry.callback(
+    "ai_prefix_cache_events_total", "Cachés de contexto creadas en el proveedor (hits, creates, expired, errors).", "counter",
+    lambda: [({"event": k}, v) for k, v in prefix_cache.stats().items() if k != "handles"])
+metrics_registry.callback(
+    "ai_cassette_events_total", "Peticiones grabadas y reproducidas (aciertos y fallos) del cassette.", "counter",
+    lambda: [({"event": k}, v) for k, v in cassettes.active_cassette.stats().items() if k != "entries"]
+    if cassettes.active_cassette else [])
+metrics_registry.callback(
+    "ai_conversation_log_dropped_total", "Registros de conversación descartados por cola llena.", "counter",
+    lambda: [({}, conversation_logger.dropped)])
+
+def format_error(provider, e):
+    return f"{provider.short_name} Error: {e}"
+
+def _acquire_circuit(provider):
+    # Con el circuito abierto la llamada se rechaza aquí mismo, sin pasar por la cola ni los reintentos
+    try:
+        return router.acquire(provider)
+    except CircuitOpenError:
+        PROVIDER_REQUESTS.inc(provider=provider.name, outcome="rejected")
+        raise
+
+async def call_provider(provider, prompt, system_prompt=None, use_cache=True, deadline=None, max_tokens=None, usage=None):
+    """Respuesta completa de un adaptador, pasando por la caché y el planificador. Lanza excepción si falla
+    (DeadlineExceededError si se agota 'deadline', y entonces la llamada en vuelo se cancela).
+
+    max_tokens limita la longitud de la respuesta (por defecto MAX_OUTPUT_TOKENS). Si se pasa un dict
+    'usage' (ver new_usage), se le suma el uso de la llamada; no cambia si la respuesta salió de la caché."""
+    scheduler = get_scheduler(provider.name)
+    tokens = estimate_tokens(prompt, system_prompt)
+    max_tokens = max_tokens or MAX_OUTPUT_TOKENS or None
+
+    async def fetch():
+        probe = _acquire_circuit(provider)
+        start = time.perf_counter()
+        reported = {}
+        try:
+            text = await scheduler.run(
+                lambda: _await_within(provider.complete(prompt, system_prompt, max_tokens, reported), PROVIDER_CALL_TIMEOUT),
+                tokens, deadline)
+        except BaseException as e:
+            _record_call(provider, start, prompt, system_prompt, None, e, probe, reported)
+            raise
+        call_usage = _record_call(provider, start, prompt, system_prompt, text, probe=probe, usage=reported)
+        if usage is not None:
+            add_usage(usage, call_usage)
+        return text
+
+    if SINGLE_FLIGHT_ENABLED:
+        key = "complete:" + ResponseCache.make_key(provider.name, provider.model_name, system_prompt, prompt, max_tokens)
+        fetch_once = lambda: single_flight.call(key, fetch)
+    else:
+        fetch_once = fetch
+
+    # Con llamadas agrupadas, vencer el plazo solo desengancha a este llamador (ver SingleFlight)
+    with span("ai.provider.complete", provider=provider.name, model=provider.model_name or "", use_cache=use_cache):
+        return await _await_within(
+            _cached_response(provider.name, provider.model_name, prompt, system_prompt, use_cache, fetch_once, max_tokens),
+            deadline=deadline)
+
+async def stream_provider(provider, prompt, system_prompt=None, use_cache=True, deadline=None, max_tokens=None, usage=None):
+    """Variante en streaming de call_provider (generador asíncrono). Lanza excepción si falla."""
+    scheduler = get_scheduler(provider.name)
+    tokens = estimate_tokens(prompt, system_prompt)
+    max_tokens = max_tokens or MAX_OUTPUT_TOKENS or None
+
+    async def make_stream():
+        probe = _acquire_circuit(provider)
+        start = time.perf_counter()
+        parts = []
+        reported = {}
+        try:
+            stream = scheduler.stream(
+                lambda: _iter_within(provider.stream(prompt, system_prompt, max_tokens, reported), PROVIDER_STREAM_TIMEOUT),
+                tokens, deadline)
+            async for text in stream:
+                if not parts:
+                    PROVIDER_TTFT.observe(time.perf_counter() - start, provider=provider.name)
+                parts.append(text)
+                yield text
+        except BaseException as e:
+            # GeneratorExit: quien consume dejó de leer (cliente desconectado)
+            _record_call(provider, start, prompt, system_prompt, "".join(parts),
+                         asyncio.CancelledError() if isinstance(e, GeneratorExit) else e, probe, reported)
+            raise
+        call_usage = _record_call(provider, start, prompt, system_prompt, "".join(parts), probe=probe, usage=reported)
+        if usage is not None:
+            add_usage(usage, call_usage)
+
+    if SINGLE_FLIGHT_ENABLED:
+        key = "stream:" + ResponseCache.make_key(provider.name, provider.model_name, system_prompt, prompt, max_tokens)
+        stream_once = lambda: single_flight.stream(key, make_stream)
+    else:
+        stream_once = make_stream
+
+    with span("ai.provider.stream", provider=provider.name, model=provider.model_name or "", use_cache=use_cache):
+        stream = _cached_stream(provider.name, provider.model_name, prompt, system_prompt, use_cache, stream_once, max_tokens)
+        async for text in _iter_within(stream, deadline=deadline):
+            yield text
+
+async def get_response(provider_name, prompt, system_prompt=None, use_cache=True, deadline=None):
+    """Respuesta completa de un proveedor del registro. Los errores se devuelven como texto."""
+    provider = get_provider(provider_name)
+    if not provider or not provider.active:
+        return provider.not_configured_message if provider else f"IA desconocida: {provider_name}"
+    try:
+        return await call_provider(provider, prompt, system_prompt, use_cache, deadline)
+    except Exception as e:
+        return format_error(provider, e)
+
+async def stream_response(provider_name, prompt, system_prompt=None, use_cache=True, deadline=None):
+    """Variante en streaming: generador asíncrono que entrega el texto a medida que llega."""
+    provider = get_provider(provider_name)
+    if not provider or not provider.active:
+        yield provider.not_configured_message if provider else f"IA desconocida: {provider_name}"
+        return
+    try:
+        async for text in stream_provider(provider, prompt, system_prompt, use_cache, deadline):
+            yield text
     except Exception as e:
-        return f"OpenAI Error: {e}"
-
-# --- 4. FUNCIÓN DE LOG ---
-def log_conversation(prompt, responses, mode="comparacion"):
-    log_file_path = "conversation_log.txt"
-    with open(log_file_path, "a", encoding="utf-8") as f:
-        timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        f.write(f"--- Consulta ({mode.upper()}) {timestamp} ---\n")
-        f.write(f"Pregunta Inicial: {prompt}\n\n")
-        if mode == "comparacion":
-            for ia_name, response_text in responses.items():
-                f.write(f"--- {ia_name} ---\n{textwrap.fill(response_text, width=80)}\n\n")
-        elif mode == "encadenada":
-            for i, step in enumerate(responses):
-                f.write(f"--- Paso {i+1}: {step['ia_name']} ({step['task']}) ---\n")
-                f.write(f"Respuesta: {textwrap.fill(step['response'], width=80)}\n\n")
-        f.write("="*60 + "\n\n")
-    print(f"Conversación guardada en {log_file_path}")
-
-# --- 5. PRESETS DE FLUJO DE TRABAJO ---
+        yield format_error(provider, e)
+
+async def get_gemini_response(prompt, system_prompt=None, use_cache=True):
+    return await get_response("gemini", prompt, system_prompt, use_cache)
+
+async def get_openai_response(prompt, system_prompt=None, use_cache=True):
+    return await get_response("openai", prompt, system_prompt, use_cache)
+
+async def get_claude_response(prompt, system_prompt=None, use_cache=True):
+    return await get_response("claude", prompt, system_prompt, use_cache)
+
+async def get_deepseek_response(prompt, system_prompt=None, use_cache=True):
+    return await get_response("deepseek", prompt, system_prompt, use_cache)
+
+# --- 6. FUNCIÓN DE LOG ---
+MODE_LATENCY = metrics_registry.histogram(
+    "ai_mode_request_seconds", "Duración total de cada consulta por modo.", ["mode"])
+CHAIN_STEP_LATENCY = metrics_registry.histogram(
+    "ai_chain_step_seconds", "Duración de cada paso de los presets encadenados.", ["preset", "step", "provider"])
+CHAIN_STEP_TOKENS = metrics_registry.counter(
+    "ai_chain_step_tokens_total", "Tokens de cada paso de los presets según el proveedor (input, output, cached).",
+    ["preset", "step", "provider", "kind"])
+CHAIN_STEP_FALLBACKS = metrics_registry.counter(
+    "ai_chain_step_fallbacks_total", "Pasos cuyo proveedor falló y pasaron al siguiente de reserva.", ["step", "provider", "fallback"])
+CONTEXT_SUMMARY_FAILURES = metrics_registry.counter(
+    "ai_context_summary_failures_total", "Resúmenes de contexto fallidos (el contexto se recorta en su lugar).", ["provider"])
+
+# El registro real lo hace un hilo en segundo plano (conversation_logger.py): aquí solo se encola.
+# Ese mismo hilo guarda cada lote en el historial (history.py), que es lo que sirve /api/history.
+if HISTORY_ENABLED:
+    conversation_logger.add_sink(history_store.write_batch)
+
+# Todos los modos registran aquí su resultado con sus tiempos, así que también es donde se mide su duración.
+def log_conversation(prompt, responses, mode="comparacion", timings=None, preset=None, errors=None, reused=None,
+                     session_id=None):
+    if timings and "total" in timings:
+        MODE_LATENCY.observe(timings["total"] / 1000, mode=mode)
+    record = {
+        "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+        "mode": mode,
+        "preset": preset,
+        "prompt": prompt,
+        "responses": responses,
+        "timings_ms": timings or {},
+        "errors": errors or [],
+    }
+    if reused:
+        record["reused"] = reused
+    if session_id:
+        record["session_id"] = session_id
+    conversation_logger.log(record)
+
+async def _timed(coro):
+    """Ejecuta la corrutina y devuelve (resultado, milisegundos)."""
+    start = time.perf_counter()
+    result = await coro
+    return result, round((time.perf_counter() - start) * 1000, 1)
+
+# --- 7. PRESETS DE FLUJO DE TRABAJO ---
 WORKFLOW_PRESETS = {
     "1": {
         "description": "Estrategia de Apuestas Deportivas: Gemini analiza, OpenAI detalla el plan.",
         "chain": [
-            {"ia_name": "gemini", "system_instruction": "Eres un experto en gestión de riesgos y estrategias de inversión. Sé conciso y estratégico.", "task_description": "Analiza la pregunta inicial. Ofrece una estrategia para la gestión del dinero, enfocándote en disciplina y riesgo."},
-            {"ia_name": "openai", "system_instruction": "Eres un planificador de estrategias y un comunicador claro.", "task_description": "Basándote en la estrategia inicial, detalla 3-5 pasos concretos y un plan de acción para implementarla."}
+            {"ia_name": "gemini", "max_output_tokens": 600, "system_instruction": "Eres un experto en gestión de riesgos y estrategias de inversión. Sé conciso y estratégico.", "task_description": "Analiza la pregunta inicial. Ofrece una estrategia para la gestión del dinero, enfocándote en disciplina y riesgo."},
+            {"ia_name": "openai", "max_output_tokens": 4000, "system_instruction": "Eres un planificador de estrategias y un comunicador claro.", "task_description": "Basándote en la estrategia inicial, detalla 3-5 pasos concretos y un plan de acción para implementarla."}
         ]
     },
     "2": {
         "description": "Resumen y Crítica: OpenAI resume, Gemini ofrece puntos de mejora.",
         "chain": [
-            {"ia_name": "openai", "system_instruction": "Eres un resumidor experto y conciso.", "task_description": "Resume el texto proporcionado en 50 palabras, extrayendo las ideas principales."},
-            {"ia_name": "gemini", "system_instruction": "Eres un crítico constructivo y analítico.", "task_description": "Analiza el resumen proporcionado e identifica 3 posibles puntos débiles o áreas de mejora en el texto original."}
+            {"ia_name": "openai", "max_output_tokens": 2500, "system_instruction": "Eres un resumidor experto y conciso.", "task_description": "Resume el texto proporcionado en 50 palabras, extrayendo las ideas principales."},
+            {"ia_name": "gemini", "max_output_tokens": 500, "system_instruction": "Eres un crítico constructivo y analítico.", "task_description": "Analiza el resumen proporcionado e identifica 3 posibles puntos débiles o áreas de mejora en el texto original."}
         ]
     },
     "3": {
         "description": "Brainstorming y Filtro: Gemini genera conceptos, OpenAI los filtra por viabilidad.",
         "chain": [
-            {"ia_name": "gemini", "system_instruction": "Eres un generador de ideas creativo y original.", "task_description": "Genera una lista de 5 ideas creativas relacionadas con el tema propuesto."},
-            {"ia_name": "openai", "system_instruction": "Eres un evaluador práctico y realista.", "task_description": "Evalúa las ideas recibidas en términos de viabilidad práctica. Ordena las restantes de mayor a menor viabilidad con una breve justificación."}
+            {"ia_name": "gemini", "max_output_tokens": 500, "system_instruction": "Eres un generador de ideas creativo y original.", "task_description": "Genera una lista de 5 ideas creativas relacionadas con el tema propuesto."},
+            {"ia_name": "openai", "max_output_tokens": 4000, "system_instruction": "Eres un evaluador práctico y realista.", "task_description": "Evalúa las ideas recibidas en términos de viabilidad práctica. Ordena las restantes de mayor a menor viabilidad con una breve justificación."}
+        ]
+    },
+    # Preset en grafo: un borrador, dos críticas en paralelo y una síntesis que recibe las tres salidas
+    "4": {
+        "description": "Borrador y Revisión en Paralelo: Gemini redacta, OpenAI y Claude critican a la vez, Gemini fusiona.",
+        "context_budget": 1200,
+        "compaction": "summary",
+        "steps": [
+            {"id": "borrador", "ia_name": "gemini", "max_output_tokens": 1200, "fallback": ["claude", "openai"], "system_instruction": "Eres un redactor claro y bien documentado.", "task_description": "Responde a la pregunta con un primer borrador completo y bien estructurado."},
+            {"id": "critica_openai", "ia_name": "openai", "max_output_tokens": 3500, "depends_on": ["borrador"], "system_instruction": "Eres un revisor riguroso centrado en la exactitud.", "task_description": "Señala errores, afirmaciones dudosas y omisiones importantes del borrador."},
+            {"id": "critica_claude", "ia_name": "claude", "max_output_tokens": 500, "depends_on": ["borrador"], "system_instruction": "Eres un editor exigente centrado en la claridad.", "task_description": "Señala qué partes del borrador son confusas, redundantes o mejorables y cómo reescribirlas."},
+            {"id": "sintesis", "ia_name": "gemini", "max_output_tokens": 1500, "fallback": ["claude"], "depends_on": ["borrador", "critica_openai", "critica_claude"], "include_prompt": True, "system_instruction": "Eres un editor jefe que integra revisiones.", "task_description": "Reescribe el borrador incorporando las críticas pertinentes. Devuelve solo la versión final."}
         ]
     }
 }
 
-# --- 6. FUNCIONES WRAPPER PARA FLASK ---
-async def run_comparison_mode(prompt):
-    if not gemini_model and not openai_client:
+# Presupuesto de contexto: la salida de un paso que supere "context_budget" tokens se recorta antes
+# de pasarla a los pasos que dependen de él, con la estrategia "compaction" (head, tail, section
+# con "section": "<título>", o summary con "summary_provider"). Se fijan en el preset o en cada paso.
+CHAIN_CONTEXT_BUDGET = int(os.getenv("CHAIN_CONTEXT_BUDGET", 2000))  # tokens; 0 = sin límite
+CHAIN_COMPACTION = os.getenv("CHAIN_COMPACTION", "head")
+CHAIN_SUMMARY_PROVIDER = os.getenv("CHAIN_SUMMARY_PROVIDER", "gemini")
+CHAIN_SUMMARY_MAX_INPUT = int(os.getenv("CHAIN_SUMMARY_MAX_INPUT", 16000))  # tokens que se envían a resumir
+STEP_SETTINGS = ("context_budget", "compaction", "section", "summary_provider", "fallback", "max_output_tokens")
+
+def compile_preset(preset):
+    """Pasos del preset en orden topológico, con los ajustes de nivel de preset heredados por cada paso."""
+    nodes = compile_workflow(preset)
+    for node in nodes:
+        for key in STEP_SETTINGS:
+            if key in preset:
+                node.setdefault(key, preset[key])
+        node.setdefault("context_budget", CHAIN_CONTEXT_BUDGET)
+        node.setdefault("compaction", CHAIN_COMPACTION)
+        node.setdefault("max_output_tokens", MAX_OUTPUT_TOKENS)
+        if node["compaction"] not in COMPACTION_STRATEGIES:
+            raise WorkflowError(f"Estrategia de compactación no válida en '{node['id']}': {node['compaction']}")
+        node["fallback"] = list(node.get("fallback", []))
+        for name in node["fallback"]:
+            if name not in PROVIDERS:
+                raise WorkflowError(f"Proveedor de reserva desconocido en '{node['id']}': {name}")
+    return nodes
+
+# Cada preset se valida y se ordena una sola vez al importar: un preset mal definido falla aquí
+# y no a mitad de una petición. Un preset se define con "chain" (lista lineal) o con "steps"
+# (cada paso con "id" y "depends_on"; "include_prompt": True añade la pregunta original al contexto).
+# "fallback": ["claude", ...] son los proveedores que responden el paso, en ese orden, si el suyo
+# falla o tiene el circuito abierto (también se puede fijar para todo el preset).
+# "max_output_tokens" limita la respuesta del paso en el propio proveedor: un paso locuaz tarda más
+# en generarse y además alarga el prompt (y la latencia) de los pasos que dependen de él. Con un
+# modelo de razonamiento (el de OpenAI por defecto) el límite incluye los tokens de razonamiento, por
+# eso los pasos de openai tienen más margen: si el razonamiento lo agota, la respuesta llega vacía y
+# el paso falla (ProviderResponseError) en vez de pasar un texto vacío; si solo la corta, el uso del
+# paso lleva "truncated".
+WORKFLOW_GRAPHS = {key: compile_preset(preset) for key, preset in WORKFLOW_PRESETS.items()}
+
+def step_providers(node):
+    """Proveedores configurados que pueden responder el paso: el suyo y, detrás, los de reserva.
+    Los que tienen el circuito abierto pasan al final: solo se intentan si no queda otro."""
+    candidates = []
+    for name in [node["ia_name"], *node.get("fallback", [])]:
+        provider = get_provider(name)
+        if provider and provider.active and provider not in candidates:
+            candidates.append(provider)
+    return sorted(candidates, key=lambda p: not router.available(p))
+
+class StepError(Exception):
+    """Ningún proveedor pudo responder el paso: 'provider' es el último que se intentó y 'error' su excepción."""
+
+    def __init__(self, provider, error):
+        super().__init__(format_error(provider, error))
+        self.provider = provider
+        self.error = error
+
+async def call_step(node, prompt, system_prompt=None, use_cache=True, candidates=None, deadline=None, usage=None):
+    """Respuesta del paso con el primer proveedor que no falle: (proveedor, texto). Si fallan todos
+    (o se agota el plazo, y entonces no se prueba ninguno más), lanza StepError."""
+    candidates = candidates or step_providers(node)
+    for i, provider in enumerate(candidates):
+        try:
+            return provider, await call_provider(provider, prompt, system_prompt, use_cache, deadline,
+                                                 node.get("max_output_tokens"), usage)
+        except Exception as e:
+            if i == len(candidates) - 1 or isinstance(e, DeadlineExceededError):
+                raise StepError(provider, e) from e
+            _record_fallback(node, provider, candidates[i + 1], e)
+
+def _record_fallback(node, provider, fallback, e):
+    CHAIN_STEP_FALLBACKS.inc(step=node["id"], provider=provider.name, fallback=fallback.name)
+    logger.warning("Paso '%s': %s; se pasa a %s.", node["id"], format_error(provider, e), fallback.label)
+
+def step_deadline(deadline, steps_left):
+    """Plazo de un paso: el tiempo que queda, repartido a partes iguales entre él y los pasos que aún
+    tienen que ejecutarse después en serie (el último paso dispone de todo lo que quede)."""
+    left = time_left(deadline)
+    if left is None:
+        return None
+    return time.monotonic() + max(0.0, left) / steps_left
+
+async def compact_context(text, node, use_cache=True, deadline=None, usage=None):
+    """Reduce la salida de un paso a su presupuesto de tokens. Devuelve (texto, estrategia aplicada o None)."""
+    budget = node.get("context_budget", CHAIN_CONTEXT_BUDGET)
+    strategy = node.get("compaction", CHAIN_COMPACTION)
+    if not budget or count_tokens(text) <= budget:
+        return text, None
+    if strategy == "summary":
+        provider = get_provider(node.get("summary_provider", CHAIN_SUMMARY_PROVIDER))
+        if not provider or not provider.active:
+            provider = next(iter(active_providers()), None)
+        if provider:
+            words = max(20, budget * 3 // 4)  # ~0,75 palabras por token
+            prompt = f"Resume el siguiente texto en como máximo {words} palabras, conservando datos, cifras y conclusiones:\n\n{truncate_tokens(text, CHAIN_SUMMARY_MAX_INPUT)}"
+            try:
+                summary = await call_provider(provider, prompt, "Eres un resumidor fiel y conciso.", use_cache, deadline,
+                                              max_tokens=budget, usage=usage)
+                return truncate_tokens(summary, budget), "summary"
+            except Exception as e:
+                # Un resumen fallido no detiene la cadena: se recorta localmente
+                CONTEXT_SUMMARY_FAILURES.inc(provider=provider.name)
+                logger.warning("No se pudo resumir el contexto (%s); se recorta.", format_error(provider, e))
+        strategy = "head"
+    return compact_text(text, budget, strategy, node.get("section"))
+
+def _step_tokens(prompt, system_prompt, output, passed):
+    return {
+        "prompt": count_tokens(prompt) + count_tokens(system_prompt),
+        "output": count_tokens(output),
+        "passed": count_tokens(passed),
+    }
+
+def _record_step_usage(preset_key, node, provider, usage):
+    """Acumula el uso del paso (su llamada y, si lo hubo, el resumen de su salida) por preset, paso y proveedor."""
+    usage_tracker.record_step(preset_key, node["id"], provider.name, usage)
+    for kind in ("input_tokens", "output_tokens", "cached_tokens"):
+        if usage[kind]:
+            CHAIN_STEP_TOKENS.inc(usage[kind], preset=preset_key, step=node["id"], provider=provider.name, kind=kind[:-len("_tokens")])
+
+# --- 8. FUNCIONES WRAPPER PARA FLASK ---
+async def run_comparison_mode(prompt, use_cache=True, session_id=None, deadline=None):
+    providers = active_providers()
+    if not providers:
         return {"Error": "Ninguna IA está configurada."}
-    tasks, active_ias = [], []
-    if gemini_model:
-        tasks.append(asyncio.create_task(get_gemini_response(prompt)))
-        active_ias.append("Gemini")
-    if openai_client:
-        tasks.append(asyncio.create_task(get_openai_response(prompt)))
-        active_ias.append("OpenAI (ChatGPT)")
-    
-    responses_list = await asyncio.gather(*tasks)
-    all_responses = dict(zip(active_ias, responses_list))
-    log_conversation(prompt, all_responses, mode="comparacion")
-    return all_responses
+    start = time.perf_counter()
+    follow_up = _is_follow_up(session_id)
+    # Una pregunta casi igual a otra reciente devuelve sus respuestas, marcadas con "_reused"
+    reused_responses, reused = _similar_result(prompt, "comparacion", use_cache=use_cache and not follow_up)
+    if reused:
+        log_conversation(prompt, reused_responses, mode="comparacion", reused=reused, session_id=session_id,
+                         timings={"total": round((time.perf_counter() - start) * 1000, 1)})
+        _session_append(session_id, prompt, [(p.name, reused_responses.get(p.label)) for p in providers])
+        return dict(reused_responses, _reused=reused)
 
-async def run_chain_mode(prompt, preset_key):
-    selected_preset = WORKFLOW_PRESETS.get(preset_key)
-    if not selected_preset:
-        return [{"Error": "Preset no válido."}]
-    
-    chain_definition = selected_preset["chain"]
-    available_ais_info = {
-        "gemini": {"func": get_gemini_response, "active": bool(gemini_model)},
-        "openai": {"func": get_openai_response, "active": bool(openai_client)},
+    timed_out = []
+    usages = {p.label: new_usage() for p in providers}
+
+    async def ask(provider):
+        try:
+            return await call_provider(provider, _session_prompt(session_id, provider.name, prompt), use_cache=use_cache,
+                                       deadline=deadline, usage=usages[provider.label]), False
+        except Exception as e:
+            if isinstance(e, DeadlineExceededError):
+                timed_out.append(provider.label)
+            return format_error(provider, e), True
+
+    tasks = [asyncio.create_task(_timed(ask(p))) for p in providers]
+    active_ias = [p.label for p in providers]
+    responses_list = await asyncio.gather(*tasks)
+    all_responses = {ia: text for ia, ((text, _), _) in zip(active_ias, responses_list)}
+    timings = {
+        "total": round((time.perf_counter() - start) * 1000, 1),
+        "providers": {ia: elapsed for ia, (_, elapsed) in zip(active_ias, responses_list)},
     }
-    
-    current_context = prompt
-    full_conversation_log = []
-
-    for step_config in chain_definition:
-        ia_name = step_config["ia_name"]
-        if not available_ais_info.get(ia_name, {}).get("active"):
-            full_conversation_log.append({"ia_name": ia_name.upper(), "task": "SALTADO", "response": "Esta IA no está configurada."})
+    errors = [ia for ia, ((_, failed), _) in zip(active_ias, responses_list) if failed]
+    if timed_out:
+        timings["timed_out"] = timed_out
+    timings["usage"] = usages
+    log_conversation(prompt, all_responses, mode="comparacion", timings=timings, errors=errors, session_id=session_id)
+    _session_append(session_id, prompt, [(p.name, all_responses[p.label]) for p in providers if p.label not in errors])
+    if not errors and not follow_up:
+        _remember_result(prompt, "comparacion", all_responses)
+    # "_usage": tokens de cada proveedor; "_timed_out": respuestas que no llegaron dentro del plazo
+    # (las demás se devuelven igualmente)
+    results = dict(all_responses, _usage=usages)
+    if timed_out:
+        results["_timed_out"] = timed_out
+    return results
+
+# Modo carrera: lo que importa es la latencia de cola, no comparar modelos. Se devuelve la primera
+# respuesta válida y se cancelan las demás llamadas en vuelo para no seguir pagándolas.
+#  - strategy="all":    se lanza el prompt a todos los proveedores a la vez.
+#  - strategy="hedged": se lanza al proveedor más rápido y, si no ha respondido al llegar a su
+#                       percentil RACE_HEDGE_PERCENTILE de latencia, se lanza una petición de cobertura
+#                       al siguiente (y así sucesivamente).
+RACE_HEDGE_PERCENTILE = float(os.getenv("RACE_HEDGE_PERCENTILE", 0.95))
+RACE_HEDGE_DEFAULT_DELAY = float(os.getenv("RACE_HEDGE_DEFAULT_DELAY", 2.0))  # segundos, sin historial
+RACE_HEDGE_MIN_SAMPLES = 20
+
+def hedge_delay(provider):
+    """Segundos a esperar antes de lanzar la petición de cobertura contra otro proveedor."""
+    if latency_tracker.count(provider.name) < RACE_HEDGE_MIN_SAMPLES:
+        return RACE_HEDGE_DEFAULT_DELAY
+    return latency_tracker.percentile(provider.name, RACE_HEDGE_PERCENTILE) / 1000
+
+async def run_race_mode(prompt, use_cache=True, strategy="all", session_id=None, deadline=None):
+    providers = active_providers()
+    if not providers:
+        return {"Error": "Ninguna IA está configurada."}
+    if strategy == "hedged":
+        # Primero el que históricamente responde antes (p50); los desconocidos, en orden de registro
+        providers.sort(key=lambda p: latency_tracker.percentile(p.name, 0.5) or float("inf"))
+
+    start = time.perf_counter()
+    waiting = list(providers)
+    pending = {}
+    errors = {}
+    winner = None
+    usages = {}
+
+    def launch():
+        provider = waiting.pop(0)
+        provider_prompt = _session_prompt(session_id, provider.name, prompt)
+        usage = usages[provider.label] = new_usage()
+        pending[asyncio.create_task(call_provider(provider, provider_prompt, use_cache=use_cache, deadline=deadline, usage=usage))] = provider
+        return provider
+
+    last_launched = launch()
+    while strategy != "hedged" and waiting:
+        launch()
+
+    try:
+        while pending and not winner:
+            timeout = hedge_delay(last_launched) if strategy == "hedged" and waiting else None
+            done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                # Se superó el umbral sin respuesta: petición de cobertura al siguiente proveedor
+                last_launched = launch()
+                continue
+            for task in done:
+                provider = pending.pop(task)
+                if task.exception() is None and task.result():
+                    winner = (provider, task.result())
+                    break
+                errors[provider.label] = format_error(provider, task.exception()) if task.exception() else f"{provider.short_name}: respuesta vacía."
+            # Si falló el único en vuelo, no esperamos al umbral para probar con el siguiente
+            if not winner and not pending and waiting:
+                last_launched = launch()
+    finally:
+        cancelled = [p.label for task, p in pending.items() if not task.done()]
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+    timings = {"total": round((time.perf_counter() - start) * 1000, 1)}
+    if not winner:
+        log_conversation(prompt, errors, mode="carrera", timings=timings, errors=list(errors), session_id=session_id)
+        return errors
+    provider, text = winner
+    timings["winner"] = provider.label
+    timings["cancelled"] = cancelled
+    timings["usage"] = usages
+    log_conversation(prompt, {provider.label: text}, mode="carrera", timings=timings, errors=list(errors), session_id=session_id)
+    # La respuesta ganadora es la que vio el usuario: todos los proveedores la verán como historial
+    _session_append(session_id, prompt, [(None, text)])
+    return {provider.label: text, "_usage": {provider.label: usages[provider.label]}}
+
+# Modo automático: una sola llamada al proveedor sano que hoy responde antes según el enrutador
+# (latencia EWMA penalizada por su tasa de errores). Si falla, se pasa al siguiente del ranking.
+# A diferencia del modo carrera no se paga más de una llamada salvo cuando algo falla.
+async def run_auto_mode(prompt, use_cache=True, session_id=None, deadline=None):
+    providers = active_providers()
+    if not providers:
+        return {"Error": "Ninguna IA está configurada."}
+    start = time.perf_counter()
+    # Con todos los circuitos abiertos se intenta igualmente: cada llamada se rechaza al instante
+    ranked = router.rank(providers) or providers
+    errors = {}
+    tried = []
+    winner = None
+    usage = new_usage()  # uso de las respuestas recibidas (también las vacías)
+    for provider in ranked:
+        tried.append(provider.label)
+        try:
+            text = await call_provider(provider, _session_prompt(session_id, provider.name, prompt), use_cache=use_cache,
+                                       deadline=deadline, usage=usage)
+        except Exception as e:
+            errors[provider.label] = format_error(provider, e)
+            if isinstance(e, DeadlineExceededError):
+                break
             continue
+        if text:
+            winner = (provider, text)
+            break
+        errors[provider.label] = f"{provider.short_name}: respuesta vacía."
+
+    timings = {"total": round((time.perf_counter() - start) * 1000, 1), "tried": tried, "usage": usage}
+    if not winner:
+        log_conversation(prompt, errors, mode="auto", timings=timings, errors=list(errors), session_id=session_id)
+        return errors
+    provider, text = winner
+    timings["routed"] = provider.label
+    log_conversation(prompt, {provider.label: text}, mode="auto", timings=timings, errors=list(errors), session_id=session_id)
+    # El siguiente turno puede ir a otro proveedor: todos ven esta respuesta como historial
+    _session_append(session_id, prompt, [(None, text)])
+    return {provider.label: text, "_usage": {provider.label: usage}}
+
+def _build_chain_prompt(current_context, task_description):
+    # Primero lo fijo del paso (la tarea) y después lo variable (el contexto): así el prefijo
+    # instrucción de sistema + tarea es idéntico byte a byte en cada ejecución del preset y el
+    # proveedor puede reutilizarlo desde su caché de prefijos
+    return f"TU TAREA ES: {task_description}\n\nCONTEXTO PREVIO: {current_context}"
+
+def _step_context(prompt, node, inputs, session_id=None):
+    """Contexto de un paso: la pregunta si no tiene entradas (con el historial de la sesión, si la hay),
+    la salida de su única dependencia o, si tiene varias, cada salida encabezada por el paso que la produjo."""
+    if not inputs:
+        return _session_prompt(session_id, node["ia_name"], prompt)
+    if len(inputs) == 1:
+        context = inputs[0][1]
+    else:
+        context = "\n\n".join(f"[{dep['id']} - {dep['ia_name'].upper()}]\n{text}" for dep, text in inputs)
+    if node.get("include_prompt"):
+        context = f"PREGUNTA INICIAL: {prompt}\n\n{context}"
+    return context
+
+def build_step_prompt(prompt, node, inputs, session_id=None):
+    """Prompt de un paso de la cadena (la tarea del paso y su contexto), el mismo en la API y en la CLI."""
+    return _build_chain_prompt(_step_context(prompt, node, inputs, session_id), node["task_description"])
+
+def _chain_final_answer(nodes, entries):
+    """Respuesta final de la cadena para el historial de la sesión: la de los pasos de los que no depende ninguno."""
+    upstream = {dep for node in nodes for dep in node["depends_on"]}
+    finals = [entries[node["id"]] for node in nodes
+              if node["id"] not in upstream and node["id"] in entries and not entries[node["id"]].get("error")]
+    return "\n\n".join(entry["response"] for entry in finals if entry["task"] != "SALTADO")
+
+def _chain_summary(nodes, entries, step_timings, start, run_id=None):
+    """Registro de la cadena en el orden declarado de los pasos, y sus tiempos."""
+    ran = [node for node in sorted(nodes, key=lambda n: n["step"]) if node["id"] in entries]
+    timings = {
+        "total": round((time.perf_counter() - start) * 1000, 1),
+        "steps": [step_timings[node["id"]] for node in ran],
+        "critical_path": critical_path(nodes, step_timings),
+        "run_id": run_id,
+        "restored": [node["id"] for node in ran if entries[node["id"]].get("checkpoint")],
+    }
+    timed_out = [node["id"] for node in ran if entries[node["id"]].get("timed_out")]
+    if timed_out:
+        timings["timed_out"] = timed_out
+    # Uso total de esta ejecución: los pasos restaurados de un checkpoint no han costado nada ahora
+    timings["usage"] = new_usage()
+    for node in ran:
+        if "usage" in entries[node["id"]] and not entries[node["id"]].get("checkpoint"):
+            add_usage(timings["usage"], entries[node["id"]]["usage"])
+    return [entries[node["id"]] for node in ran], timings
+
+def _restore_step(run_id, node, provider, prompt_for_current_ia, use_cache):
+    """Hash de las entradas del paso y su checkpoint, (registro, texto pasado), si no han cambiado.
+    Con use_cache=False no se restaura nada, pero el hash sirve para guardar el nuevo resultado.
+    Sin run_id no hay checkpoints: nadie podría reanudar esa ejecución."""
+    if not CHAIN_CHECKPOINTS_ENABLED or not run_id:
+        return None, None
+    input_hash = step_hash(node, provider.model_name, prompt_for_current_ia, node["system_instruction"])
+    return input_hash, checkpoint_store.load(run_id, node["id"], input_hash) if use_cache else None
+
+# run_id identifica la ejecución a efectos de checkpoints: solo quien lo indica reanuda una ejecución
+# anterior con el mismo run_id. Sin él, cada petición es una ejecución nueva y no se guardan checkpoints.
+async def run_chain_mode(prompt, preset_key, use_cache=True, run_id=None, session_id=None, deadline=None):
+    nodes = WORKFLOW_GRAPHS.get(preset_key)
+    if not nodes:
+        return [{"Error": "Preset no válido."}]
+
+    start = time.perf_counter()
+    follow_up = _is_follow_up(session_id)
+    reused_log, reused = _similar_result(prompt, "encadenada", preset_key, use_cache and not follow_up)
+    if reused:
+        for entry in reused_log:
+            entry["reused"] = reused
+        log_conversation(prompt, reused_log, mode="encadenada", preset=preset_key, reused=reused, session_id=session_id,
+                         timings={"total": round((time.perf_counter() - start) * 1000, 1)})
+        _session_append(session_id, prompt, [(None, _chain_final_answer(nodes, {n["id"]: e for n in nodes for e in reused_log if e["step"] == n["step"]}))])
+        return reused_log
+
+    entries = {}
+    step_timings = {}
+    # Solo se compacta lo que algún paso va a recibir
+    upstream = {dep for node in nodes for dep in node["depends_on"]}
+    # Con plazo, cada paso dispone de su parte del tiempo restante (ver step_deadline)
+    steps_left = steps_to_end(nodes)
+
+    # Cada paso recibe solo las salidas de los pasos de los que depende; los que no dependen
+    # entre sí se ejecutan a la vez
+    async def run_node(node, inputs):
+        ia_name = node["ia_name"]
+        candidates = step_providers(node)
+        if not candidates:
+            entries[node["id"]] = {"step": node["step"], "ia_name": ia_name.upper(), "task": "SALTADO", "response": "Esta IA no está configurada."}
+            step_timings[node["id"]] = 0.0
+            return SKIPPED
 
-        ia_system_instruction = step_config["system_instruction"]
-        ia_task_description = step_config["task_description"]
-        ia_func = available_ais_info[ia_name]["func"]
+        ia_task_description = node["task_description"]
+        prompt_for_current_ia = build_step_prompt(prompt, node, inputs, session_id)
+        input_hash, restored = _restore_step(run_id, node, candidates[0], prompt_for_current_ia, use_cache)
+        if restored:
+            entry, passed = restored
+            entries[node["id"]] = dict(entry, checkpoint=True)
+            step_timings[node["id"]] = 0.0
+            return passed
+        step_start = time.perf_counter()
+        node_deadline = step_deadline(deadline, steps_left[node["id"]])
+        usage = new_usage()
+        provider = candidates[0]
+        try:
+            provider, response_text = await call_step(node, prompt_for_current_ia, node["system_instruction"], use_cache, candidates,
+                                                      node_deadline, usage)
+        except StepError as e:
+            # Un error nunca se pasa como contexto: los pasos que dependen de este no se ejecutan
+            provider = e.provider
+            entries[node["id"]] = {"step": node["step"], "ia_name": provider.name.upper(), "task": ia_task_description, "response": str(e), "error": True}
+            if isinstance(e.error, DeadlineExceededError):
+                entries[node["id"]]["timed_out"] = True
+            raise
+        finally:
+            step_timings[node["id"]] = round((time.perf_counter() - step_start) * 1000, 1)
+            CHAIN_STEP_LATENCY.observe(step_timings[node["id"]] / 1000, preset=preset_key, step=node["id"], provider=provider.name)
 
-        prompt_for_current_ia = f"CONTEXTO PREVIO: {current_context}\n\nTU TAREA ES: {ia_task_description}"
-        response_text = await ia_func(prompt_for_current_ia, system_prompt=ia_system_instruction)
-        
-        full_conversation_log.append({
-            "ia_name": ia_name.upper(),
+        passed, compacted = await compact_context(response_text, node, use_cache, node_deadline, usage) if node["id"] in upstream else (response_text, None)
+        _record_step_usage(preset_key, node, provider, usage)
+        entries[node["id"]] = {
+            "step": node["step"],
+            "ia_name": provider.name.upper(),
             "task": ia_task_description,
-            "response": response_text
-        })
-        current_context = response_text
-    
-    log_conversation(prompt, full_conversation_log, mode="encadenada")
-    return full_conversation_log
\ No newline at end of file
+            "response": response_text,
+            "tokens": _step_tokens(prompt_for_current_ia, node["system_instruction"], response_text, passed),
+            "usage": usage,
+        }
+        if provider.name != ia_name:
+            entries[node["id"]]["fallback_from"] = ia_name.upper()
+        if compacted:
+            entries[node["id"]]["compacted"] = compacted
+        if input_hash:
+            checkpoint_store.save(run_id, node["id"], input_hash, entries[node["id"]], passed)
+        return passed
+
+    _, failed = await run_workflow(nodes, run_node)
+    full_conversation_log, timings = _chain_summary(nodes, entries, step_timings, start, run_id)
+    log_conversation(prompt, full_conversation_log, mode="encadenada", timings=timings, preset=preset_key, session_id=session_id)
+    _session_append(session_id, prompt, [(None, _chain_final_answer(nodes, entries))])
+    if not failed and not follow_up:
+        _remember_result(prompt, "encadenada", full_conversation_log, preset_key)
+    return full_conversation_log
+
+# --- 9. MODOS EN STREAMING (SSE) ---
+# Cada evento es un dict serializable a JSON:
+#   {"type": "start", "provider": ..., "step": ..., "task": ...}   comienza una respuesta
+#   {"type": "token", "provider": ..., "step": ..., "text": ...}   fragmento de texto
+#   {"type": "done",  "provider": ..., "step": ...}                respuesta completa
+# En modo comparación "step" es None; en modo encadenado es el número de paso (1, 2, ...).
+# Un "done" con "timed_out" indica que la respuesta se cortó al agotarse el plazo de la petición.
+# Si se reutiliza el resultado de una pregunta casi igual, los eventos "start" llevan "reused".
+def _replay_events(entries, reused):
+    """Eventos de un resultado reutilizado: cada respuesta completa en un único fragmento."""
+    for step, provider, task, text in entries:
+        yield {"type": "start", "provider": provider, "step": step, "task": task, "reused": reused}
+        yield {"type": "token", "provider": provider, "step": step, "text": text}
+        yield {"type": "done", "provider": provider, "step": step}
+
+async def stream_comparison_mode(prompt, use_cache=True, session_id=None, deadline=None):
+    providers = active_providers()
+    if not providers:
+        yield {"type": "token", "provider": "Error", "step": None, "text": "Ninguna IA está configurada."}
+        return
+
+    start = time.perf_counter()
+    follow_up = _is_follow_up(session_id)
+    reused_responses, reused = _similar_result(prompt, "comparacion", use_cache=use_cache and not follow_up)
+    if reused:
+        for event in _replay_events([(None, ia, None, text) for ia, text in reused_responses.items()], reused):
+            yield event
+        log_conversation(prompt, reused_responses, mode="comparacion", reused=reused, session_id=session_id,
+                         timings={"total": round((time.perf_counter() - start) * 1000, 1)})
+        _session_append(session_id, prompt, [(p.name, reused_responses.get(p.label)) for p in providers])
+        return
+
+    # Todos los proveedores escriben en una cola común; así cada fragmento se reenvía en cuanto llega
+    queue = asyncio.Queue()
+    all_responses = {p.label: "" for p in providers}
+    errors = []
+    timings = {"providers": {}, "first_token": {}, "usage": {}}
+
+    async def pump(provider):
+        ia_name = provider.label
+        usage = timings["usage"][ia_name] = new_usage()
+        done_event = {"type": "done", "provider": ia_name, "step": None, "usage": usage}
+        try:
+            async for text in stream_provider(provider, _session_prompt(session_id, provider.name, prompt), use_cache=use_cache, deadline=deadline,
+                                              usage=usage):
+                await queue.put({"type": "token", "provider": ia_name, "step": None, "text": text})
+        except Exception as e:
+            errors.append(ia_name)
+            if isinstance(e, DeadlineExceededError):
+                done_event["timed_out"] = True
+                timings.setdefault("timed_out", []).append(ia_name)
+            await queue.put({"type": "token", "provider": ia_name, "step": None, "text": format_error(provider, e)})
+        finally:
+            await queue.put(done_event)
+
+    tasks = [asyncio.create_task(pump(provider)) for provider in providers]
+    try:
+        for ia_name in all_responses:
+            yield {"type": "start", "provider": ia_name, "step": None, "task": None}
+        pending = len(tasks)
+        while pending:
+            event = await queue.get()
+            elapsed = round((time.perf_counter() - start) * 1000, 1)
+            if event["type"] == "token":
+                all_responses[event["provider"]] += event["text"]
+                timings["first_token"].setdefault(event["provider"], elapsed)
+            else:
+                timings["providers"][event["provider"]] = elapsed
+                pending -= 1
+            yield event
+    finally:
+        # Si el cliente se desconecta, no seguimos consumiendo (ni pagando) los streams restantes
+        for task in tasks:
+            task.cancel()
+    timings["total"] = round((time.perf_counter() - start) * 1000, 1)
+    log_conversation(prompt, all_responses, mode="comparacion", timings=timings, errors=errors, session_id=session_id)
+    _session_append(session_id, prompt, [(p.name, all_responses[p.label]) for p in providers if p.label not in errors])
+    if not errors and not follow_up:
+        _remember_result(prompt, "comparacion", all_responses)
+
+async def stream_chain_mode(prompt, preset_key, use_cache=True, run_id=None, session_id=None, deadline=None):
+    nodes = WORKFLOW_GRAPHS.get(preset_key)
+    if not nodes:
+        yield {"type": "token", "provider": "Error", "step": None, "text": "Preset no válido."}
+        return
+
+    start = time.perf_counter()
+    follow_up = _is_follow_up(session_id)
+    reused_log, reused = _similar_result(prompt, "encadenada", preset_key, use_cache and not follow_up)
+    if reused:
+        for event in _replay_events([(e["step"], e["ia_name"], e["task"], e["response"]) for e in reused_log], reused):
+            yield event
+        for entry in reused_log:
+            entry["reused"] = reused
+        log_conversation(prompt, reused_log, mode="encadenada", preset=preset_key, reused=reused, session_id=session_id,
+                         timings={"total": round((time.perf_counter() - start) * 1000, 1)})
+        _session_append(session_id, prompt, [(None, _chain_final_answer(nodes, {n["id"]: e for n in nodes for e in reused_log if e["step"] == n["step"]}))])
+        return
+
+    entries = {}
+    step_timings = {}
+    upstream = {dep for node in nodes for dep in node["depends_on"]}
+    steps_left = steps_to_end(nodes)
+    # Los pasos paralelos escriben sus eventos en una cola común, como en stream_comparison_mode
+    queue = asyncio.Queue()
+
+    async def run_node(node, inputs):
+        ia_name, i = node["ia_name"], node["step"]
+        candidates = step_providers(node)
+        if not candidates:
+            entries[node["id"]] = {"step": i, "ia_name": ia_name.upper(), "task": "SALTADO", "response": "Esta IA no está configurada."}
+            await queue.put({"type": "start", "provider": ia_name.upper(), "step": i, "task": "SALTADO"})
+            await queue.put({"type": "token", "provider": ia_name.upper(), "step": i, "text": "Esta IA no está configurada."})
+            await queue.put({"type": "done", "provider": ia_name.upper(), "step": i})
+            step_timings[node["id"]] = 0.0
+            return SKIPPED
+
+        ia_task_description = node["task_description"]
+        prompt_for_current_ia = build_step_prompt(prompt, node, inputs, session_id)
+        input_hash, restored = _restore_step(run_id, node, candidates[0], prompt_for_current_ia, use_cache)
+        if restored:
+            # Paso restaurado de un checkpoint: su respuesta se entrega en un único fragmento
+            entry, passed = restored
+            entries[node["id"]] = dict(entry, checkpoint=True)
+            step_timings[node["id"]] = 0.0
+            await queue.put({"type": "start", "provider": entry["ia_name"], "step": i, "task": ia_task_description, "checkpoint": True})
+            await queue.put({"type": "token", "provider": entry["ia_name"], "step": i, "text": entry["response"]})
+            await queue.put({"type": "done", "provider": entry["ia_name"], "step": i, "tokens": entry.get("tokens"), "usage": entry.get("usage")})
+            return passed
+
+        step_start = time.perf_counter()
+        node_deadline = step_deadline(deadline, steps_left[node["id"]])
+        usage = new_usage()
+        response_text = ""
+        # Se pasa al proveedor de reserva solo si el anterior falla antes del primer fragmento:
+        # lo ya enviado al cliente no se puede retirar
+        try:
+            for n, provider in enumerate(candidates):
+                label = provider.name.upper()
+                start_event = {"type": "start", "provider": label, "step": i, "task": ia_task_description}
+                if provider.name != ia_name:
+                    start_event["fallback_from"] = ia_name.upper()
+                await queue.put(start_event)
+                try:
+                    async for text in stream_provider(provider, prompt_for_current_ia, node["system_instruction"], use_cache, node_deadline,
+                                                      node.get("max_output_tokens"), usage):
+                        response_text += text
+                        await queue.put({"type": "token", "provider": label, "step": i, "text": text})
+                    break
+                except Exception as e:
+                    timed_out = isinstance(e, DeadlineExceededError)
+                    if not response_text and n < len(candidates) - 1 and not timed_out:
+                        _record_fallback(node, provider, candidates[n + 1], e)
+                        continue
+                    # Un error nunca se pasa como contexto: los pasos que dependen de este no se ejecutan
+                    error_text = format_error(provider, e)
+                    await queue.put({"type": "token", "provider": label, "step": i, "text": error_text})
+                    done_event = {"type": "done", "provider": label, "step": i, "error": True}
+                    entries[node["id"]] = {"step": i, "ia_name": label, "task": ia_task_description, "response": response_text + error_text, "error": True}
+                    if timed_out:
+                        done_event["timed_out"] = entries[node["id"]]["timed_out"] = True
+                    await queue.put(done_event)
+                    raise
+        finally:
+            step_timings[node["id"]] = round((time.perf_counter() - step_start) * 1000, 1)
+            CHAIN_STEP_LATENCY.observe(step_timings[node["id"]] / 1000, preset=preset_key, step=node["id"], provider=provider.name)
+        passed, compacted = await compact_context(response_text, node, use_cache, node_deadline, usage) if node["id"] in upstream else (response_text, None)
+        _record_step_usage(preset_key, node, provider, usage)
+        tokens = _step_tokens(prompt_for_current_ia, node["system_instruction"], response_text, passed)
+        await queue.put({"type": "done", "provider": label, "step": i, "tokens": tokens, "usage": usage})
+
+        entries[node["id"]] = {
+            "step": i,
+            "ia_name": label,
+            "task": ia_task_description,
+            "response": response_text,
+            "tokens": tokens,
+            "usage": usage,
+        }
+        if provider.name != ia_name:
+            entries[node["id"]]["fallback_from"] = ia_name.upper()
+        if compacted:
+            entries[node["id"]]["compacted"] = compacted
+        if input_hash:
+            checkpoint_store.save(run_id, node["id"], input_hash, entries[node["id"]], passed)
+        return passed
+
+    failed = None
+
+    async def drive():
+        nonlocal failed
+        try:
+            _, failed = await run_workflow(nodes, run_node)
+        finally:
+            await queue.put(None)
+
+    runner = asyncio.create_task(drive())
+    try:
+        while True:
+            event = await queue.get()
+            if event is None:
+                break
+            yield event
+    finally:
+        # Si el cliente se desconecta, run_workflow cancela los pasos en vuelo
+        runner.cancel()
+        await asyncio.gather(runner, return_exceptions=True)
+
+    full_conversation_log, timings = _chain_summary(nodes, entries, step_timings, start, run_id)
+    log_conversation(prompt, full_conversation_log, mode="encadenada", timings=timings, preset=preset_key, session_id=session_id)
+    _session_append(session_id, prompt, [(None, _chain_final_answer(nodes, entries))])
+    if failed is not None and not failed and not follow_up:
+        _remember_result(prompt, "encadenada", full_conversation_log, preset_key)
+
+# --- 10. BUCLE DE EVENTOS PERSISTENTE ---
+# Un único bucle de larga duración por proceso (worker). Los clientes async de los proveedores
+# quedan ligados a este bucle, así que todas las llamadas deben ejecutarse en él.
+_event_loop = None
+_event_loop_pid = None
+_event_loop_lock = threading.Lock()
+
+def get_event_loop():
+    """Devuelve el bucle persistente del proceso, creándolo (en un hilo daemon) si hace falta."""
+    global _event_loop, _event_loop_pid
+    with _event_loop_lock:
+        # Tras un fork el hilo del bucle no existe en el hijo: se crea uno nuevo
+        if _event_loop is None or _event_loop.is_closed() or _event_loop_pid != os.getpid():
+            _event_loop = asyncio.new_event_loop()
+            _event_loop_pid = os.getpid()
+            threading.Thread(target=_event_loop.run_forever, name="ai-core-loop", daemon=True).start()
+            # Este proceso atiende tráfico: empieza a volcar sus métricas para los demás (ver metrics.py)
+            if metrics_registry.store:
+                metrics_registry.store.start()
+        return _event_loop
+
+def run_sync(coro, timeout=None):
+    """Ejecuta una corrutina en el bucle persistente y bloquea hasta su resultado (para código síncrono).
+    Si se agota 'timeout', la corrutina se cancela en el bucle (no sigue llamando a los proveedores)."""
+    future = asyncio.run_coroutine_threadsafe(coro, get_event_loop())
+    try:
+        return future.result(timeout)
+    except concurrent.futures.TimeoutError:
+        future.cancel()
+        raise
+
+async def run_in_core_loop(coro):
+    """Equivalente a run_sync para código que ya corre en otro bucle (p. ej. un servidor ASGI)."""
+    loop = get_event_loop()
+    if asyncio.get_running_loop() is loop:
+        return await coro
+    return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coro, loop))
+
+async def _anext(agen):
+    # run_coroutine_threadsafe exige una corrutina; __anext__() devuelve otro tipo de awaitable
+    return await agen.__anext__()
+
+async def _aclose(agen):
+    await agen.aclose()
+
+def iter_sync(agen):
+    """Recorre un generador asíncrono del bucle persistente desde código síncrono (p. ej. una respuesta Flask)."""
+    loop = get_event_loop()
+    try:
+        while True:
+            try:
+                item = asyncio.run_coroutine_threadsafe(_anext(agen), loop).result()
+            except StopAsyncIteration:
+                return
+            yield item
+    finally:
+        # Cierra el generador en su bucle: cancela las llamadas pendientes si el cliente se fue
+        asyncio.run_coroutine_threadsafe(_aclose(agen), loop).result()
+
+async def aiter_in_core_loop(agen):
+    """Equivalente a iter_sync para código que corre en otro bucle (p. ej. un servidor ASGI)."""
+    try:
+        while True:
+            try:
+                item = await run_in_core_loop(_anext(agen))
+            except StopAsyncIteration:
+                return
+            yield item
+    finally:
+        await run_in_core_loop(_aclose(agen))
+
+# --- 11. VARIOS PROCESOS (SERVIDORES CON FORK) ---
+# Con gunicorn y preload_app (ver gunicorn.conf.py) este módulo se importa una sola vez en el proceso
+# padre: la configuración y la compilación de los presets (WORKFLOW_GRAPHS) no se repiten en cada
+# worker. En el padre no se crea ningún cliente (gRPC no es seguro tras un fork) ni el bucle: los crea
+# cada worker en warm_up(), que es también donde se descubre el modelo si no está en el entorno ni en
+# la caché. Lo que no puede heredarse (bucle, conexiones SQLite, llamadas en vuelo, colas del
+# planificador ligadas al bucle) se descarta en el hijo justo después del fork, y warm_up() lo vuelve
+# a crear antes de que el worker reciba tráfico. La caché de respuestas en SQLite la comparten todos
+# los workers; las métricas, a través de METRICS_MULTIPROC_DIR (ver metrics.py), que cada worker
+# empieza a volcar al crear su bucle.
+def prepare_workers():
+    """Configuración única en el proceso padre, antes de crear los workers, sin clientes ni red.
+    Devuelve los proveedores con clave."""
+    count_tokens("warm-up")  # carga el tokenizador local (tiktoken), que los hijos heredan ya cargado
+    return prepare_providers()
+
+def _reset_after_fork():
+    global _event_loop, _event_loop_lock
+    # Un lock tomado por un hilo del padre quedaría tomado para siempre en el hijo
+    _event_loop = None
+    _event_loop_lock = threading.Lock()
+    response_cache._db = None
+    response_cache._disk_bytes = None
+    response_cache._lock = threading.Lock()
+    usage_tracker._lock = threading.Lock()
+    single_flight._flights = {}
+    _schedulers.clear()
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+def warm_up():
+    """Prepara el worker antes de recibir tráfico: arranca el bucle persistente, crea en él los clientes
+    de los proveedores (descubriendo el modelo si hace falta, y los modelos de las instrucciones de sistema de
+    los presets) y sus colas, y abre la caché de respuestas. No pide ninguna respuesta a los proveedores.
+    Devuelve los nombres de los proveedores listos."""
+    system_prompts = {}
+    for nodes in WORKFLOW_GRAPHS.values():
+        for node in nodes:
+            for name in [node["ia_name"], *node["fallback"]]:
+                system_prompts.setdefault(name, []).append(node["system_instruction"])
+
+    async def warm():
+        ready = []
+        for provider in PROVIDERS.values():
+            if await provider.warm_up(system_prompts.get(provider.name, ())):
+                get_scheduler(provider.name)
+                ready.append(provider.name)
+        return ready
+
+    ready = run_sync(warm())
+    if RESPONSE_CACHE_ENABLED:
+        try:
+            with response_cache._lock:
+                response_cache._connect()
+        except sqlite3.Error as e:
+            logger.warning("Caché de respuestas no disponible: %s", e)
+    return ready
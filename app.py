@@ -1,9 +1,23 @@
 # app.py
 
-from flask import Flask, render_template, request, jsonify
-import asyncio
+import os
+import json
+import uuid
+import logging
+import shutil
+from flask import Flask, Response, render_template, request, jsonify, send_file
 # Asegúrate de que ai_core.py está en la misma carpeta
-from ai_core import run_comparison_mode, run_chain_mode, WORKFLOW_PRESETS
+from ai_core import (
+    run_comparison_mode, run_chain_mode, run_race_mode, run_auto_mode, stream_comparison_mode, stream_chain_mode,
+    run_sync, iter_sync, make_deadline, response_cache, similarity_cache, single_flight, scheduler_stats, router,
+    usage_tracker,
+    WORKFLOW_PRESETS, REQUEST_TIMEOUT,
+)
+from metrics import registry as metrics_registry
+import batch
+from jobs import job_manager, QueueFullError
+from history import history_store, HistoryError
+from sessions import session_store, validate_session_id, SessionError
 
 app = Flask(__name__)
 
@@ -14,29 +28,332 @@ def index():
     return render_template('index.html', presets=WORKFLOW_PRESETS)
 
 
+# Un cuerpo que no es JSON (o no es un objeto) se rechaza con un 400 en JSON, no con la página de error de Flask
+JSON_BODY_ERROR = "El cuerpo de la solicitud debe ser un objeto JSON."
+
+
+# Lógica común de /api/query: la usan tanto la ruta Flask como el punto de entrada ASGI (asgi.py).
+# Devuelve (cuerpo, código HTTP). Con "cache": false se ignora la caché de respuestas.
+# En modo encadenado, "run_id" agrupa los checkpoints de los pasos: repetir la consulta con el mismo
+# run_id reanuda la cadena en el primer paso que falló (sin run_id no se guardan checkpoints).
+# Con "session_id" la consulta continúa una conversación: los proveedores reciben los turnos recientes.
+# "timeout" (segundos, por defecto REQUEST_TIMEOUT) es el plazo total: al agotarse se cancelan las
+# llamadas en vuelo y se devuelve lo que haya llegado, marcado con "_timed_out" / "timed_out".
+async def handle_query(data):
+    if not isinstance(data, dict):
+        return {"error": JSON_BODY_ERROR}, 400
+    prompt = data.get('prompt')
+    mode = data.get('mode')
+    use_cache = data.get('cache', True) is not False
+    session_id = data.get('session_id')
+
+    if not prompt or not mode:
+        return {"error": "Faltan 'prompt' o 'mode' en la solicitud."}, 400
+    if session_id is not None:
+        try:
+            validate_session_id(session_id)
+        except SessionError as e:
+            return {"error": str(e)}, 400
+    deadline, error = request_deadline(data)
+    if error:
+        return {"error": error}, 400
+
+    if mode == 'comparison':
+        results = await run_comparison_mode(prompt, use_cache=use_cache, session_id=session_id, deadline=deadline)
+
+    elif mode == 'chained':
+        preset_key = data.get('preset')
+        if not preset_key:
+            return {"error": "Falta 'preset' para el modo encadenado."}, 400
+        results = await run_chain_mode(prompt, preset_key, use_cache=use_cache, run_id=data.get('run_id'), session_id=session_id,
+                                       deadline=deadline)
+
+    elif mode == 'race':
+        # "strategy": "all" (todas a la vez) o "hedged" (petición de cobertura tras un umbral de latencia)
+        strategy = data.get('strategy', 'all')
+        if strategy not in ('all', 'hedged'):
+            return {"error": f"Estrategia no válida: {strategy}"}, 400
+        results = await run_race_mode(prompt, use_cache=use_cache, strategy=strategy, session_id=session_id, deadline=deadline)
+
+    elif mode == 'auto':
+        # Una sola llamada al proveedor sano más rápido según el enrutador (con reserva si falla)
+        results = await run_auto_mode(prompt, use_cache=use_cache, session_id=session_id, deadline=deadline)
+
+    else:
+        return {"error": f"Modo no válido: {mode}"}, 400
+
+    return results, 200
+
+
+def request_deadline(data):
+    """Plazo absoluto de la solicitud a partir de "timeout": (deadline o None, mensaje de error o None)."""
+    timeout = data.get('timeout', REQUEST_TIMEOUT)
+    if timeout is None:
+        return None, None
+    if isinstance(timeout, bool) or not isinstance(timeout, (int, float)) or timeout < 0:
+        return None, f"'timeout' no válido: {timeout}"
+    return make_deadline(timeout), None
+
+
 # Esta es nuestra nueva ruta de API. Solo se comunica con datos (JSON).
 @app.route('/api/query', methods=['POST'])
 def api_query():
-    data = request.get_json()
+    data = request.get_json(silent=True)
+    # run_sync() envía la corrutina al bucle persistente del worker en lugar de
+    # crear y destruir un bucle por petición con asyncio.run(). WSGI no avisa si el cliente se
+    # desconecta: aquí la consulta solo se corta por su plazo ("timeout"); asgi.py sí la cancela.
+    results, status = run_sync(handle_query(data))
+    return jsonify(results), status
+
+
+# Versión en streaming de /api/query. Devuelve (generador asíncrono de eventos, None)
+# o (None, (error, código HTTP)) si la solicitud no es válida.
+def open_stream(data):
+    if not isinstance(data, dict):
+        return None, ({"error": JSON_BODY_ERROR}, 400)
     prompt = data.get('prompt')
     mode = data.get('mode')
+    use_cache = data.get('cache', True) is not False
+    session_id = data.get('session_id')
 
     if not prompt or not mode:
-        return jsonify({"error": "Faltan 'prompt' o 'mode' en la solicitud."}), 400
+        return None, ({"error": "Faltan 'prompt' o 'mode' en la solicitud."}, 400)
+    if session_id is not None:
+        try:
+            validate_session_id(session_id)
+        except SessionError as e:
+            return None, ({"error": str(e)}, 400)
+    deadline, error = request_deadline(data)
+    if error:
+        return None, ({"error": error}, 400)
 
-    results = {}
     if mode == 'comparison':
-        # asyncio.run() ejecuta nuestra función asíncrona
-        results = asyncio.run(run_comparison_mode(prompt))
-    
-    elif mode == 'chained':
+        return stream_comparison_mode(prompt, use_cache=use_cache, session_id=session_id, deadline=deadline), None
+
+    if mode == 'chained':
         preset_key = data.get('preset')
         if not preset_key:
-            return jsonify({"error": "Falta 'preset' para el modo encadenado."}), 400
-        results = asyncio.run(run_chain_mode(prompt, preset_key))
+            return None, ({"error": "Falta 'preset' para el modo encadenado."}, 400)
+        return stream_chain_mode(prompt, preset_key, use_cache=use_cache, run_id=data.get('run_id'), session_id=session_id,
+                                 deadline=deadline), None
+
+    return None, ({"error": f"Modo no válido: {mode}"}, 400)
+
+
+def sse_event(event):
+    return f"data: {json.dumps(event, ensure_ascii=False)}\n\n"
+
+
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+
+# Server-Sent Events: reenvía los tokens de cada IA según llegan, etiquetados por proveedor y paso.
+# Se usa POST (el prompt puede ser largo), así que el navegador lee el flujo con fetch() en vez de EventSource.
+@app.route('/api/stream', methods=['POST'])
+def api_stream():
+    stream, error = open_stream(request.get_json(silent=True))
+    if error:
+        return jsonify(error[0]), error[1]
+
+    def generate():
+        for event in iter_sync(stream):
+            yield sse_event(event)
+        yield sse_event({"type": "end"})
+
+    return Response(generate(), mimetype='text/event-stream', headers=SSE_HEADERS)
+
+
+# Contadores de la caché de respuestas (aciertos en memoria/disco, fallos, expulsiones...)
+# y, en "similarity", los de la reutilización de preguntas casi idénticas; en "single_flight",
+# las llamadas idénticas en vuelo que se han agrupado
+@app.route('/api/cache/stats')
+def api_cache_stats():
+    return jsonify(dict(response_cache.stats(), similarity=similarity_cache.stats(), single_flight=single_flight.stats()))
+
+
+# Estado de las colas por proveedor: llamadas en vuelo, en espera, tiempo de espera, reintentos...
+@app.route('/api/scheduler/stats')
+def api_scheduler_stats():
+    return jsonify(scheduler_stats())
+
+
+# Salud de cada proveedor según el enrutador: latencia y tasa de errores (EWMA) por modelo,
+# estado del circuito y contadores de aperturas, rechazos y llamadas de prueba
+@app.route('/api/router/stats')
+def api_router_stats():
+    return jsonify(router.stats())
+
+
+# Uso acumulado de tokens según los proveedores (o estimado si no lo informan): por proveedor,
+# y por preset y paso de las cadenas (el presupuesto de cada paso es su "max_output_tokens" en ai_core)
+@app.route('/api/usage/stats')
+def api_usage_stats():
+    return jsonify(usage_tracker.stats())
+
+
+# Métricas en formato de texto de Prometheus: latencias por proveedor y por paso, tiempo hasta el
+# primer token, tokens, errores, caché y colas. Son del proceso salvo con METRICS_MULTIPROC_DIR
+# (gunicorn.conf.py), en cuyo caso se suman las de todos los workers.
+@app.route('/metrics')
+def metrics():
+    return Response(metrics_registry.render(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+
+# Trabajos en segundo plano: POST /api/jobs responde al instante con un id (mismo cuerpo que
+# /api/query) y GET /api/jobs/<id> devuelve el estado y los resultados de cada paso según terminan.
+@app.route('/api/jobs', methods=['POST'])
+def api_jobs_submit():
+    data = request.get_json(silent=True)
+    error = job_manager.validate(data)
+    if error:
+        return jsonify({"error": error}), 400
+    try:
+        job = job_manager.submit(data)
+    except QueueFullError as e:
+        return jsonify({"error": str(e)}), 503
+    return jsonify({"id": job.id, "status": job.status, "url": f"/api/jobs/{job.id}"}), 202
+
+
+@app.route('/api/jobs/<job_id>')
+def api_jobs_status(job_id):
+    job = job_manager.get(job_id)
+    if not job:
+        return jsonify({"error": "Trabajo no encontrado."}), 404
+    return jsonify(job.to_dict())
+
+
+@app.route('/api/jobs/<job_id>', methods=['DELETE'])
+def api_jobs_cancel(job_id):
+    job = job_manager.cancel(job_id)
+    if not job:
+        return jsonify({"error": "Trabajo no encontrado."}), 404
+    return jsonify({"id": job.id, "status": job.status}), 202
+
+
+@app.route('/api/jobs/stats')
+def api_jobs_stats():
+    return jsonify(job_manager.stats())
+
+
+# Sesiones: POST crea un id nuevo (también vale uno elegido por el cliente en "session_id"),
+# GET devuelve sus turnos y DELETE la olvida.
+@app.route('/api/sessions', methods=['POST'])
+def api_sessions_create():
+    return jsonify({"session_id": uuid.uuid4().hex}), 201
+
+
+@app.route('/api/sessions/stats')
+def api_sessions_stats():
+    return jsonify(session_store.stats())
+
+
+@app.route('/api/sessions/<session_id>')
+def api_sessions_get(session_id):
+    try:
+        session = session_store.get(session_id)
+    except SessionError as e:
+        return jsonify({"error": str(e)}), 400
+    if not session:
+        return jsonify({"error": "Sesión no encontrada."}), 404
+    return jsonify(session)
+
+
+@app.route('/api/sessions/<session_id>', methods=['DELETE'])
+def api_sessions_delete(session_id):
+    try:
+        found = session_store.delete(session_id)
+    except SessionError as e:
+        return jsonify({"error": str(e)}), 400
+    if not found:
+        return jsonify({"error": "Sesión no encontrada."}), 404
+    return '', 204
+
+
+# Historial: de la conversación más reciente a la más antigua, paginado por cursor.
+# Filtros (query string): q (texto), provider, mode, preset, since, until, limit, cursor.
+@app.route('/api/history')
+def api_history():
+    args = request.args
+    try:
+        page = history_store.search(
+            q=args.get('q'), provider=args.get('provider'), mode=args.get('mode'), preset=args.get('preset'),
+            since=args.get('since'), until=args.get('until'), cursor=args.get('cursor'),
+            limit=args.get('limit', type=int),
+        )
+    except HistoryError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify(page)
+
+
+@app.route('/api/history/<int:conversation_id>')
+def api_history_item(conversation_id):
+    record = history_store.get(conversation_id)
+    if not record:
+        return jsonify({"error": "Conversación no encontrada."}), 404
+    return jsonify(record)
+
+
+# Lotes: sube un JSONL (campo de formulario 'file' o el cuerpo tal cual) y se procesa en segundo plano.
+# Parámetros (query string o formulario): mode, preset, concurrency, prompt_field, cache.
+@app.route('/api/batch', methods=['POST'])
+def api_batch_submit():
+    options = request.values
+    mode = options.get('mode', 'comparison')
+    if mode not in batch.BATCH_MODES:
+        return jsonify({"error": f"Modo no válido: {mode}"}), 400
+    if mode == 'chained' and not options.get('preset'):
+        return jsonify({"error": "Falta 'preset' para el modo encadenado."}), 400
+    if options.get('preset') and options['preset'] not in WORKFLOW_PRESETS:
+        return jsonify({"error": "Preset no válido."}), 400
+    try:
+        concurrency = int(options.get('concurrency', batch.BATCH_CONCURRENCY))
+    except ValueError:
+        return jsonify({"error": f"'concurrency' no válido: {options.get('concurrency')}"}), 400
+    if concurrency < 1:
+        return jsonify({"error": f"'concurrency' no válido: {concurrency}"}), 400
+    # Un lote no puede saltarse el reparto del planificador pidiendo cientos de prompts a la vez
+    concurrency = min(concurrency, batch.BATCH_MAX_CONCURRENCY)
+
+    batch_id = batch.new_batch_id()
+    directory, input_path, _ = batch.batch_paths(batch_id)
+    os.makedirs(directory, exist_ok=True)
+    # Se copia a disco por bloques: el archivo nunca se carga entero en memoria
+    upload = request.files.get('file')
+    if upload:
+        upload.save(input_path)
+    else:
+        with open(input_path, 'wb') as f:
+            shutil.copyfileobj(request.stream, f)
+
+    batch.start_batch(
+        batch_id,
+        mode=mode,
+        preset=options.get('preset'),
+        concurrency=concurrency,
+        prompt_field=options.get('prompt_field', 'prompt'),
+        use_cache=options.get('cache', 'true').lower() != 'false',
+    )
+    return jsonify({"id": batch_id, "status": f"/api/batch/{batch_id}", "results": f"/api/batch/{batch_id}/results"}), 202
+
+
+@app.route('/api/batch/<batch_id>')
+def api_batch_status(batch_id):
+    runner = batch.get_batch(batch_id)
+    if not runner:
+        return jsonify({"error": "Lote no encontrado."}), 404
+    return jsonify({"id": batch_id, **runner.progress()})
+
 
-    return jsonify(results)
+# Resultados en JSONL (en orden de finalización); se pueden descargar mientras el lote avanza
+@app.route('/api/batch/<batch_id>/results')
+def api_batch_results(batch_id):
+    _, _, output_path = batch.batch_paths(batch_id)
+    if not batch.get_batch(batch_id) or not os.path.exists(output_path):
+        return jsonify({"error": "Lote no encontrado."}), 404
+    return send_file(os.path.abspath(output_path), mimetype='application/x-ndjson')
 
 
+# Servidor de desarrollo (un proceso). Para producción con varios workers: gunicorn -c gunicorn.conf.py app:app
 if __name__ == '__main__':
-    app.run(debug=True)
\ No newline at end of file
+    logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"), format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    app.run(debug=True)
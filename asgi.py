@@ -0,0 +1,106 @@
+# asgi.py
+# Punto de entrada ASGI: /api/query y /api/stream se atienden de forma nativa (sin bloquear
+# ningún hilo mientras esperan los proveedores) y el resto de rutas se delega en la app Flask.
+# Aquí, a diferencia de Flask, se detecta cuándo el cliente cierra la conexión: la consulta se
+# cancela y con ella las llamadas en vuelo a los proveedores.
+#
+# Uso:  uvicorn asgi:application --workers 4
+#       gunicorn -c gunicorn.conf.py -k uvicorn.workers.UvicornWorker asgi:application
+# (con gunicorn la preparación se hace una vez en el padre y cada worker se calienta antes del tráfico)
+
+import json
+import asyncio
+from asgiref.wsgi import WsgiToAsgi  # viene con: pip install "flask[async]"
+
+from ai_core import run_in_core_loop, aiter_in_core_loop
+from conversation_logger import conversation_logger
+from app import app, handle_query, open_stream, sse_event, SSE_HEADERS
+
+flask_asgi = WsgiToAsgi(app)
+
+
+async def _read_body(receive):
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            return body
+
+
+async def _send_json(send, payload, status=200):
+    body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+async def _send_sse(send, stream):
+    headers = [(b"content-type", b"text/event-stream")]
+    headers += [(k.lower().encode(), v.encode()) for k, v in SSE_HEADERS.items()]
+    await send({"type": "http.response.start", "status": 200, "headers": headers})
+    async for event in aiter_in_core_loop(stream):
+        await send({"type": "http.response.body", "body": sse_event(event).encode("utf-8"), "more_body": True})
+    await send({"type": "http.response.body", "body": sse_event({"type": "end"}).encode("utf-8")})
+
+
+async def _wait_disconnect(receive):
+    # Con el cuerpo ya leído, el siguiente mensaje solo llega cuando el cliente se desconecta
+    while (await receive())["type"] != "http.disconnect":
+        pass
+
+
+async def _until_disconnect(receive, coro):
+    """Ejecuta coro y la cancela si el cliente se desconecta antes de que termine.
+    Devuelve (resultado, False), o (None, True) si hubo desconexión."""
+    task = asyncio.ensure_future(coro)
+    watcher = asyncio.ensure_future(_wait_disconnect(receive))
+    try:
+        await asyncio.wait({task, watcher}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        watcher.cancel()
+        if not task.done():
+            # Cancelar aquí cancela también la corrutina en el bucle persistente de ai_core
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+    if task.cancelled():
+        return None, True
+    return task.result(), False
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            # Vuelca los registros de conversación pendientes antes de salir
+            conversation_logger.close()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def application(scope, receive, send):
+    if scope["type"] == "lifespan":
+        return await _lifespan(receive, send)
+    if scope["type"] == "http" and scope["method"] == "POST" and scope["path"] in ("/api/query", "/api/stream"):
+        try:
+            data = json.loads(await _read_body(receive) or b"{}")
+        except ValueError:
+            return await _send_json(send, {"error": "JSON inválido."}, 400)
+        # Las llamadas a los proveedores corren en el bucle persistente de ai_core,
+        # que es donde viven sus clientes async
+        if scope["path"] == "/api/stream":
+            stream, error = open_stream(data)
+            if error:
+                return await _send_json(send, *error)
+            await _until_disconnect(receive, _send_sse(send, stream))
+            return
+        result, disconnected = await _until_disconnect(receive, run_in_core_loop(handle_query(data)))
+        if disconnected:
+            return  # nadie espera ya la respuesta
+        return await _send_json(send, *result)
+    return await flask_asgi(scope, receive, send)
@@ -0,0 +1,308 @@
+# batch.py
+# Procesamiento por lotes de prompts en JSONL (uno por línea: {"prompt": "...", "id": ...}).
+# Cada prompt pasa por el modo comparación, un preset encadenado, el modo carrera o el automático con
+# concurrencia acotada, y el resultado se escribe en otro JSONL en orden de finalización.
+#
+# La memoria no depende del tamaño del archivo: la entrada se lee línea a línea y nunca hay más
+# de BATCH_WINDOW líneas leídas pero sin terminar. Un archivo de checkpoint (<salida>.checkpoint)
+# guarda el desplazamiento de la primera línea pendiente, así que tras una caída se reanuda
+# desde ahí (las líneas ya terminadas por encima de esa marca también se recuerdan y se saltan).
+# Los resultados y el checkpoint se escriben en un hilo propio del lote: un lote lanzado por
+# /api/batch corre en el bucle compartido de ai_core y no debe frenarlo con E/S bloqueante.
+#
+# Uso:
+#   python batch.py prompts.jsonl resultados.jsonl --mode comparison --concurrency 8
+#   python batch.py prompts.jsonl resultados.jsonl --mode chained --preset 2
+
+import os
+import sys
+import json
+import time
+import uuid
+import asyncio
+import logging
+import argparse
+import threading
+import concurrent.futures
+from collections import OrderedDict
+
+from ai_core import (
+    run_comparison_mode, run_chain_mode, run_race_mode, run_auto_mode, get_event_loop, make_deadline, WORKFLOW_PRESETS,
+)
+
+logger = logging.getLogger(__name__)
+
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", 8))
+BATCH_MAX_CONCURRENCY = int(os.getenv("BATCH_MAX_CONCURRENCY", 32))  # tope para lo que pida cada lote
+BATCH_WINDOW_FACTOR = 4  # líneas leídas por delante como máximo = concurrencia * este factor
+BATCH_CHECKPOINT_INTERVAL = float(os.getenv("BATCH_CHECKPOINT_INTERVAL", 1.0))  # segundos
+BATCH_DIR = os.getenv("BATCH_DIR", "batches")  # lotes subidos por /api/batch
+BATCH_TTL = int(os.getenv("BATCH_TTL", 24 * 3600))  # segundos que se recuerda un lote terminado
+BATCH_MAX = int(os.getenv("BATCH_MAX", 200))        # lotes recordados como máximo
+BATCH_MODES = ("comparison", "chained", "race", "auto")
+FINISHED = ("completado", "error", "cancelado")
+
+
+async def run_prompt(item, mode, preset, use_cache):
+    """Ejecuta un prompt del lote. Cada línea puede sobrescribir 'mode' y 'preset', y fijar su plazo en 'timeout' (segundos)."""
+    mode = item.get("mode", mode)
+    preset = item.get("preset", preset)
+    # Una línea con modo o preset no válidos cuenta como error, no como resultado
+    if mode not in BATCH_MODES:
+        raise ValueError(f"Modo no válido: {mode}")
+    if mode == "chained" and preset not in WORKFLOW_PRESETS:
+        raise ValueError(f"Preset no válido: {preset}" if preset else "Falta 'preset' para el modo encadenado.")
+    deadline = make_deadline(item.get("timeout"))
+    if mode == "comparison":
+        return await run_comparison_mode(item["prompt"], use_cache=use_cache, deadline=deadline)
+    if mode == "chained":
+        return await run_chain_mode(item["prompt"], preset, use_cache=use_cache, deadline=deadline)
+    if mode == "race":
+        return await run_race_mode(item["prompt"], use_cache=use_cache, strategy=item.get("strategy", "all"), deadline=deadline)
+    return await run_auto_mode(item["prompt"], use_cache=use_cache, deadline=deadline)
+
+
+class BatchRunner:
+    def __init__(self, input_path, output_path, mode="comparison", preset=None,
+                 concurrency=BATCH_CONCURRENCY, prompt_field="prompt", use_cache=True, resume=True):
+        self.input_path = input_path
+        self.output_path = output_path
+        self.checkpoint_path = f"{output_path}.checkpoint"
+        self.mode = mode
+        self.preset = preset
+        self.concurrency = max(1, min(concurrency, BATCH_MAX_CONCURRENCY))
+        self.window = self.concurrency * BATCH_WINDOW_FACTOR
+        self.prompt_field = prompt_field
+        self.use_cache = use_cache
+        self.resume = resume
+        # Progreso (lo consulta /api/batch/<id>)
+        self.status = "pendiente"
+        self.processed = 0
+        self.failed = 0
+        self.skipped = 0
+        self.started_at = None
+        self.finished_at = None
+        self.error = None
+        # Marca de agua: todas las líneas anteriores a self._line están terminadas
+        self._line = 0
+        self._offset = 0
+        self._done_above = set()   # líneas terminadas por encima de la marca (acotado por la ventana)
+        self._offsets = {}         # línea -> desplazamiento en bytes de su final, solo dentro de la ventana
+        self._checkpoint_saved_at = 0.0
+        self._io = None  # hilo que escribe resultados y checkpoints, en orden de llegada
+
+    def _load_checkpoint(self):
+        if not self.resume:
+            return
+        try:
+            with open(self.checkpoint_path, encoding="utf-8") as f:
+                checkpoint = json.load(f)
+        except (OSError, ValueError):
+            return
+        self._line = checkpoint["line"]
+        self._offset = checkpoint["offset"]
+        self._done_above = set(checkpoint.get("done", []))
+        logger.info("Reanudando el lote %s desde la línea %d.", self.output_path, self._line + 1)
+
+    def _checkpoint_state(self, force=True):
+        """Lo que se guarda en el checkpoint, o None si el último se guardó hace menos de BATCH_CHECKPOINT_INTERVAL."""
+        now = time.monotonic()
+        if not force and now - self._checkpoint_saved_at < BATCH_CHECKPOINT_INTERVAL:
+            return None
+        self._checkpoint_saved_at = now
+        return {"line": self._line, "offset": self._offset, "done": sorted(self._done_above)}
+
+    def _write_checkpoint(self, state):
+        tmp_path = f"{self.checkpoint_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.checkpoint_path)
+
+    @staticmethod
+    def _write_result(out, line):
+        out.write(line)
+        out.flush()
+
+    def _in_io_thread(self, fn, *args):
+        # La escritura se encarga al momento (el orden es el de las llamadas) y se espera fuera del bucle
+        return asyncio.get_running_loop().run_in_executor(self._io, fn, *args)
+
+    def _mark_done(self, line_no):
+        self._done_above.add(line_no)
+        while self._line in self._done_above:
+            self._done_above.remove(self._line)
+            self._offset = self._offsets.pop(self._line, self._offset)
+            self._line += 1
+
+    def progress(self):
+        return {
+            "status": self.status,
+            "processed": self.processed,
+            "failed": self.failed,
+            "skipped": self.skipped,
+            "in_flight_window": len(self._offsets),
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "error": self.error,
+        }
+
+    async def run(self):
+        self.status = "en curso"
+        self.started_at = time.time()
+        self._load_checkpoint()
+        self._io = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="batch-io")
+        queue = asyncio.Queue(maxsize=self.concurrency)
+        window_freed = asyncio.Condition()
+
+        async def worker(out):
+            while True:
+                entry = await queue.get()
+                if entry is None:
+                    return
+                line_no, item = entry
+                start = time.perf_counter()
+                record = {"line": line_no + 1, "id": item.get("id"), "prompt": item.get("prompt")}
+                try:
+                    record["result"] = await run_prompt(item, self.mode, self.preset, self.use_cache)
+                    record["status"] = "ok"
+                    self.processed += 1
+                except Exception as e:
+                    record["status"] = "error"
+                    record["error"] = str(e)
+                    self.failed += 1
+                record["latency_ms"] = round((time.perf_counter() - start) * 1000, 1)
+                # Primero el resultado, después el checkpoint (como mucho uno por segundo): si se cae
+                # entre ambos, esas líneas se repetirían al reanudar (al menos una vez), nunca se perderían
+                await self._in_io_thread(self._write_result, out, json.dumps(record, ensure_ascii=False) + "\n")
+                saved = None
+                async with window_freed:
+                    self._mark_done(line_no)
+                    state = self._checkpoint_state(force=False)
+                    if state:
+                        saved = self._in_io_thread(self._write_checkpoint, state)
+                    window_freed.notify_all()
+                if saved:
+                    await saved
+
+        try:
+            with open(self.input_path, "rb") as src, open(self.output_path, "a", encoding="utf-8") as out:
+                workers = [asyncio.create_task(worker(out)) for _ in range(self.concurrency)]
+                try:
+                    src.seek(self._offset)
+                    line_no = self._line
+                    while True:
+                        raw = src.readline()
+                        if not raw:
+                            break
+                        current, line_no = line_no, line_no + 1
+                        self._offsets[current] = src.tell()
+                        if current in self._done_above:
+                            continue  # ya terminada antes de la caída
+                        try:
+                            item = json.loads(raw)
+                            if self.prompt_field != "prompt":
+                                item["prompt"] = item.get(self.prompt_field)
+                            if not item.get("prompt"):
+                                raise ValueError("línea sin prompt")
+                        except (ValueError, AttributeError):
+                            self.skipped += 1
+                            async with window_freed:
+                                self._mark_done(current)
+                            continue
+                        # No leemos más allá de la ventana: la memoria queda acotada aunque una línea se atasque
+                        async with window_freed:
+                            await window_freed.wait_for(lambda: current - self._line < self.window)
+                        await queue.put((current, item))
+                    for _ in workers:
+                        await queue.put(None)
+                    await asyncio.gather(*workers)
+                finally:
+                    # Si nos cancelan (Ctrl+C, apagado), lo terminado queda registrado en el checkpoint
+                    for task in workers:
+                        task.cancel()
+                    # Va detrás de las escrituras de resultados ya encargadas
+                    await self._in_io_thread(self._write_checkpoint, self._checkpoint_state())
+            self.status = "completado"
+        except asyncio.CancelledError:
+            self.status = "cancelado"
+            raise
+        except Exception as e:
+            self.status = "error"
+            self.error = str(e)
+            raise
+        finally:
+            self._io.shutdown(wait=False)
+            self.finished_at = time.time()
+        return self.progress()
+
+
+# --- Lotes subidos por la API (/api/batch) ---
+# Cada lote vive en BATCH_DIR/<id>/ (input.jsonl, output.jsonl y su checkpoint) y se ejecuta en
+# el bucle persistente de ai_core, sin bloquear el hilo de la petición. Los lotes terminados hace
+# más de BATCH_TTL segundos (o los más antiguos, si hay más de BATCH_MAX) se olvidan; sus archivos
+# siguen en disco, pero /api/batch/<id> ya no los encuentra.
+_batches = OrderedDict()
+_batches_lock = threading.Lock()
+
+def new_batch_id():
+    return uuid.uuid4().hex[:12]
+
+def batch_paths(batch_id):
+    directory = os.path.join(BATCH_DIR, batch_id)
+    return directory, os.path.join(directory, "input.jsonl"), os.path.join(directory, "output.jsonl")
+
+def start_batch(batch_id, **options):
+    """Lanza en segundo plano el lote cuyo input.jsonl ya está en disco."""
+    _, input_path, output_path = batch_paths(batch_id)
+    runner = BatchRunner(input_path, output_path, **options)
+    with _batches_lock:
+        _evict_batches()
+        _batches[batch_id] = runner
+    asyncio.run_coroutine_threadsafe(runner.run(), get_event_loop())
+    return runner
+
+def get_batch(batch_id):
+    with _batches_lock:
+        return _batches.get(batch_id)
+
+def _evict_batches():
+    # Como jobs.py: los lotes pendientes o en curso nunca se expulsan
+    now = time.time()
+    for batch_id, runner in list(_batches.items()):
+        if runner.status in FINISHED and now - (runner.finished_at or now) > BATCH_TTL:
+            del _batches[batch_id]
+    excess = len(_batches) - BATCH_MAX
+    for batch_id, runner in list(_batches.items()):
+        if excess <= 0:
+            break
+        if runner.status in FINISHED:
+            del _batches[batch_id]
+            excess -= 1
+
+
+def main():
+    logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"), format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    parser = argparse.ArgumentParser(description="Ejecuta un lote de prompts JSONL contra las IAs configuradas.")
+    parser.add_argument("input", help="Archivo JSONL de entrada (un objeto con 'prompt' por línea)")
+    parser.add_argument("output", help="Archivo JSONL de salida (se añade al final)")
+    parser.add_argument("--mode", choices=BATCH_MODES, default="comparison")
+    parser.add_argument("--preset", help="Preset para el modo encadenado")
+    parser.add_argument("--concurrency", type=int, default=BATCH_CONCURRENCY)
+    parser.add_argument("--prompt-field", default="prompt", help="Campo de cada línea que contiene el prompt")
+    parser.add_argument("--no-cache", action="store_true", help="No usar la caché de respuestas")
+    parser.add_argument("--restart", action="store_true", help="Ignora el checkpoint y empieza desde el principio")
+    args = parser.parse_args()
+
+    if args.mode == "chained" and not args.preset:
+        parser.error("--preset es obligatorio en modo encadenado")
+
+    runner = BatchRunner(args.input, args.output, mode=args.mode, preset=args.preset,
+                         concurrency=args.concurrency, prompt_field=args.prompt_field,
+                         use_cache=not args.no_cache, resume=not args.restart)
+    progress = asyncio.run(runner.run())
+    print(f"Lote terminado: {progress['processed']} correctos, {progress['failed']} con error, {progress['skipped']} saltados.")
+    sys.exit(1 if progress["failed"] else 0)
+
+
+if __name__ == "__main__":
+    main()
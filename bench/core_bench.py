@@ -0,0 +1,265 @@
+# bench/core_bench.py
+# Microbenchmarks de ai_core con proveedores falsos (bench/fake_providers.py): mide lo que añade el
+# propio proyecto (planificador, montaje de prompts, log, bucle persistente, Flask...) sin depender
+# de la red ni de la variabilidad de las APIs reales.
+#
+# Cada escenario se ejecuta a varios niveles de concurrencia y se informa de rendimiento
+# (peticiones/s), latencia p50/p95/p99 y memoria (RSS máximo; con --tracemalloc, el pico de Python).
+# Con --latency 0 --jitter 0 lo que queda es exactamente la sobrecarga del proyecto.
+#
+# Uso:
+#   python bench/core_bench.py                                   # comparación y cadena, 1/8/32
+#   python bench/core_bench.py --scenario chain --preset 4 --concurrency 1,16,64
+#   python bench/core_bench.py --via app                         # a través de Flask (/api/query)
+#   python bench/core_bench.py --output bench_results.json       # guarda el resultado en JSON
+#   python bench/core_bench.py --compare bench_results.json      # compara con una ejecución anterior
+
+import os
+import sys
+import json
+import math
+import time
+import asyncio
+import argparse
+import platform
+import resource
+import tempfile
+import threading
+import subprocess
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+# El log y la caché del benchmark van a un directorio temporal, nunca a los archivos del proyecto
+_workdir = tempfile.mkdtemp(prefix="ai_bench_")
+os.environ.setdefault("CONVERSATION_LOG_PATH", os.path.join(_workdir, "conversation_log.jsonl"))
+os.environ.setdefault("RESPONSE_CACHE_PATH", os.path.join(_workdir, "response_cache.sqlite3"))
+os.environ.setdefault("HISTORY_PATH", os.path.join(_workdir, "history.sqlite3"))
+os.environ.setdefault("CHAIN_CHECKPOINT_PATH", os.path.join(_workdir, "chain_checkpoints.sqlite3"))
+
+import ai_core  # noqa: E402
+from fake_providers import install  # noqa: E402
+
+SCENARIOS = ("comparison", "chain", "stream-comparison", "stream-chain")
+DEFAULT_PROMPT = "¿Cómo organizo un presupuesto mensual para un equipo pequeño?"
+
+
+def percentile(sorted_values, q):
+    """Percentil por rango más cercano (sorted_values ya ordenada)."""
+    if not sorted_values:
+        return None
+    index = max(0, min(len(sorted_values) - 1, math.ceil(q * len(sorted_values)) - 1))
+    return round(sorted_values[index], 2)
+
+
+def rss_max_mb():
+    # ru_maxrss está en KB en Linux y en bytes en macOS
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(usage / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+# --- Escenarios llamando directamente a ai_core (en su bucle persistente) ---
+async def _consume(stream):
+    async for _ in stream:
+        pass
+
+def core_call(scenario, args):
+    use_cache = args.cache
+    if scenario == "comparison":
+        return ai_core.run_comparison_mode(args.prompt, use_cache=use_cache)
+    if scenario == "chain":
+        return ai_core.run_chain_mode(args.prompt, args.preset, use_cache=use_cache)
+    if scenario == "stream-comparison":
+        return _consume(ai_core.stream_comparison_mode(args.prompt, use_cache=use_cache))
+    return _consume(ai_core.stream_chain_mode(args.prompt, args.preset, use_cache=use_cache))
+
+async def run_core_level(scenario, concurrency, requests, args):
+    latencies = []
+    remaining = iter(range(requests))
+
+    async def worker():
+        for _ in remaining:
+            start = time.perf_counter()
+            await core_call(scenario, args)
+            latencies.append((time.perf_counter() - start) * 1000)
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return latencies
+
+
+# --- Escenarios a través de la app Flask (hilos como los de un servidor WSGI) ---
+def run_app_level(scenario, concurrency, requests, args):
+    from app import app
+    client_local = threading.local()
+    route = "/api/stream" if scenario.startswith("stream-") else "/api/query"
+    body = {"prompt": args.prompt, "mode": "chained" if scenario.endswith("chain") else "comparison",
+            "preset": args.preset, "cache": args.cache}
+
+    def one(_):
+        client = getattr(client_local, "client", None)
+        if client is None:
+            client = client_local.client = app.test_client()
+        start = time.perf_counter()
+        response = client.post(route, json=body)
+        response.get_data()  # en streaming, consume el flujo completo
+        return (time.perf_counter() - start) * 1000
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        return list(pool.map(one, range(requests)))
+
+
+def run_level(scenario, concurrency, args, providers):
+    requests = max(args.requests, concurrency)
+    ai_core._schedulers.clear()  # contadores del planificador limpios para cada nivel
+    prefix_before = [p.prefix_stats() for p in providers]
+    calls_before = sum(p.calls for p in providers)
+    errors_before = sum(p.errors for p in providers)
+    if args.tracemalloc:
+        tracemalloc.start()
+
+    start = time.perf_counter()
+    if args.via == "app":
+        latencies = run_app_level(scenario, concurrency, requests, args)
+    else:
+        latencies = ai_core.run_sync(run_core_level(scenario, concurrency, requests, args))
+    duration = time.perf_counter() - start
+
+    traced_peak = None
+    if args.tracemalloc:
+        traced_peak = round(tracemalloc.get_traced_memory()[1] / (1024 * 1024), 2)
+        tracemalloc.stop()
+    latencies.sort()
+    scheduler = ai_core.scheduler_stats()
+    return {
+        "scenario": scenario,
+        "via": args.via,
+        "concurrency": concurrency,
+        "requests": requests,
+        "duration_s": round(duration, 3),
+        "throughput_rps": round(requests / duration, 2),
+        "latency_ms": {
+            "p50": percentile(latencies, 0.50),
+            "p95": percentile(latencies, 0.95),
+            "p99": percentile(latencies, 0.99),
+            "mean": round(sum(latencies) / len(latencies), 2),
+            "max": round(latencies[-1], 2),
+        },
+        "memory_mb": {"rss_max": rss_max_mb(), "tracemalloc_peak": traced_peak},
+        "provider_calls": sum(p.calls for p in providers) - calls_before,
+        "injected_errors": sum(p.errors for p in providers) - errors_before,
+        "retries": sum(s["retries"] for s in scheduler.values()),
+        "failures": sum(s["failures"] for s in scheduler.values()),
+        "scheduler_wait_ms_max": max((s["wait_ms_max"] for s in scheduler.values()), default=0.0),
+        "prefix_reuse_ratio": prefix_reuse(prefix_before, [p.prefix_stats() for p in providers]),
+    }
+
+
+def prefix_reuse(before, after):
+    """Fracción del prompt enviado en este nivel que ya estaba en la caché de prefijos simulada."""
+    total = sum(a["chars_total"] - b["chars_total"] for a, b in zip(after, before))
+    reused = sum(a["chars_reused"] - b["chars_reused"] for a, b in zip(after, before))
+    return round(reused / total, 3) if total else 0.0
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_ROOT,
+                              capture_output=True, text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def compare(previous, current):
+    """Imprime la variación de p50/p95/rendimiento frente a una ejecución anterior."""
+    old = {(r["scenario"], r["via"], r["concurrency"]): r for r in previous["results"]}
+    print(f"\nComparación con {previous['meta'].get('commit') or 'la ejecución anterior'}:")
+    for r in current["results"]:
+        before = old.get((r["scenario"], r["via"], r["concurrency"]))
+        if not before:
+            continue
+        def delta(new, prev):
+            return f"{(new - prev) / prev * 100:+.1f}%" if prev else "n/a"
+        print(f"  {r['scenario']:<18} c={r['concurrency']:<4} "
+              f"p50 {delta(r['latency_ms']['p50'], before['latency_ms']['p50']):>8}  "
+              f"p95 {delta(r['latency_ms']['p95'], before['latency_ms']['p95']):>8}  "
+              f"rps {delta(r['throughput_rps'], before['throughput_rps']):>8}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Microbenchmarks de ai_core con proveedores falsos.")
+    parser.add_argument("--scenario", action="append", choices=SCENARIOS, help="Escenario a medir (repetible)")
+    parser.add_argument("--concurrency", default="1,8,32", help="Niveles de concurrencia separados por comas")
+    parser.add_argument("--requests", type=int, default=200, help="Peticiones por nivel (al menos una por cliente)")
+    parser.add_argument("--via", choices=["core", "app"], default="core", help="Llamar a ai_core directamente o a través de Flask")
+    parser.add_argument("--preset", default="1", help="Preset para los escenarios encadenados")
+    parser.add_argument("--prompt", default=DEFAULT_PROMPT)
+    parser.add_argument("--providers", default="gemini,openai", help="Proveedores falsos a registrar")
+    parser.add_argument("--latency", type=float, default=0.05, help="Latencia simulada hasta el primer fragmento (s)")
+    parser.add_argument("--jitter", type=float, default=0.01, help="Variación aleatoria de la latencia (s)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Probabilidad de error 503 por llamada")
+    parser.add_argument("--output-tokens", type=int, default=200, help="Palabras por respuesta")
+    parser.add_argument("--chunk-size", type=int, default=8, help="Palabras por fragmento en streaming")
+    parser.add_argument("--chunk-interval", type=float, default=0.0, help="Segundos entre fragmentos")
+    parser.add_argument("--prefill-ms", type=float, default=0.0, help="ms por cada 1000 caracteres de prompt no cacheados")
+    parser.add_argument("--max-in-flight", type=int, help="Límite de llamadas en vuelo por proveedor")
+    parser.add_argument("--backoff-base", type=float, default=0.01, help="Base del backoff entre reintentos (s)")
+    parser.add_argument("--cache", action="store_true", help="Usar la caché de respuestas (por defecto se omite)")
+    parser.add_argument("--single-flight", action="store_true",
+                        help="Agrupar llamadas idénticas en vuelo (por defecto no: todas las peticiones usan el mismo prompt)")
+    parser.add_argument("--tracemalloc", action="store_true", help="Mide el pico de memoria de Python (más lento)")
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--output", help="Guarda el resultado en este archivo JSON")
+    parser.add_argument("--compare", help="JSON de una ejecución anterior con el que comparar")
+    parser.add_argument("--json", action="store_true", help="Imprime el resultado en JSON")
+    args = parser.parse_args()
+
+    names = [n.strip() for n in args.providers.split(",") if n.strip()]
+    if args.max_in_flight:
+        for name in names:
+            os.environ[f"{name.upper()}_MAX_IN_FLIGHT"] = str(args.max_in_flight)
+    ai_core.PROVIDER_BACKOFF_BASE = args.backoff_base
+    ai_core.SINGLE_FLIGHT_ENABLED = args.single_flight
+    providers = install(names, latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+                        output_tokens=args.output_tokens, chunk_size=args.chunk_size,
+                        chunk_interval=args.chunk_interval, prefill_ms_per_1k=args.prefill_ms, seed=args.seed)
+    levels = [int(c) for c in args.concurrency.split(",") if c.strip()]
+    scenarios = args.scenario or ["comparison", "chain"]
+
+    # Calentamiento: crea el bucle persistente, los planificadores y las importaciones perezosas
+    ai_core.run_sync(core_call(scenarios[0], args))
+
+    results = []
+    for scenario in scenarios:
+        for concurrency in levels:
+            results.append(run_level(scenario, concurrency, args, providers))
+            if not args.json:
+                r = results[-1]
+                print(f"{scenario:<18} {args.via:<4} c={concurrency:<4} {r['throughput_rps']:>8.1f} rps  "
+                      f"p50 {r['latency_ms']['p50']:>8.1f} ms  p95 {r['latency_ms']['p95']:>8.1f} ms  "
+                      f"p99 {r['latency_ms']['p99']:>8.1f} ms  rss {r['memory_mb']['rss_max']:>6.1f} MB  "
+                      f"prefijo {r['prefix_reuse_ratio']:.0%}")
+
+    report = {
+        "meta": {
+            "commit": git_commit(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "params": {k: v for k, v in vars(args).items() if k not in ("output", "compare", "json")},
+        },
+        "results": results,
+    }
+    if args.json:
+        print(json.dumps(report, indent=2, ensure_ascii=False))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            compare(json.load(f), report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+# bench/fake_providers.py
+# Proveedores falsos para los benchmarks: implementan la misma interfaz que los adaptadores reales
+# (providers.ProviderAdapter) pero no tocan la red. Cada llamada espera una latencia configurable
+# (con jitter), falla con una probabilidad dada (HTTP 503, que el planificador reintenta como
+# un error real) y en streaming entrega la respuesta en fragmentos de un tamaño fijo. Respeta
+# max_tokens (una "palabra" por token) e informa del uso como los adaptadores reales.
+#
+# También simula la caché de prefijos de los proveedores: instrucción de sistema + prompt se
+# trocean en bloques y solo los bloques iniciales ya vistos cuentan como reutilizados, igual que
+# en las cachés reales (basta un byte distinto para que el resto del prompt deje de coincidir).
+# Con prefill_ms_per_1k > 0 el texto no reutilizado añade latencia, y prefix_stats() informa
+# de cuánto prefijo se ha reutilizado.
+#
+# Uso:
+#   from bench.fake_providers import install
+#   install(latency=0.05, jitter=0.01, error_rate=0.02, chunk_size=8)
+
+import asyncio
+import hashlib
+import random
+from collections import OrderedDict
+
+from providers import PROVIDERS, ProviderAdapter, register_provider, fill_usage
+
+
+class FakeProviderError(Exception):
+    """Error simulado con el mismo aspecto que los de los SDK (status_code)."""
+
+    def __init__(self, status_code=503):
+        super().__init__(f"Error simulado {status_code}")
+        self.status_code = status_code
+
+
+class PrefixRecorder:
+    """Bloques de prefijo ya vistos (LRU acotado), como la caché de prefijos de un proveedor."""
+
+    def __init__(self, block_chars=256, max_blocks=100000):
+        self.block_chars = block_chars
+        self.max_blocks = max_blocks
+        self._blocks = OrderedDict()
+        self.requests = 0
+        self.chars_total = 0
+        self.chars_reused = 0
+
+    def record(self, system_prompt, prompt):
+        """Registra una petición y devuelve cuántos caracteres de su prefijo ya estaban en caché."""
+        text = f"{system_prompt or ''}\x00{prompt}".encode("utf-8")
+        digest = hashlib.sha1()
+        reused = 0
+        matching = True
+        for end in range(self.block_chars, len(text) + 1, self.block_chars):
+            digest.update(text[end - self.block_chars:end])
+            key = digest.hexdigest()
+            if matching and key in self._blocks:
+                reused = end
+                self._blocks.move_to_end(key)
+            else:
+                matching = False
+                self._blocks[key] = True
+        while len(self._blocks) > self.max_blocks:
+            self._blocks.popitem(last=False)
+        self.requests += 1
+        self.chars_total += len(text)
+        self.chars_reused += reused
+        return reused, len(text)
+
+    def stats(self):
+        return {
+            "requests": self.requests,
+            "chars_total": self.chars_total,
+            "chars_reused": self.chars_reused,
+            "reuse_ratio": round(self.chars_reused / self.chars_total, 3) if self.chars_total else 0.0,
+        }
+
+
+class FakeProviderAdapter(ProviderAdapter):
+    def __init__(self, name, label, latency=0.05, jitter=0.0, error_rate=0.0, output_tokens=200,
+                 chunk_size=8, chunk_interval=0.0, prefill_ms_per_1k=0.0, seed=None):
+        self.name = name
+        self.label = label
+        self.short_name = label
+        super().__init__()
+        self.model = f"fake-{name}"
+        self.latency = latency                # segundos hasta el primer fragmento
+        self.jitter = jitter                  # +- segundos aleatorios sobre la latencia
+        self.error_rate = error_rate          # probabilidad de fallar cada llamada
+        self.output_tokens = output_tokens    # "palabras" de cada respuesta
+        self.chunk_size = max(1, chunk_size)  # palabras por fragmento en streaming
+        self.chunk_interval = chunk_interval  # segundos entre fragmentos
+        self.prefill_ms_per_1k = prefill_ms_per_1k  # ms por cada 1000 caracteres de prompt no cacheados
+        self.prefixes = PrefixRecorder()
+        self._random = random.Random(seed)
+        self.calls = 0
+        self.errors = 0
+        # Sin SDK que configurar: el propio adaptador hace de cliente
+        self._client = self
+        self._configured = True
+
+    @property
+    def has_key(self):
+        return True
+
+    def reset_client(self):
+        pass  # el propio adaptador es el cliente: tras un fork no hay conexiones que recrear
+
+    def _response_words(self, prompt, max_tokens=None):
+        return [f"{self.name}{i}" for i in range(min(self.output_tokens, max_tokens or self.output_tokens))]
+
+    def prefix_stats(self):
+        return self.prefixes.stats()
+
+    async def _first_byte(self, prompt, system_prompt):
+        """Espera la latencia simulada y devuelve cuántos caracteres del prefijo estaban en caché."""
+        self.calls += 1
+        reused, total = self.prefixes.record(system_prompt, prompt)
+        prefill = (total - reused) / 1000 * self.prefill_ms_per_1k / 1000
+        await asyncio.sleep(max(0.0, self.latency + prefill + self._random.uniform(-self.jitter, self.jitter)))
+        if self._random.random() < self.error_rate:
+            self.errors += 1
+            raise FakeProviderError()
+        return reused
+
+    @staticmethod
+    def _fill_usage(usage, prompt, system_prompt, words, reused):
+        # ~4 caracteres por token, como la estimación del planificador
+        fill_usage(usage, (len(prompt) + len(system_prompt or "")) // 4 + 1, len(words), reused // 4)
+
+    async def complete(self, prompt, system_prompt=None, max_tokens=None, usage=None):
+        reused = await self._first_byte(prompt, system_prompt)
+        words = self._response_words(prompt, max_tokens)
+        chunks = (len(words) + self.chunk_size - 1) // self.chunk_size
+        if self.chunk_interval:
+            await asyncio.sleep(self.chunk_interval * max(0, chunks - 1))
+        self._fill_usage(usage, prompt, system_prompt, words, reused)
+        return " ".join(words)
+
+    async def stream(self, prompt, system_prompt=None, max_tokens=None, usage=None):
+        reused = await self._first_byte(prompt, system_prompt)
+        words = self._response_words(prompt, max_tokens)
+        for i in range(0, len(words), self.chunk_size):
+            if i and self.chunk_interval:
+                await asyncio.sleep(self.chunk_interval)
+            yield " ".join(words[i:i + self.chunk_size]) + " "
+        self._fill_usage(usage, prompt, system_prompt, words, reused)
+
+
+FAKE_PROVIDERS = {"gemini": "Gemini (falso)", "openai": "OpenAI (falso)", "claude": "Claude (falso)", "deepseek": "DeepSeek (falso)"}
+
+def install(names=("gemini", "openai"), **options):
+    """Sustituye el registro de proveedores por adaptadores falsos. Devuelve la lista instalada."""
+    PROVIDERS.clear()
+    installed = []
+    for i, name in enumerate(names):
+        seed = None if options.get("seed") is None else options["seed"] + i
+        installed.append(register_provider(FakeProviderAdapter(name, FAKE_PROVIDERS.get(name, name), **dict(options, seed=seed))))
+    return installed
@@ -0,0 +1,83 @@
+# bench/import_time.py
+# Informe de tiempo de importación de los módulos de entrada (ai_core, main, app).
+# Cada medición se hace en un proceso nuevo con "python -X importtime", para que
+# ninguna caché de módulos del propio script falsee el resultado.
+#
+# Uso:
+#   python bench/import_time.py                      # mide el árbol actual
+#   python bench/import_time.py --repo /ruta/a/otro  # mide otra copia (p. ej. una versión anterior)
+#   python bench/import_time.py --json               # salida legible por máquina
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_MODULES = ["ai_core", "main", "app"]
+# Paquetes cuyo coste interesa ver por separado
+WATCHED_PACKAGES = ["google.generativeai", "openai", "flask"]
+
+
+def measure_once(module, repo, timeout):
+    start = time.perf_counter()
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=repo, capture_output=True, text=True, timeout=timeout,
+    )
+    wall = time.perf_counter() - start
+    # Formato de -X importtime: "import time: self [us] | cumulative | imported package"
+    cumulative = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        parts = [p.strip() for p in line[len("import time:"):].split("|")]
+        if len(parts) == 3 and parts[1].isdigit():
+            cumulative[parts[2].strip()] = int(parts[1])
+    return {
+        "wall_s": wall,
+        "ok": proc.returncode == 0,
+        "packages_ms": {pkg: cumulative[pkg] / 1000 for pkg in WATCHED_PACKAGES if pkg in cumulative},
+    }
+
+
+def measure(module, repo, runs, timeout):
+    samples = [measure_once(module, repo, timeout) for _ in range(runs)]
+    walls = [s["wall_s"] for s in samples]
+    return {
+        "module": module,
+        "runs": runs,
+        "ok": all(s["ok"] for s in samples),
+        "wall_median_s": statistics.median(walls),
+        "wall_min_s": min(walls),
+        "packages_imported": sorted({pkg for s in samples for pkg in s["packages_ms"]}),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mide el tiempo de importación de los módulos de entrada.")
+    parser.add_argument("--repo", default=REPO_ROOT, help="Directorio con los módulos a medir")
+    parser.add_argument("--module", action="append", help="Módulo a medir (repetible)")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--timeout", type=float, default=300, help="Límite por importación, en segundos")
+    parser.add_argument("--json", action="store_true", help="Imprime el resultado en JSON")
+    args = parser.parse_args()
+
+    results = [measure(m, args.repo, args.runs, args.timeout) for m in (args.module or DEFAULT_MODULES)]
+    if args.json:
+        print(json.dumps({"repo": args.repo, "results": results}, indent=2))
+        return
+
+    print(f"Tiempo de importación ({args.runs} ejecuciones por módulo) en {args.repo}")
+    print(f"{'módulo':<10} {'mediana':>10} {'mínimo':>10}  SDK importados al cargar")
+    for r in results:
+        estado = "" if r["ok"] else "  (¡la importación falló!)"
+        sdks = ", ".join(r["packages_imported"]) or "-"
+        print(f"{r['module']:<10} {r['wall_median_s']:>9.3f}s {r['wall_min_s']:>9.3f}s  {sdks}{estado}")
+
+
+if __name__ == "__main__":
+    main()
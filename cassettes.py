@@ -0,0 +1,333 @@
+# cassettes.py
+# Grabación y reproducción del tráfico con los proveedores, para ejecutar ai_core.py, app.py y
+# main.py sin claves ni red, de forma determinista y con los tiempos de producción.
+#
+#   CASSETTE_MODE=record  cada llamada real a un proveedor (petición, respuesta, uso de tokens,
+#                         error si lo hubo, y el instante de cada fragmento del stream) se añade
+#                         como una línea JSON al archivo CASSETTE_PATH.
+#   CASSETTE_MODE=replay  los adaptadores del registro se sustituyen por otros que responden desde
+#                         el archivo. CASSETTE_LATENCY escala las esperas grabadas: 0 = sin esperas,
+#                         1 = la latencia original (primer fragmento incluido), 0.5 = el doble de rápido.
+#
+# La búsqueda es por hash de la petición (proveedor, instrucción de sistema, prompt y límite de
+# tokens) en un índice hash -> posiciones en el archivo, que se guarda junto a él (<archivo>.idx) y
+# solo se completa con lo añadido desde la última vez. Si una petición se grabó varias veces, las
+# grabaciones se devuelven por turnos. Una petición sin grabar falla con CassetteMissError.
+#
+# Los aciertos de la caché de respuestas no llegan a los proveedores, así que ni se graban ni se
+# reproducen: para medir latencias conviene RESPONSE_CACHE_ENABLED=0.
+
+import os
+import json
+import time
+import atexit
+import asyncio
+import hashlib
+import logging
+import threading
+
+from providers import PROVIDERS, ProviderAdapter
+
+CASSETTE_MODE = os.getenv("CASSETTE_MODE", "").lower()  # "", "record" o "replay"
+CASSETTE_PATH = os.getenv("CASSETTE_PATH", "cassettes/providers.jsonl")
+CASSETTE_LATENCY = float(os.getenv("CASSETTE_LATENCY", 0))  # factor sobre las esperas grabadas
+CASSETTE_MODES = ("record", "replay")
+
+logger = logging.getLogger(__name__)
+
+
+class CassetteMissError(Exception):
+    """La petición no está en el cassette (no se reintenta: repetirla no cambia nada)."""
+
+
+class ReplayedError(Exception):
+    """Error grabado de un proveedor, con su código HTTP (ver replayed_error)."""
+
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+_error_types = {}
+
+def replayed_error(error):
+    # Una subclase con el nombre del tipo original: ai_core decide si reintentar también por el nombre
+    name = error.get("type") or "ReplayedError"
+    if name not in _error_types:
+        _error_types[name] = type(name, (ReplayedError,), {})
+    return _error_types[name](error.get("message", ""), error.get("status"))
+
+
+def request_hash(provider, system_prompt, prompt, max_tokens=None):
+    # El modelo no entra: en reproducción no hay descubrimiento, se usa el que se grabó
+    raw = json.dumps([provider, system_prompt or "", prompt, max_tokens or 0], ensure_ascii=False)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class Cassette:
+    """Archivo JSONL de interacciones (solo se añaden líneas) con su índice por hash de la petición."""
+
+    def __init__(self, path=CASSETTE_PATH):
+        self.path = path
+        self._index = None    # hash -> [posición en bytes de cada grabación]
+        self._models = {}     # proveedor -> modelo grabado
+        self._indexed_size = 0
+        self._turns = {}      # hash -> siguiente grabación a devolver
+        self._lock = threading.Lock()
+        self.counters = {"hits": 0, "misses": 0, "recorded": 0}
+
+    @property
+    def index_path(self):
+        return f"{self.path}.idx"
+
+    def _load_index(self):
+        if self._index is not None:
+            return
+        self._index, self._models, self._indexed_size = {}, {}, 0
+        try:
+            with open(self.index_path, encoding="utf-8") as f:
+                saved = json.load(f)
+            if saved["size"] <= os.path.getsize(self.path):
+                self._index, self._models, self._indexed_size = saved["index"], saved["models"], saved["size"]
+        except (OSError, ValueError, KeyError):
+            pass
+        # El archivo solo crece: basta con indexar lo añadido desde que se guardó el índice
+        try:
+            with open(self.path, "rb") as f:
+                f.seek(self._indexed_size)
+                for line in iter(f.readline, b""):
+                    if line.endswith(b"\n"):
+                        self._add_to_index(json.loads(line), self._indexed_size)
+                        self._indexed_size += len(line)
+        except FileNotFoundError:
+            return
+        self.save_index()
+
+    def _add_to_index(self, entry, offset):
+        self._index.setdefault(entry["h"], []).append(offset)
+        self._models.setdefault(entry["p"], entry.get("m"))
+
+    def save_index(self):
+        if self._index is None:
+            return
+        tmp_path = f"{self.index_path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"size": self._indexed_size, "index": self._index, "models": self._models}, f)
+            os.replace(tmp_path, self.index_path)
+        except OSError as e:
+            logger.warning("No se pudo guardar el índice del cassette: %s", e)
+
+    def providers(self):
+        """Proveedor -> modelo de todo lo grabado."""
+        with self._lock:
+            self._load_index()
+            return dict(self._models)
+
+    def lookup(self, key):
+        """Siguiente grabación de la petición con ese hash, o None."""
+        with self._lock:
+            self._load_index()
+            offsets = self._index.get(key)
+            if not offsets:
+                self.counters["misses"] += 1
+                return None
+            turn = self._turns.get(key, 0)
+            self._turns[key] = turn + 1
+            self.counters["hits"] += 1
+            with open(self.path, "rb") as f:
+                f.seek(offsets[turn % len(offsets)])
+                return json.loads(f.readline())
+
+    def record(self, entry):
+        line = (json.dumps(entry, ensure_ascii=False, separators=(",", ":")) + "\n").encode("utf-8")
+        with self._lock:
+            self._load_index()
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(self.path, "ab") as f:
+                offset = f.tell()
+                f.write(line)
+            # Si otro proceso escribió entretanto, esas líneas se indexan al volver a cargar el índice
+            if offset == self._indexed_size:
+                self._add_to_index(entry, offset)
+                self._indexed_size += len(line)
+            self.counters["recorded"] += 1
+
+    def stats(self):
+        with self._lock:
+            entries = sum(len(offsets) for offsets in self._index.values()) if self._index else 0
+            return {**self.counters, "entries": entries}
+
+
+def _entry(provider, system_prompt, prompt, max_tokens, stream):
+    # Claves cortas: h hash, p proveedor, m modelo, s streaming, sp/q/mt la petición,
+    # c fragmentos [ms desde el inicio, texto], t duración total (ms), u uso, e error
+    return {"h": request_hash(provider.name, system_prompt, prompt, max_tokens), "p": provider.name,
+            "m": provider.model_name, "s": stream, "sp": system_prompt, "q": prompt, "mt": max_tokens, "c": []}
+
+def _elapsed_ms(start):
+    return round((time.perf_counter() - start) * 1000, 1)
+
+
+class RecordingAdapter(ProviderAdapter):
+    """Envuelve un adaptador real y graba en el cassette cada llamada que hace."""
+
+    def __init__(self, inner, cassette):
+        self.name = inner.name
+        self.label = inner.label
+        self.short_name = inner.short_name
+        self.api_key_envs = inner.api_key_envs
+        self.model_envs = inner.model_envs
+        super().__init__()
+        self.inner = inner
+        self.cassette = cassette
+
+    @property
+    def has_key(self):
+        return self.inner.has_key
+
+    @property
+    def not_configured_message(self):
+        return self.inner.not_configured_message
+
+    @property
+    def model_name(self):
+        return self.inner.model_name
+
+    def get_client(self):
+        return self.inner.get_client()
+
+    def reset_client(self):
+        self.inner.reset_client()
+
+    async def warm_up(self, system_prompts=()):
+        return await self.inner.warm_up(system_prompts)
+
+    def _finish(self, entry, start, usage, error=None):
+        entry["t"] = _elapsed_ms(start)
+        if usage:
+            entry["u"] = usage
+        if error is not None:
+            entry["e"] = {"type": type(error).__name__, "message": str(error), "status": getattr(error, "status_code", None)}
+        self.cassette.record(entry)
+
+    async def complete(self, prompt, system_prompt=None, max_tokens=None, usage=None):
+        entry = _entry(self, system_prompt, prompt, max_tokens, stream=False)
+        reported = {}
+        start = time.perf_counter()
+        try:
+            text = await self.inner.complete(prompt, system_prompt, max_tokens, reported)
+        except Exception as e:
+            self._finish(entry, start, reported, e)
+            raise
+        entry["c"].append([_elapsed_ms(start), text])
+        self._finish(entry, start, reported)
+        if usage is not None:
+            usage.update(reported)
+        return text
+
+    async def stream(self, prompt, system_prompt=None, max_tokens=None, usage=None):
+        entry = _entry(self, system_prompt, prompt, max_tokens, stream=True)
+        reported = {}
+        start = time.perf_counter()
+        try:
+            async for text in self.inner.stream(prompt, system_prompt, max_tokens, reported):
+                entry["c"].append([_elapsed_ms(start), text])
+                yield text
+        except Exception as e:
+            self._finish(entry, start, reported, e)
+            raise
+        # Un stream abandonado por quien consume (GeneratorExit, cancelación) no se graba: está incompleto
+        self._finish(entry, start, reported)
+        if usage is not None:
+            usage.update(reported)
+
+
+class ReplayAdapter(ProviderAdapter):
+    """Responde desde el cassette, con los fragmentos y (opcionalmente) los tiempos grabados."""
+
+    def __init__(self, original, cassette, latency=CASSETTE_LATENCY):
+        self.name = original.name
+        self.label = original.label
+        self.short_name = original.short_name
+        self.api_key_envs = original.api_key_envs
+        self.model_envs = original.model_envs
+        super().__init__()
+        self.cassette = cassette
+        self.latency = latency
+        self.model = cassette.providers().get(self.name) or self.model
+
+    @property
+    def has_key(self):
+        # Sin grabaciones de este proveedor, en reproducción es como si no estuviera configurado
+        return self.name in self.cassette.providers()
+
+    @property
+    def not_configured_message(self):
+        return f"{self.short_name} no está en el cassette ({self.cassette.path})."
+
+    def get_client(self):
+        return self if self.has_key else None  # no hay SDK: el propio adaptador hace de cliente
+
+    def reset_client(self):
+        pass
+
+    def _lookup(self, prompt, system_prompt, max_tokens):
+        entry = self.cassette.lookup(request_hash(self.name, system_prompt, prompt, max_tokens))
+        if entry is None:
+            raise CassetteMissError(f"Petición a {self.short_name} sin grabar en {self.cassette.path}.")
+        return entry
+
+    async def _wait_until(self, start, offset_ms):
+        if self.latency:
+            delay = offset_ms * self.latency / 1000 - (time.perf_counter() - start)
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+    def _finish(self, entry, usage):
+        if entry.get("e"):
+            raise replayed_error(entry["e"])
+        if usage is not None and entry.get("u"):
+            usage.update(entry["u"])
+
+    async def complete(self, prompt, system_prompt=None, max_tokens=None, usage=None):
+        start = time.perf_counter()
+        entry = self._lookup(prompt, system_prompt, max_tokens)
+        await self._wait_until(start, entry["t"])
+        self._finish(entry, usage)
+        return "".join(text for _, text in entry["c"])
+
+    async def stream(self, prompt, system_prompt=None, max_tokens=None, usage=None):
+        start = time.perf_counter()
+        entry = self._lookup(prompt, system_prompt, max_tokens)
+        chunks = entry["c"]
+        if not entry["s"] and chunks:
+            # Grabada como respuesta completa: llega de una vez al final
+            chunks = [[entry["t"], chunks[0][1]]]
+        for offset_ms, text in chunks:
+            await self._wait_until(start, offset_ms)
+            yield text
+        await self._wait_until(start, entry["t"])
+        self._finish(entry, usage)
+
+
+active_cassette = None
+
+def install(mode=CASSETTE_MODE, path=CASSETTE_PATH, latency=CASSETTE_LATENCY):
+    """Sustituye los adaptadores del registro por los de grabación o reproducción. Devuelve el Cassette."""
+    global active_cassette
+    if mode not in CASSETTE_MODES:
+        raise ValueError(f"CASSETTE_MODE no válido: {mode} (debe ser {' o '.join(CASSETTE_MODES)})")
+    cassette = active_cassette = Cassette(path)
+    for name, provider in list(PROVIDERS.items()):
+        PROVIDERS[name] = RecordingAdapter(provider, cassette) if mode == "record" else ReplayAdapter(provider, cassette, latency)
+    if mode == "record":
+        atexit.register(cassette.save_index)
+    return cassette
+
+def _reset_after_fork():
+    if active_cassette is not None:
+        active_cassette._lock = threading.Lock()
+
+os.register_at_fork(after_in_child=_reset_after_fork)
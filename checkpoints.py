@@ -0,0 +1,117 @@
+# checkpoints.py
+# Checkpoints de las cadenas: la salida de cada paso terminado se guarda con la clave
+# (id de ejecución, paso) junto con un hash de todo lo que la determina (proveedor, modelo,
+# instrucción de sistema, tarea y el prompt ya construido con el contexto recibido). Al repetir
+# la ejecución, un paso cuyo hash no ha cambiado se restaura sin llamar al proveedor, así que la
+# cadena se reanuda en el primer paso que falló o cuyas entradas cambiaron. Solo se reanuda con un
+# id de ejecución explícito (run_id en la petición): dos peticiones iguales sin él son independientes.
+#
+# Los pasos fallidos no se guardan nunca. Los checkpoints caducan a los CHAIN_CHECKPOINT_TTL segundos.
+
+import os
+import json
+import time
+import hashlib
+import logging
+import sqlite3
+import threading
+
+CHAIN_CHECKPOINTS_ENABLED = os.getenv("CHAIN_CHECKPOINTS_ENABLED", "1") != "0"
+CHAIN_CHECKPOINT_PATH = os.getenv("CHAIN_CHECKPOINT_PATH", "chain_checkpoints.sqlite3")
+CHAIN_CHECKPOINT_TTL = int(os.getenv("CHAIN_CHECKPOINT_TTL", 7 * 24 * 3600))  # segundos
+_PURGE_EVERY = 200  # escrituras entre limpiezas de checkpoints caducados
+
+logger = logging.getLogger(__name__)
+
+
+def step_hash(node, model, prompt, system_prompt):
+    """Hash del contenido que determina la salida de un paso."""
+    raw = json.dumps([node, model, system_prompt or "", prompt], ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class CheckpointStore:
+    def __init__(self, path=CHAIN_CHECKPOINT_PATH, ttl=CHAIN_CHECKPOINT_TTL):
+        self.path = path
+        self.ttl = ttl
+        self._db = None
+        self._lock = threading.Lock()
+        self._writes = 0
+        self.counters = {"restored": 0, "saved": 0, "stale": 0}
+
+    def _connect(self):
+        if self._db is None:
+            self._db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS checkpoints ("
+                "run_id TEXT NOT NULL, step_id TEXT NOT NULL, input_hash TEXT NOT NULL, "
+                "entry TEXT NOT NULL, passed TEXT NOT NULL, created_at REAL NOT NULL, "
+                "PRIMARY KEY (run_id, step_id))"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS checkpoints_created_at ON checkpoints (created_at)")
+        return self._db
+
+    def load(self, run_id, step_id, input_hash):
+        """(registro del paso, texto pasado a los dependientes) si hay un checkpoint vigente con ese hash, o None."""
+        with self._lock:
+            try:
+                row = self._connect().execute(
+                    "SELECT input_hash, entry, passed, created_at FROM checkpoints WHERE run_id = ? AND step_id = ?",
+                    (run_id, step_id),
+                ).fetchone()
+            except sqlite3.Error as e:
+                logger.warning("Checkpoints de cadena no disponibles: %s", e)
+                return None
+            if row is None:
+                return None
+            if row[0] != input_hash or row[3] + self.ttl <= time.time():
+                self.counters["stale"] += 1
+                return None
+            self.counters["restored"] += 1
+            return json.loads(row[1]), row[2]
+
+    def save(self, run_id, step_id, input_hash, entry, passed):
+        now = time.time()
+        with self._lock:
+            try:
+                db = self._connect()
+                db.execute(
+                    "INSERT OR REPLACE INTO checkpoints (run_id, step_id, input_hash, entry, passed, created_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (run_id, step_id, input_hash, json.dumps(entry, ensure_ascii=False), passed, now),
+                )
+                self.counters["saved"] += 1
+                self._writes += 1
+                if self._writes % _PURGE_EVERY == 0:
+                    db.execute("DELETE FROM checkpoints WHERE created_at <= ?", (now - self.ttl,))
+            except sqlite3.Error as e:
+                logger.warning("Checkpoints de cadena no disponibles: %s", e)
+
+    def steps(self, run_id):
+        """Pasos guardados de una ejecución: step_id -> fecha del checkpoint."""
+        with self._lock:
+            rows = self._connect().execute(
+                "SELECT step_id, created_at FROM checkpoints WHERE run_id = ?", (run_id,)).fetchall()
+        return dict(rows)
+
+    def clear(self, run_id=None):
+        with self._lock:
+            if run_id is None:
+                self._connect().execute("DELETE FROM checkpoints")
+            else:
+                self._connect().execute("DELETE FROM checkpoints WHERE run_id = ?", (run_id,))
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters)
+
+
+checkpoint_store = CheckpointStore()
+
+def _reset_after_fork():
+    # La conexión SQLite no puede compartirse entre procesos: el hijo abre la suya en el primer uso
+    checkpoint_store._db = None
+    checkpoint_store._lock = threading.Lock()
+
+os.register_at_fork(after_in_child=_reset_after_fork)
@@ -0,0 +1,93 @@
+# compaction.py
+# Recorte del contexto que pasa de un paso de la cadena al siguiente. Cada salida se mide con un
+# tokenizador local y, si supera el presupuesto del preset, se reduce antes de pasarla:
+#   - "head":    se queda con el principio,
+#   - "tail":    se queda con el final,
+#   - "section": extrae una sección declarada ("RESUMEN:", "## Conclusión"...) y, si no aparece,
+#                recurre a "head",
+#   - "summary": la resume otra IA (lo hace ai_core.compact_context, que es quien llama a los
+#                proveedores; este módulo solo mide y recorta).
+#
+# Si está instalado tiktoken se cuentan tokens reales (CHAIN_TOKENIZER, cl100k_base por defecto);
+# si no, se usa la aproximación de ~4 caracteres por token. En ambos casos no hay llamadas de red.
+
+import os
+import re
+
+CHAIN_TOKENIZER = os.getenv("CHAIN_TOKENIZER", "cl100k_base")
+CHARS_PER_TOKEN = 4
+COMPACTION_STRATEGIES = ("head", "tail", "section", "summary")
+
+_encoding = None
+_encoding_loaded = False
+
+def _get_encoding():
+    global _encoding, _encoding_loaded
+    if not _encoding_loaded:
+        try:
+            import tiktoken
+            _encoding = tiktoken.get_encoding(CHAIN_TOKENIZER)
+        except Exception:
+            # Sin tiktoken (o sin su fichero de vocabulario en caché) nos quedamos con la aproximación
+            _encoding = None
+        _encoding_loaded = True
+    return _encoding
+
+
+def count_tokens(text):
+    if not text:
+        return 0
+    encoding = _get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+def truncate_tokens(text, budget, keep="head"):
+    """Recorta el texto a 'budget' tokens conservando el principio (head) o el final (tail)."""
+    if count_tokens(text) <= budget:
+        return text
+    encoding = _get_encoding()
+    if encoding is not None:
+        tokens = encoding.encode(text, disallowed_special=())
+        kept = tokens[:budget] if keep == "head" else tokens[-budget:]
+        text = encoding.decode(kept)
+    else:
+        limit = budget * CHARS_PER_TOKEN
+        text = text[:limit] if keep == "head" else text[-limit:]
+    return f"{text} [...]" if keep == "head" else f"[...] {text}"
+
+
+# Encabezados reconocidos: "## Título", "**Título**" o "TÍTULO:" al principio de una línea
+def _heading(name):
+    name = re.escape(name)
+    return re.compile(rf"^[ \t]*(?:#{{1,6}}[ \t]*{name}\b.*|\*\*[ \t]*{name}[ \t]*:?[ \t]*\*\*:?.*|{name}[ \t]*:.*)$",
+                      re.MULTILINE | re.IGNORECASE)
+
+_ANY_HEADING = re.compile(r"^[ \t]*(?:#{1,6}[ \t]+\S.*|\*\*[^*\n]+\*\*:?[ \t]*|[A-ZÁÉÍÓÚÑ][A-ZÁÉÍÓÚÑ \t]{2,}:.*)$", re.MULTILINE)
+
+def extract_section(text, section):
+    """Contenido de la sección 'section' hasta el siguiente encabezado, o None si no aparece."""
+    match = _heading(section).search(text)
+    if not match:
+        return None
+    # Lo que vaya en la misma línea tras "TÍTULO:" también forma parte de la sección
+    first_line = match.group(0)
+    inline = first_line.split(":", 1)[1].strip(" *") if ":" in first_line and not first_line.lstrip().startswith("#") else ""
+    rest = text[match.end():]
+    following = _ANY_HEADING.search(rest)
+    body = rest[:following.start()] if following else rest
+    return "\n".join(part for part in (inline, body.strip()) if part) or None
+
+
+def compact_text(text, budget, strategy="head", section=None):
+    """Aplica una estrategia local (head, tail o section). Devuelve (texto, estrategia aplicada o None)."""
+    if not budget or count_tokens(text) <= budget:
+        return text, None
+    if strategy == "section" and section:
+        extracted = extract_section(text, section)
+        if extracted:
+            return truncate_tokens(extracted, budget, "head"), "section"
+        strategy = "head"
+    keep = "tail" if strategy == "tail" else "head"
+    return truncate_tokens(text, budget, keep), keep
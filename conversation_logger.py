@@ -0,0 +1,136 @@
+# conversation_logger.py
+# Registro de conversaciones en segundo plano: el camino de la petición solo encola un registro
+# y un hilo escritor los vuelca por lotes en un archivo JSONL (un registro por consulta),
+# rotándolo cuando supera un tamaño máximo. Otros destinos (el historial SQLite de history.py)
+# se enganchan con add_sink() y reciben los mismos lotes desde ese hilo.
+
+import os
+import json
+import queue
+import logging
+import atexit
+import threading
+
+LOG_PATH = os.getenv("CONVERSATION_LOG_PATH", "conversation_log.jsonl")
+LOG_MAX_BYTES = int(os.getenv("CONVERSATION_LOG_MAX_BYTES", 10 * 1024 * 1024))
+LOG_BACKUP_COUNT = int(os.getenv("CONVERSATION_LOG_BACKUP_COUNT", 5))
+LOG_FLUSH_INTERVAL = float(os.getenv("CONVERSATION_LOG_FLUSH_INTERVAL", 1.0))  # segundos
+LOG_BATCH_SIZE = int(os.getenv("CONVERSATION_LOG_BATCH_SIZE", 100))
+LOG_QUEUE_SIZE = int(os.getenv("CONVERSATION_LOG_QUEUE_SIZE", 10000))
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class ConversationLogger:
+    """Escritor JSONL en un hilo propio, alimentado por una cola acotada."""
+
+    def __init__(self, path=LOG_PATH, max_bytes=LOG_MAX_BYTES, backup_count=LOG_BACKUP_COUNT,
+                 flush_interval=LOG_FLUSH_INTERVAL, batch_size=LOG_BATCH_SIZE, queue_size=LOG_QUEUE_SIZE):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._sinks = []
+        self.dropped = 0
+
+    def add_sink(self, sink):
+        """Registra sink(lote) para recibir cada lote tras escribirlo en el JSONL."""
+        if sink not in self._sinks:
+            self._sinks.append(sink)
+        return sink
+
+    def _ensure_started(self):
+        # Se arranca en el primer uso (y de nuevo tras un fork, donde el hilo no sobrevive)
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread is None or self._pid != os.getpid():
+                self._queue = queue.Queue(maxsize=self._queue.maxsize)
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, name="conversation-logger", daemon=True)
+                self._thread.start()
+
+    def log(self, record):
+        """Encola un registro (dict serializable a JSON). Nunca bloquea: si la cola está llena se descarta."""
+        self._ensure_started()
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        batch = []
+        stop = False
+        while not stop:
+            try:
+                item = self._queue.get(timeout=self.flush_interval)
+                if item is _STOP:
+                    stop = True
+                else:
+                    batch.append(item)
+                # Vacía lo que ya esté en cola sin esperar, hasta completar el lote
+                while not stop and len(batch) < self.batch_size:
+                    item = self._queue.get_nowait()
+                    if item is _STOP:
+                        stop = True
+                    else:
+                        batch.append(item)
+            except queue.Empty:
+                pass
+            if batch:
+                self._write(batch)
+                batch = []
+
+    def _write(self, batch):
+        data = "".join(json.dumps(record, ensure_ascii=False) + "\n" for record in batch).encode("utf-8")
+        try:
+            self._rotate_if_needed(len(data))
+            # Un único write() con O_APPEND por lote: varios procesos pueden escribir en el
+            # mismo archivo sin mezclar líneas
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, data)
+            finally:
+                os.close(fd)
+        except OSError as e:
+            logger.error("Error al guardar el log de conversaciones: %s", e)
+        for sink in list(self._sinks):
+            try:
+                sink(batch)
+            except Exception as e:
+                logger.error("Error en un destino del log de conversaciones: %s", e)
+
+    def _rotate_if_needed(self, incoming):
+        try:
+            size = os.path.getsize(self.path)
+        except OSError:
+            return
+        if size + incoming <= self.max_bytes or self.backup_count <= 0:
+            return
+        for i in range(self.backup_count - 1, 0, -1):
+            src = f"{self.path}.{i}"
+            if os.path.exists(src):
+                os.replace(src, f"{self.path}.{i + 1}")
+        os.replace(self.path, f"{self.path}.1")
+
+    def close(self, timeout=5.0):
+        """Cierre ordenado: escribe todo lo pendiente y detiene el hilo."""
+        if self._thread is None or self._pid != os.getpid():
+            return
+        try:
+            self._queue.put(_STOP, timeout=timeout)
+        except queue.Full:
+            pass
+        self._thread.join(timeout)
+        self._thread = None
+
+
+conversation_logger = ConversationLogger()
+atexit.register(conversation_logger.close)
@@ -0,0 +1,63 @@
+# gunicorn.conf.py
+# Despliegue con varios procesos. gunicorn importa la app una sola vez en el proceso padre
+# (preload_app) y crea los workers con fork, de modo que la configuración y la compilación de los
+# presets no se repiten en cada uno. El padre no crea clientes de los SDK (un canal gRPC abierto
+# antes del fork no es seguro en los hijos). Tras el fork, cada worker descarta el estado heredado
+# (providers.py, ai_core.py, checkpoints.py, jobs.py) y se calienta con ai_core.warm_up(), que crea
+# los clientes y descubre los modelos que falten, antes de aceptar peticiones.
+#
+# Uso:
+#   gunicorn -c gunicorn.conf.py app:app                                              (WSGI, con hilos)
+#   gunicorn -c gunicorn.conf.py -k uvicorn.workers.UvicornWorker asgi:application    (ASGI)
+#
+# Compartido entre workers: la caché de respuestas (SQLite), el historial, los checkpoints de las
+# cadenas y las métricas de /metrics (METRICS_MULTIPROC_DIR). Propio de cada worker: los trabajos y
+# lotes en curso, las sesiones en memoria, la caché por similitud, las estadísticas de /api/*/stats y
+# las cuotas de cada proveedor (<PROVEEDOR>_RPM / _TPM se aplican por worker: repártelas entre ellos).
+
+import os
+import logging
+import multiprocessing
+
+bind = os.getenv("BIND", "127.0.0.1:8000")
+workers = int(os.getenv("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gthread")
+threads = int(os.getenv("GUNICORN_THREADS", 16))  # por worker, con gthread: las consultas esperan a los proveedores
+timeout = int(os.getenv("GUNICORN_TIMEOUT", 240))  # por encima de REQUEST_TIMEOUT
+graceful_timeout = 30
+preload_app = True
+
+# Avisos de la app (logging): los workers heredan esta configuración del padre
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"), format="%(asctime)s [%(process)d] %(levelname)s %(name)s: %(message)s")
+
+# metrics.py lo lee al importarse, así que se fija antes de cargar la app
+os.environ.setdefault("METRICS_MULTIPROC_DIR", ".metrics")
+
+
+def on_starting(server):
+    # En el padre, una vez y antes del primer fork
+    from metrics import clear_multiprocess_dir
+    from ai_core import prepare_workers
+    clear_multiprocess_dir(os.environ["METRICS_MULTIPROC_DIR"])
+    providers = prepare_workers()
+    server.log.info("Proveedores con clave: %s", ", ".join(p.name for p in providers) or "ninguno")
+
+
+def post_worker_init(worker):
+    # En cada worker, después del fork y antes de aceptar conexiones
+    from ai_core import warm_up
+    ready = warm_up()
+    worker.log.info("Worker %s listo: %s", worker.pid, ", ".join(ready) or "sin proveedores")
+
+
+def worker_exit(server, worker):
+    from metrics import registry
+    if registry.store:
+        registry.store.flush()
+
+
+def child_exit(server, worker):
+    # En el padre: los contadores del worker terminado se conservan en dead.json
+    from metrics import registry
+    if registry.store:
+        registry.store.mark_process_dead(worker.pid)
@@ -0,0 +1,394 @@
+# history.py
+# Historial de conversaciones consultable: un almacén SQLite (WAL) con un índice de texto completo
+# (FTS5) sobre la pregunta y las respuestas. Lo alimenta el hilo de conversation_logger con los
+# mismos lotes que escribe en el JSONL, así que el camino de la petición no cambia.
+#
+# GET /api/history pagina por conjunto de claves (timestamp, id) en lugar de OFFSET: cada página
+# es una búsqueda en índice y cuesta lo mismo con una semana de historial que con un año.
+#
+# El log de texto antiguo (conversation_log.txt) y los JSONL ya escritos se importan una vez con
+#   python history.py import conversation_log.txt conversation_log.jsonl
+# Cada registro lleva una huella, así que repetir la importación no duplica nada. Las respuestas
+# del log de texto se guardan tal y como quedaron escritas (con los saltos de línea de textwrap).
+
+import os
+import re
+import sys
+import json
+import base64
+import hashlib
+import logging
+import sqlite3
+import datetime
+import threading
+
+from providers import PROVIDERS
+
+logger = logging.getLogger(__name__)
+
+HISTORY_ENABLED = os.getenv("HISTORY_ENABLED", "1") != "0"
+HISTORY_PATH = os.getenv("HISTORY_PATH", "history.sqlite3")
+HISTORY_PAGE_SIZE = int(os.getenv("HISTORY_PAGE_SIZE", 20))
+HISTORY_MAX_PAGE_SIZE = int(os.getenv("HISTORY_MAX_PAGE_SIZE", 100))
+
+# Nombres de modo de la API -> nombres con los que se registran
+MODE_NAMES = {"comparison": "comparacion", "chained": "encadenada", "race": "carrera"}
+
+_SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS conversations ("
+    "id INTEGER PRIMARY KEY, fingerprint TEXT NOT NULL UNIQUE, timestamp TEXT NOT NULL, "
+    "mode TEXT, preset TEXT, source TEXT, prompt TEXT NOT NULL, record TEXT NOT NULL)",
+    "CREATE INDEX IF NOT EXISTS conversations_timestamp ON conversations (timestamp, id)",
+    "CREATE INDEX IF NOT EXISTS conversations_mode ON conversations (mode, timestamp, id)",
+    "CREATE INDEX IF NOT EXISTS conversations_preset ON conversations (preset, timestamp, id)",
+    # Un proveedor por fila: el filtro por proveedor también va por índice
+    "CREATE TABLE IF NOT EXISTS conversation_providers ("
+    "provider TEXT NOT NULL, timestamp TEXT NOT NULL, conversation_id INTEGER NOT NULL, "
+    "PRIMARY KEY (provider, timestamp, conversation_id)) WITHOUT ROWID",
+)
+_FTS_SCHEMA = ("CREATE VIRTUAL TABLE IF NOT EXISTS conversations_fts USING fts5("
+               "prompt, responses, tokenize='unicode61 remove_diacritics 2')")
+
+
+class HistoryError(ValueError):
+    """Parámetros de búsqueda no válidos."""
+
+
+def _provider_aliases():
+    # "Gemini", "GEMINI", "OpenAI (ChatGPT)", "OpenAI"... -> nombre del registro
+    aliases = {}
+    for provider in PROVIDERS.values():
+        for alias in (provider.name, provider.label, provider.short_name):
+            if alias:
+                aliases[alias.lower()] = provider.name
+    return aliases
+
+
+def _normalize_timestamp(value):
+    # Los logs antiguos usan "YYYY-MM-DD HH:MM:SS"; se guarda siempre en ISO con "T"
+    return datetime.datetime.fromisoformat(value).isoformat(timespec="seconds")
+
+
+def _entries(record):
+    """Lista de (proveedor tal como se registró, tarea, texto) de un registro, sea cual sea su modo."""
+    responses = record.get("responses")
+    if isinstance(responses, dict):
+        return [(name, None, text) for name, text in responses.items()]
+    entries = []
+    for entry in responses or []:
+        if isinstance(entry, dict):
+            entries.append((entry.get("ia_name") or "", entry.get("task"), entry.get("response") or ""))
+    return entries
+
+
+def fingerprint(record):
+    raw = json.dumps([record.get("timestamp"), record.get("mode"), record.get("prompt"), record.get("responses")],
+                     ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def encode_cursor(timestamp, row_id):
+    return base64.urlsafe_b64encode(f"{timestamp}|{row_id}".encode("utf-8")).decode("ascii").rstrip("=")
+
+def decode_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode("utf-8")
+        timestamp, row_id = raw.rsplit("|", 1)
+        return timestamp, int(row_id)
+    except (ValueError, UnicodeDecodeError):
+        raise HistoryError("Cursor no válido.") from None
+
+
+def _parse_date(value, end=False):
+    # Acepta fecha ("2025-07-29") o fecha y hora; una fecha sola como límite superior incluye todo el día
+    try:
+        parsed = datetime.datetime.fromisoformat(value)
+    except ValueError:
+        raise HistoryError(f"Fecha no válida: {value}") from None
+    if end and len(value) == 10:
+        return parsed.date().isoformat() + "T23:59:59"
+    return parsed.isoformat(timespec="seconds")
+
+
+def _fts_query(text):
+    # Cada palabra como frase entre comillas: la sintaxis de FTS5 (AND, NEAR, "*"...) no llega del usuario
+    words = re.findall(r"\w+", text)
+    return " ".join(f'"{word}"' for word in words)
+
+
+class HistoryStore:
+    """Almacén SQLite del historial. Una conexión por hilo (y por proceso, tras un fork)."""
+
+    def __init__(self, path=HISTORY_PATH):
+        self.path = path
+        self._local = threading.local()
+        self._init_lock = threading.Lock()
+        self._initialized = False
+        self.fts = False
+
+    def _connect(self):
+        local = self._local
+        if getattr(local, "db", None) is None or local.pid != os.getpid():
+            db = sqlite3.connect(self.path, isolation_level=None, timeout=10)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            with self._init_lock:
+                if not self._initialized:
+                    for statement in _SCHEMA:
+                        db.execute(statement)
+                    try:
+                        db.execute(_FTS_SCHEMA)
+                        self.fts = True
+                    except sqlite3.OperationalError:
+                        # SQLite sin FTS5: la búsqueda de texto cae a LIKE sobre la pregunta
+                        logger.warning("SQLite sin FTS5; la búsqueda de texto del historial será lenta.")
+                    self._initialized = True
+            local.db = db
+            local.pid = os.getpid()
+        return local.db
+
+    def add_records(self, records):
+        """Inserta registros de conversation_logger (ignora los ya guardados). Devuelve cuántos son nuevos."""
+        aliases = _provider_aliases()
+        added = 0
+        db = self._connect()
+        db.execute("BEGIN")
+        try:
+            for record in records:
+                try:
+                    timestamp = _normalize_timestamp(record["timestamp"])
+                except (KeyError, TypeError, ValueError):
+                    continue
+                entries = _entries(record)
+                cursor = db.execute(
+                    "INSERT OR IGNORE INTO conversations (fingerprint, timestamp, mode, preset, source, prompt, record) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (fingerprint(record), timestamp, record.get("mode"), record.get("preset"),
+                     record.get("source", "web"), record.get("prompt") or "",
+                     json.dumps(record, ensure_ascii=False, default=str)),
+                )
+                if not cursor.rowcount:
+                    continue
+                row_id = cursor.lastrowid
+                providers = {aliases.get(name.lower(), name.lower()) for name, _, _ in entries if name}
+                db.executemany(
+                    "INSERT OR IGNORE INTO conversation_providers (provider, timestamp, conversation_id) VALUES (?, ?, ?)",
+                    [(provider, timestamp, row_id) for provider in providers],
+                )
+                if self.fts:
+                    db.execute(
+                        "INSERT INTO conversations_fts (rowid, prompt, responses) VALUES (?, ?, ?)",
+                        (row_id, record.get("prompt") or "", "\n\n".join(str(text) for _, _, text in entries)),
+                    )
+                added += 1
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        return added
+
+    def write_batch(self, records):
+        """Sumidero de conversation_logger: un error aquí no debe parar el hilo escritor."""
+        try:
+            self.add_records(records)
+        except sqlite3.Error as e:
+            logger.error("Error al guardar el historial de conversaciones: %s", e)
+
+    def search(self, q=None, provider=None, mode=None, preset=None, since=None, until=None, cursor=None, limit=None):
+        """Página de conversaciones, de la más reciente a la más antigua, y el cursor de la siguiente."""
+        limit = max(1, min(int(limit or HISTORY_PAGE_SIZE), HISTORY_MAX_PAGE_SIZE))
+        clauses, params = [], []
+        if mode:
+            clauses.append("c.mode = ?")
+            params.append(MODE_NAMES.get(mode, mode))
+        if preset:
+            clauses.append("c.preset = ?")
+            params.append(str(preset))
+        if since:
+            clauses.append("c.timestamp >= ?")
+            params.append(_parse_date(since))
+        if until:
+            clauses.append("c.timestamp <= ?")
+            params.append(_parse_date(until, end=True))
+        if provider:
+            clauses.append("EXISTS (SELECT 1 FROM conversation_providers p "
+                           "WHERE p.provider = ? AND p.timestamp = c.timestamp AND p.conversation_id = c.id)")
+            params.append(_provider_aliases().get(provider.lower(), provider.lower()))
+        db = self._connect()
+        if q:
+            if self.fts:
+                match = _fts_query(q)
+                if not match:
+                    raise HistoryError("La búsqueda no contiene palabras.")
+                clauses.append("c.id IN (SELECT rowid FROM conversations_fts WHERE conversations_fts MATCH ?)")
+                params.append(match)
+            else:
+                clauses.append("c.prompt LIKE ?")
+                params.append(f"%{q}%")
+        if cursor:
+            clauses.append("(c.timestamp, c.id) < (?, ?)")
+            params.extend(decode_cursor(cursor))
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        rows = db.execute(
+            f"SELECT c.id, c.timestamp, c.record FROM conversations c {where} "
+            "ORDER BY c.timestamp DESC, c.id DESC LIMIT ?",
+            params + [limit + 1],
+        ).fetchall()
+        items = []
+        for row_id, timestamp, raw in rows[:limit]:
+            record = json.loads(raw)
+            record["id"] = row_id
+            record["timestamp"] = timestamp
+            items.append(record)
+        next_cursor = encode_cursor(rows[limit - 1][1], rows[limit - 1][0]) if len(rows) > limit else None
+        return {"items": items, "next_cursor": next_cursor}
+
+    def get(self, row_id):
+        row = self._connect().execute("SELECT timestamp, record FROM conversations WHERE id = ?", (row_id,)).fetchone()
+        if row is None:
+            return None
+        record = json.loads(row[1])
+        record["id"] = row_id
+        record["timestamp"] = row[0]
+        return record
+
+    def stats(self):
+        db = self._connect()
+        return {
+            "conversations": db.execute("SELECT COUNT(*) FROM conversations").fetchone()[0],
+            "full_text": self.fts,
+            "path": self.path,
+        }
+
+
+# --- Importación de logs anteriores ---
+_TEXT_HEADER = re.compile(r"^--- Consulta(?: \((?P<mode>[^)]*)\))? (?P<ts>\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}) ---$")
+_TEXT_QUESTION = re.compile(r"^Pregunta(?: Inicial)?: ?(?P<text>.*)$")
+_TEXT_SECTION = re.compile(r"^--- (?:Paso (?P<step>\d+): (?P<name>.+?)(?: \((?P<task>.*)\))?|(?P<label>.+?)) ---$")
+_TEXT_NOISE = re.compile(r"^(?:Longitud: \d+ caracteres|-{30})$")
+_TEXT_END = "=" * 60
+
+
+def parse_text_log(lines):
+    """Registros (con la forma de conversation_logger) a partir del conversation_log.txt antiguo.
+
+    Entiende los formatos que escribían ai_core.py y main.py: comparación ("--- Gemini ---") y
+    cadena ("--- Paso 1: gemini (tarea) ---" con "Prompt enviado:" / "Respuesta:").
+    """
+    record = None
+    section = None
+    target = None  # lista de líneas donde va el texto que se lee
+
+    def finish():
+        if record is None:
+            return None
+        sections = record.pop("_sections")
+        prompt = "\n".join(record.pop("_prompt")).strip()
+        chained = any(s["step"] is not None for s in sections)
+        mode = (record.get("mode") or ("encadenada" if chained else "comparacion")).lower()
+        if chained:
+            responses = [{"step": s["step"], "ia_name": s["name"], "task": s["task"],
+                          "response": "\n".join(s["lines"]).strip()} for s in sections]
+        else:
+            responses = {s["name"]: "\n".join(s["lines"]).strip() for s in sections}
+        return dict(record, mode=mode, prompt=prompt, responses=responses)
+
+    for line in lines:
+        line = line.rstrip("\n")
+        header = _TEXT_HEADER.match(line)
+        if header:
+            done = finish()
+            if done:
+                yield done
+            record = {"timestamp": _normalize_timestamp(header["ts"]), "mode": header["mode"], "preset": None,
+                      "source": "txt", "_prompt": [], "_sections": []}
+            section = None
+            target = None
+            continue
+        if record is None:
+            continue
+        if line == _TEXT_END:
+            done = finish()
+            if done:
+                yield done
+            record = section = target = None
+            continue
+        question = _TEXT_QUESTION.match(line) if section is None and not record["_prompt"] else None
+        if question:
+            target = record["_prompt"]
+            target.append(question["text"])
+            continue
+        match = _TEXT_SECTION.match(line)
+        if match:
+            step = int(match["step"]) if match["step"] else None
+            section = {"step": step, "name": (match["name"] or match["label"]).strip(), "task": match["task"], "lines": []}
+            record["_sections"].append(section)
+            target = section["lines"]
+            continue
+        if section is not None:
+            if _TEXT_NOISE.match(line):
+                continue
+            if line.startswith("Prompt enviado:"):
+                target = []  # el prompt enviado no se guarda; se descarta hasta "Respuesta:"
+                continue
+            if line.startswith("Respuesta:"):
+                target = section["lines"]
+                target.append(line[len("Respuesta:"):].strip())
+                continue
+        if target is not None:
+            target.append(line)
+    done = finish()
+    if done:
+        yield done
+
+
+def parse_jsonl_log(lines):
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield json.loads(line)
+        except json.JSONDecodeError:
+            continue
+
+
+def import_log(path, store=None, batch_size=500):
+    """Importa un log antiguo (.txt o .jsonl) al historial. Devuelve (leídos, nuevos)."""
+    store = store or history_store
+    parse = parse_jsonl_log if ".jsonl" in os.path.basename(path) else parse_text_log
+    read = added = 0
+    batch = []
+    with open(path, encoding="utf-8", errors="replace") as f:
+        for record in parse(f):
+            batch.append(record)
+            read += 1
+            if len(batch) >= batch_size:
+                added += store.add_records(batch)
+                batch = []
+    if batch:
+        added += store.add_records(batch)
+    return read, added
+
+
+history_store = HistoryStore()
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv or argv[0] != "import":
+        print("Uso: python history.py import [conversation_log.txt] [conversation_log.jsonl ...]")
+        return 2
+    paths = argv[1:] or [p for p in ("conversation_log.txt", "conversation_log.jsonl") if os.path.exists(p)]
+    for path in paths:
+        try:
+            read, added = import_log(path)
+        except OSError as e:
+            print(f"No se pudo leer {path}: {e}")
+            continue
+        print(f"{path}: {read} conversaciones leídas, {added} nuevas.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
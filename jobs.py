@@ -0,0 +1,277 @@
+# jobs.py
+# Trabajos en segundo plano para consultas largas (cadenas de varios pasos, comparaciones...).
+# POST /api/jobs encola la consulta y devuelve un id al instante; un número fijo de workers la
+# ejecuta en el bucle persistente de ai_core y GET /api/jobs/<id> devuelve el estado y los
+# resultados de cada paso según se van completando (incluido el texto parcial del paso en curso).
+# Así ningún hilo de Flask queda bloqueado esperando a los proveedores.
+#
+# Los trabajos viven en memoria del proceso: con varios workers de servidor, las consultas de
+# estado deben llegar al mismo proceso que aceptó el trabajo (afinidad de sesión).
+
+import os
+import time
+import uuid
+import asyncio
+import threading
+from collections import OrderedDict
+
+from ai_core import (
+    stream_comparison_mode, stream_chain_mode, run_race_mode, run_auto_mode, run_sync, get_event_loop, make_deadline,
+    WORKFLOW_PRESETS,
+)
+from sessions import validate_session_id, SessionError
+
+JOBS_WORKERS = int(os.getenv("JOBS_WORKERS", 4))          # trabajos ejecutándose a la vez
+JOBS_QUEUE_SIZE = int(os.getenv("JOBS_QUEUE_SIZE", 100))  # trabajos en espera como máximo
+JOBS_TTL = int(os.getenv("JOBS_TTL", 3600))               # segundos que se conserva un trabajo terminado
+JOBS_MAX = int(os.getenv("JOBS_MAX", 1000))               # trabajos guardados como máximo
+JOB_MODES = ("comparison", "chained", "race", "auto")
+FINISHED = ("completado", "error", "cancelado")
+
+
+class QueueFullError(Exception):
+    """No caben más trabajos en la cola."""
+
+
+class Job:
+    def __init__(self, prompt, mode, preset=None, use_cache=True, strategy="all", run_id=None, session_id=None, timeout=None):
+        self.id = uuid.uuid4().hex[:12]
+        self.prompt = prompt
+        self.mode = mode
+        self.preset = preset
+        self.use_cache = use_cache
+        self.strategy = strategy
+        self.run_id = run_id
+        self.session_id = session_id
+        self.timeout = timeout  # segundos desde que empieza a ejecutarse; None = sin plazo
+        self.status = "pendiente"
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.error = None
+        self.task = None
+        self._entries = {}  # paso (o proveedor) -> resultado parcial
+        self._race_result = None  # modos race y auto: una única respuesta
+        # El bucle de ai_core escribe y los hilos de Flask leen
+        self._lock = threading.Lock()
+
+    def apply_event(self, event):
+        """Incorpora un evento de stream_comparison_mode / stream_chain_mode."""
+        key = event["provider"] if event["step"] is None else event["step"]
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = self._entries[key] = {"step": event["step"], "ia_name": event["provider"],
+                                              "task": event.get("task"), "response": "", "done": False}
+                if event.get("reused"):
+                    entry["reused"] = event["reused"]
+                if event.get("checkpoint"):
+                    entry["checkpoint"] = True
+            if event["type"] == "start" and event.get("fallback_from"):
+                # El paso lo responde un proveedor de reserva (se cambia antes del primer fragmento)
+                entry["ia_name"] = event["provider"]
+                entry["fallback_from"] = event["fallback_from"]
+            if event["type"] == "token":
+                entry["response"] += event["text"]
+            elif event["type"] == "done":
+                entry["done"] = True
+                if event.get("error"):
+                    entry["error"] = True
+                if event.get("timed_out"):
+                    entry["timed_out"] = True
+                if event.get("tokens"):
+                    entry["tokens"] = event["tokens"]
+                if event.get("usage"):
+                    entry["usage"] = event["usage"]
+
+    def results(self):
+        """Resultados con la misma forma que /api/query (más "done" por paso en modo encadenado)."""
+        if self.mode in ("race", "auto"):
+            return self._race_result
+        entries = [dict(entry) for entry in self._entries.values()]
+        if self.mode == "comparison":
+            results = {entry["ia_name"]: entry["response"] for entry in entries}
+            usage = {entry["ia_name"]: entry["usage"] for entry in entries if entry.get("usage")}
+            if usage:
+                results["_usage"] = usage
+            reused = next((entry["reused"] for entry in entries if entry.get("reused")), None)
+            return dict(results, _reused=reused) if reused else results
+        return sorted(entries, key=lambda entry: entry["step"])
+
+    def to_dict(self):
+        with self._lock:
+            results = self.results()
+            steps_done = sum(1 for entry in self._entries.values() if entry["done"])
+        return {
+            "id": self.id,
+            "status": self.status,
+            "mode": self.mode,
+            "preset": self.preset,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "steps_done": steps_done,
+            "results": results,
+            "error": self.error,
+        }
+
+
+class JobManager:
+    def __init__(self, workers=JOBS_WORKERS, queue_size=JOBS_QUEUE_SIZE, ttl=JOBS_TTL, max_jobs=JOBS_MAX):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.ttl = ttl
+        self.max_jobs = max_jobs
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+        self._queue = None
+        self._worker_tasks = []
+
+    @staticmethod
+    def validate(data):
+        """Devuelve un mensaje de error si la solicitud no es válida, o None."""
+        if not isinstance(data, dict):
+            return "El cuerpo de la solicitud debe ser un objeto JSON."
+        if not data.get("prompt") or not data.get("mode"):
+            return "Faltan 'prompt' o 'mode' en la solicitud."
+        if data["mode"] not in JOB_MODES:
+            return f"Modo no válido: {data['mode']}"
+        if data["mode"] == "chained" and data.get("preset") not in WORKFLOW_PRESETS:
+            return "Falta 'preset' para el modo encadenado." if not data.get("preset") else "Preset no válido."
+        if data.get("strategy", "all") not in ("all", "hedged"):
+            return f"Estrategia no válida: {data['strategy']}"
+        timeout = data.get("timeout")
+        if timeout is not None and (isinstance(timeout, bool) or not isinstance(timeout, (int, float)) or timeout < 0):
+            return f"'timeout' no válido: {timeout}"
+        if data.get("session_id") is not None:
+            try:
+                validate_session_id(data["session_id"])
+            except SessionError as e:
+                return str(e)
+        return None
+
+    def submit(self, data):
+        """Crea y encola un trabajo (data ya validada). Lanza QueueFullError si la cola está llena."""
+        job = Job(data["prompt"], data["mode"], preset=data.get("preset"),
+                  use_cache=data.get("cache", True) is not False, strategy=data.get("strategy", "all"),
+                  run_id=data.get("run_id"), session_id=data.get("session_id"), timeout=data.get("timeout"))
+        with self._lock:
+            self._evict()
+            self._jobs[job.id] = job
+        try:
+            run_sync(self._enqueue(job))
+        except QueueFullError:
+            with self._lock:
+                self._jobs.pop(job.id, None)
+            raise
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def cancel(self, job_id):
+        job = self.get(job_id)
+        if job and job.status not in FINISHED:
+            get_event_loop().call_soon_threadsafe(self._cancel, job)
+        return job
+
+    def stats(self):
+        with self._lock:
+            jobs = list(self._jobs.values())
+        counts = {}
+        for job in jobs:
+            counts[job.status] = counts.get(job.status, 0) + 1
+        return {"workers": self.workers, "queue_size": self.queue_size, "jobs": counts}
+
+    def _evict(self):
+        # Se olvidan los trabajos terminados hace más de ttl segundos y, si aun así hay demasiados,
+        # los terminados más antiguos. Los pendientes o en curso nunca se expulsan.
+        now = time.time()
+        for job_id, job in list(self._jobs.items()):
+            if job.status in FINISHED and now - (job.finished_at or now) > self.ttl:
+                del self._jobs[job_id]
+        excess = len(self._jobs) - self.max_jobs
+        for job_id, job in list(self._jobs.items()):
+            if excess <= 0:
+                break
+            if job.status in FINISHED:
+                del self._jobs[job_id]
+                excess -= 1
+
+    # --- Lo que sigue se ejecuta en el bucle persistente de ai_core ---
+    async def _enqueue(self, job):
+        if self._queue is None:
+            self._queue = asyncio.Queue(maxsize=self.queue_size)
+            self._worker_tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        try:
+            self._queue.put_nowait(job)
+        except asyncio.QueueFull:
+            raise QueueFullError("Demasiados trabajos en cola. Inténtalo más tarde.") from None
+
+    def _cancel(self, job):
+        if job.task:
+            job.task.cancel()
+        elif job.status == "pendiente":
+            job.status = "cancelado"  # el worker lo descartará al sacarlo de la cola
+            job.finished_at = time.time()
+
+    async def _worker(self):
+        while True:
+            job = await self._queue.get()
+            if job.status != "pendiente":
+                continue
+            job.task = asyncio.create_task(self._run(job))
+            try:
+                # wait() no propaga la cancelación en ningún sentido: si se cancela el trabajo, el
+                # worker sigue con el siguiente; si se cancela el worker, cancela el trabajo y termina
+                await asyncio.wait([job.task])
+            except asyncio.CancelledError:
+                job.task.cancel()
+                raise
+            finally:
+                job.task = None
+
+    async def _run(self, job):
+        job.status = "en curso"
+        job.started_at = time.time()
+        deadline = make_deadline(job.timeout)
+        try:
+            if job.mode == "race":
+                job._race_result = await run_race_mode(job.prompt, use_cache=job.use_cache, strategy=job.strategy,
+                                                       session_id=job.session_id, deadline=deadline)
+            elif job.mode == "auto":
+                job._race_result = await run_auto_mode(job.prompt, use_cache=job.use_cache, session_id=job.session_id,
+                                                       deadline=deadline)
+            else:
+                if job.mode == "comparison":
+                    stream = stream_comparison_mode(job.prompt, use_cache=job.use_cache, session_id=job.session_id,
+                                                    deadline=deadline)
+                else:
+                    stream = stream_chain_mode(job.prompt, job.preset, use_cache=job.use_cache, run_id=job.run_id,
+                                               session_id=job.session_id, deadline=deadline)
+                try:
+                    async for event in stream:
+                        job.apply_event(event)
+                finally:
+                    await stream.aclose()  # al cancelar, corta también las llamadas en vuelo
+            job.status = "completado"
+        except asyncio.CancelledError:
+            job.status = "cancelado"
+            raise
+        except Exception as e:
+            job.status = "error"
+            job.error = str(e)
+        finally:
+            job.finished_at = time.time()
+
+
+job_manager = JobManager()
+
+def _reset_after_fork():
+    # La cola y los workers viven en el bucle de ai_core del padre; el hijo los crea con su primer trabajo
+    job_manager._queue = None
+    job_manager._worker_tasks = []
+    job_manager._lock = threading.Lock()
+
+os.register_at_fork(after_in_child=_reset_after_fork)
@@ -1,203 +1,50 @@
 # main.py
 
 import os
+import uuid
 import asyncio
-import google.generativeai as genai
-from openai import OpenAI
+import logging
 from dotenv import load_dotenv
 import datetime
 import textwrap
+from conversation_logger import conversation_logger
 
 # --- 1. Cargar las variables de entorno ---
 load_dotenv()
-
-# --- 2. Obtener las API Keys del entorno ---
-GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-CLAUDE_API_KEY = os.getenv("CLAUDE_API_KEY")
-DEEPSEEK_API_KEY = os.getenv("DEEPSEEK_API_KEY")
-
-
-# --- 3. Configurar las APIs con tus claves ---
-
-# Gemini
-gemini_model = None
-if GEMINI_API_KEY:
-    try:
-        genai.configure(api_key=GEMINI_API_KEY)
-        PREFERRED_GEMINI_MODEL = 'models/gemini-2.5-flash-lite' 
-
-        chosen_model_found = False
-        available_gemini_models = []
-        for m in genai.list_models():
-            if 'generateContent' in m.supported_generation_methods: 
-                available_gemini_models.append(m.name)
-        
-        if PREFERRED_GEMINI_MODEL in available_gemini_models:
-            gemini_model = genai.GenerativeModel(PREFERRED_GEMINI_MODEL)
-            chosen_model_found = True
-        else:
-            for model_name in available_gemini_models:
-                if 'gemini' in model_name.lower() and 'generateContent' in genai.get_model(model_name).supported_generation_methods:
-                    gemini_model = genai.GenerativeModel(model_name)
-                    chosen_model_found = True
-                    break
-            
-        if gemini_model:
-            print(f"Gemini configurado con éxito usando: {gemini_model.model_name}")
-        else:
-            print(f"Error: No se encontró ningún modelo Gemini compatible.")
-
-    except Exception as e:
-        print(f"Error al configurar Gemini: {e}")
-        gemini_model = None
-else:
-    print("Advertencia: GEMINI_API_KEY no encontrada.")
-
-
-# OpenAI
-openai_client = None
-if OPENAI_API_KEY:
-    try:
-        openai_client = OpenAI(api_key=OPENAI_API_KEY)
-        print("OpenAI (ChatGPT) configurado con éxito.")
-    except Exception as e:
-        print(f"Error al configurar OpenAI: {e}")
-        openai_client = None
-else:
-    print("Advertencia: OPENAI_API_KEY no encontrada.")
-
-
-# Anthropic (Claude) - Placeholder
-claude_client = None
-# if CLAUDE_API_KEY:
-#     try:
-#         from anthropic import Anthropic
-#         claude_client = Anthropic(api_key=CLAUDE_API_KEY)
-#         print("Anthropic (Claude) configurado con éxito.")
-#     except Exception as e:
-#         print(f"Error al configurar Anthropic: {e}")
-#         claude_client = None
-
-# DeepSeek - Placeholder
-deepseek_client = None
-# if DEEPSEEK_API_KEY:
-#     try:
-#         # from openai import OpenAI as DeepSeekOpenAIClient
-#         # deepseek_client = DeepSeekOpenAIClient(api_key=DEEPSEEK_API_KEY, base_url="https://api.deepseek.com/v1")
-#         print("DeepSeek configurado con éxito.")
-#     except Exception as e:
-#         print(f"Error al configurar DeepSeek: {e}")
-#         deepseek_client = None
-
-
-# --- 4. Funciones Asíncronas para obtener respuestas de cada IA (usan asyncio.to_thread) ---
-
-async def get_gemini_response(prompt, system_prompt=None):
-    if not gemini_model:
-        return "Gemini no configurado o modelo no disponible."
-    try:
-        full_prompt = prompt
-        if system_prompt:
-            # Para Gemini, inyectamos el system_prompt al inicio del prompt principal
-            # ya que generate_content no tiene un parámetro 'system' directo como chat.completions
-            full_prompt = f"INSTRUCCIÓN DE SISTEMA PARA EL ROL: {system_prompt}\n\n" \
-                          f"Aquí está la tarea principal y el contexto:\n{prompt}"
-
-        response = await asyncio.to_thread(gemini_model.generate_content, full_prompt)
-        
-        if response.candidates and response.candidates[0].content.parts:
-            return response.candidates[0].content.parts[0].text
-        else:
-            return "Gemini: No se pudo obtener una respuesta textual (posiblemente contenido bloqueado o vacío)."
-    except Exception as e:
-        return f"Gemini Error: {e}"
-
-async def get_openai_response(prompt, system_prompt=None):
-    if not openai_client:
-        return "OpenAI no configurado."
-    try:
-        messages = []
-        if system_prompt:
-            messages.append({"role": "system", "content": system_prompt})
-        messages.append({"role": "user", "content": prompt})
-
-        response = await asyncio.to_thread(
-            openai_client.chat.completions.create,
-            model="gpt-3.5-turbo",
-            messages=messages
-        )
-        return response.choices[0].message.content
-    except Exception as e:
-        return f"OpenAI Error: {e}"
-
-async def get_claude_response(prompt, system_prompt=None):
-    if not claude_client:
-        return "Claude no configurado."
-    try:
-        # IMPLEMENTACIÓN ASÍNCRONA DE CLAUDE AQUÍ
-        # messages = []
-        # if system_prompt:
-        #     messages.append({"role": "user", "content": f"<system_prompt>{system_prompt}</system_prompt>"})
-        # messages.append({"role": "user", "content": prompt})
-        #
-        # response = await asyncio.to_thread(
-        #     claude_client.messages.create,
-        #     model="claude-3-opus-20240229",
-        #     max_tokens=1024,
-        #     messages=messages
-        # )
-        # return response.content[0].text
-        return "Claude: [IMPLEMENTAR ASÍNCRONO]" # Placeholder
-    except Exception as e:
-        return f"Claude Error: {e}"
-
-async def get_deepseek_response(prompt, system_prompt=None):
-    if not deepseek_client:
-        return "DeepSeek no configurado."
-    try:
-        # IMPLEMENTACIÓN ASÍNCRONA DE DEEPSEEK AQUÍ
-        # messages = []
-        # if system_prompt:
-        #     messages.append({"role": "system", "content": system_prompt})
-        # messages.append({"role": "user", "content": prompt})
-        #
-        # response = await asyncio.to_thread(
-        #     deepseek_client.chat.completions.create,
-        #     model="deepseek-chat",
-        #     messages=messages
-        # )
-        # return response.choices[0].message.content
-        return "DeepSeek: [IMPLEMENTAR ASÍNCRONO]" # Placeholder
-    except Exception as e:
-        return f"DeepSeek Error: {e}"
-
-
-# --- 5. Funciones Auxiliares ---
-def log_conversation(prompt, responses, mode="comparacion"):
-    """Guarda la conversación en un archivo de log."""
-    log_file_path = "conversation_log.txt"
-    with open(log_file_path, "a", encoding="utf-8") as f:
-        timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        f.write(f"--- Consulta ({mode.upper()}) {timestamp} ---\n")
-        f.write(f"Pregunta Inicial: {prompt}\n\n")
-
-        if mode == "comparacion":
-            for ia_name, response_text in responses.items():
-                f.write(f"--- {ia_name} ---\n")
-                f.write(textwrap.fill(response_text, width=80) + "\n")
-                f.write(f"Longitud: {len(response_text)} caracteres\n")
-                f.write(f"{'-' * 30}\n\n")
-        elif mode == "encadenada":
-            for i, step in enumerate(responses):
-                f.write(f"--- Paso {i+1}: {step['ia_name']} ---\n")
-                f.write(f"Prompt enviado: {textwrap.fill(step['prompt_sent'], width=80)}\n")
-                f.write(f"Respuesta: {textwrap.fill(step['response_text'], width=80)}\n")
-                f.write(f"Longitud: {len(step['response_text'])} caracteres\n")
-                f.write(f"{'-' * 30}\n\n")
-
-        f.write("=" * 60 + "\n\n")
-    print(f"Conversación guardada en {log_file_path}")
+# Los avisos de los módulos (proveedor configurado, paso que pasa a una reserva...) van por logging
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"), format="%(levelname)s: %(message)s")
+
+# --- 2. Proveedores de IA ---
+# Gemini, OpenAI, Claude y DeepSeek se configuran en providers.py (el mismo registro que usa
+# la app web). Los SDK se importan y los clientes se crean en la primera consulta, así que
+# el menú aparece al instante.
+from providers import PROVIDERS, active_providers, read_model_cache
+# call_provider() usa la caché de respuestas y el planificador de cada proveedor, y format_error()
+# da el texto de sus errores. Con CASSETTE_MODE=replay las IAs responden desde un cassette
+# grabado (ver cassettes.py), sin claves ni red
+from cassettes import CASSETTE_MODE, CASSETTE_PATH
+from ai_core import (
+    call_provider, format_error, run_race_mode, run_auto_mode, compile_preset, compact_context, call_step, step_providers, StepError,
+    build_step_prompt,
+)
+# Los presets se ejecutan como grafos: los pasos independientes corren a la vez
+from workflow import run_workflow
+# Sesión de varios turnos: las IAs ven las preguntas y respuestas anteriores de esta ejecución.
+# Con CLI_SESSION_ID (y SESSION_SPILL_DIR) se puede retomar una conversación de otra ejecución.
+from sessions import session_store
+
+
+# --- 3. Funciones Auxiliares ---
+def log_conversation(prompt, responses, mode="comparacion", session_id=None):
+    """Encola la conversación; el hilo de conversation_logger la escribe en JSONL en segundo plano."""
+    conversation_logger.log({
+        "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+        "source": "cli",
+        "session_id": session_id,
+        "mode": mode,
+        "prompt": prompt,
+        "responses": responses,
+    })
 
 # --- Definición de Presets de Flujo de Trabajo (¡ACTUALIZADO!) ---
 WORKFLOW_PRESETS = {
@@ -246,12 +93,50 @@ WORKFLOW_PRESETS = {
             }
         ]
     },
+    "4": {
+        "description": "Borrador y Revisión en Paralelo: Gemini redacta, OpenAI y Claude critican a la vez, Gemini fusiona.",
+        # Cada respuesta de más de 1200 tokens se resume antes de pasarla al paso siguiente
+        # (también vale "head", "tail" o "section" con "section": "<título>")
+        "context_budget": 1200,
+        "compaction": "summary",
+        # En lugar de "chain", "steps": cada paso declara de qué pasos depende ("depends_on").
+        # Las dos críticas dependen solo del borrador, así que se piden a la vez.
+        "steps": [
+            {
+                "id": "borrador",
+                "ia_name": "gemini",
+                "system_instruction": "Eres un redactor claro y bien documentado. Tu objetivo es dar una primera respuesta completa.",
+                "task_description": "Responde a la pregunta inicial con un primer borrador completo y bien estructurado."
+            },
+            {
+                "id": "critica_openai",
+                "ia_name": "openai",
+                "depends_on": ["borrador"],
+                "system_instruction": "Eres un revisor riguroso. Tu objetivo es detectar errores de contenido.",
+                "task_description": "Señala errores, afirmaciones dudosas y omisiones importantes del borrador."
+            },
+            {
+                "id": "critica_claude",
+                "ia_name": "claude",
+                "depends_on": ["borrador"],
+                "system_instruction": "Eres un editor exigente. Tu objetivo es mejorar la claridad del texto.",
+                "task_description": "Señala qué partes del borrador son confusas, redundantes o mejorables y cómo reescribirlas."
+            },
+            {
+                "id": "sintesis",
+                "ia_name": "gemini",
+                "depends_on": ["borrador", "critica_openai", "critica_claude"],
+                "system_instruction": "Eres un editor jefe que integra revisiones. Tu objetivo es entregar la versión final.",
+                "task_description": "Reescribe el borrador incorporando las críticas pertinentes. Devuelve solo la versión final."
+            }
+        ]
+    },
     # Puedes añadir más presets aquí.
 }
 
 
-# --- 6. Función para el Modo de Conversación Encadenada ---
-async def run_chained_conversation():
+# --- 4. Función para el Modo de Conversación Encadenada ---
+async def run_chained_conversation(session_id):
     print("\n--- Modo de Conversación Encadenada ---")
     print("Elige un flujo de trabajo predefinido para encadenar las IAs.")
 
@@ -273,114 +158,167 @@ async def run_chained_conversation():
         else:
             print("Selección inválida. Por favor, elige un número de preset válido.")
 
-    chain_definition = selected_preset["chain"]
-    
-    available_ais_info = {
-        "gemini": {"func": get_gemini_response, "active": bool(gemini_model)},
-        "openai": {"func": get_openai_response, "active": bool(openai_client)},
-        # "claude": {"func": get_claude_response, "active": bool(claude_client)},
-        # "deepseek": {"func": get_deepseek_response, "active": bool(deepseek_client)},
-    }
+    chain_definition = compile_preset(selected_preset)
+    upstream = {dep for step in chain_definition for dep in step["depends_on"]}
 
-    # Verificar que todas las IA en el preset seleccionado estén activas
+    # Verificar que cada paso del preset tenga una IA activa (la suya o una de reserva)
     for step in chain_definition:
-        ia_name = step["ia_name"]
-        if ia_name not in available_ais_info or not available_ais_info[ia_name]["active"]:
-            print(f"Error: La IA '{ia_name}' requerida por este preset no está configurada o activa. Volviendo al menú principal.")
+        if not step_providers(step):
+            print(f"Error: La IA '{step['ia_name']}' requerida por este preset no está configurada o activa. Volviendo al menú principal.")
             return
 
     initial_prompt = input("\nDame el prompt inicial para este flujo de trabajo: ")
-    max_turns = len(chain_definition) # El número de turnos es el número de pasos en la cadena definida
 
-    current_context = initial_prompt
     full_conversation_log = []
 
     print("\n--- Iniciando Conversación Encadenada ---")
     print(f"Pregunta inicial: {textwrap.fill(initial_prompt, width=80)}")
 
-    for i, step_config in enumerate(chain_definition):
-        if i >= max_turns:
-            print("\n--- Máximo de turnos alcanzado. Finalizando cadena. ---")
-            break
-
+    async def run_step(step_config, inputs):
         ia_name = step_config["ia_name"]
         ia_system_instruction = step_config["system_instruction"] # NUEVO: La instrucción de sistema/persona
         ia_task_description = step_config["task_description"]     # NUEVO: La descripción de la tarea específica
-        ia_func = available_ais_info[ia_name]["func"]
-
-        # Construir el prompt para la IA actual
-        # Ahora el prompt principal se enfoca en la pregunta del usuario y el contexto,
-        # y la "tarea_específica" le dice qué hacer con eso.
-        prompt_for_current_ia = (
-            f"PREGUNTA INICIAL DEL USUARIO: '{initial_prompt}'\n\n"
-            f"CONTEXTO PREVIO Y RESPUESTA ANTERIOR:\n{current_context}\n\n"
-            f"TU TAREA ES: {ia_task_description}\n\n"
-            "Genera tu respuesta o análisis."
-        )
-
-        print(f"\n=== Paso {i + 1}: {ia_name.upper()} (Tarea: {ia_task_description}) ===") # Muestra la tarea en el output
-        print(f"Prompt enviado: '{textwrap.shorten(prompt_for_current_ia, width=100, placeholder='...')}'")
-
-        # Se pasa la 'system_instruction' como system_prompt a la función de la IA
-        response_text = await ia_func(prompt_for_current_ia, system_prompt=ia_system_instruction) 
 
+        # Cada paso recibe solo las respuestas de los pasos de los que depende (y la pregunta inicial
+        # solo si el preset lo pide con "include_prompt"), con el mismo prompt que la API. Los pasos
+        # iniciales reciben también los turnos recientes de la sesión.
+        prompt_for_current_ia = build_step_prompt(initial_prompt, step_config, inputs, session_id)
+
+        # Se pasa la 'system_instruction' como system_prompt a la función de la IA; si su IA falla
+        # (o tiene el circuito abierto), responde la primera de reserva ("fallback") que funcione
+        try:
+            provider, response_text = await call_step(step_config, prompt_for_current_ia, ia_system_instruction)
+            ia_name = provider.name
+        except StepError as e:
+            # Un error nunca se pasa como contexto: los pasos que dependen de este no se ejecutan
+            print(f"\n=== Paso {step_config['step']}: {e.provider.name.upper()} (Tarea: {ia_task_description}) ===")
+            print(textwrap.fill(str(e), width=80))
+            print("-" * 40)
+            full_conversation_log.append({
+                "step": step_config["step"],
+                "ia_name": e.provider.name,
+                "prompt_sent": prompt_for_current_ia,
+                "response_text": str(e),
+                "error": True
+            })
+            raise
+
+        # Los pasos paralelos se imprimen según terminan
+        print(f"\n=== Paso {step_config['step']}: {ia_name.upper()} (Tarea: {ia_task_description}) ===") # Muestra la tarea en el output
+        print(f"Prompt enviado: '{textwrap.shorten(prompt_for_current_ia, width=100, placeholder='...')}'")
         print(f"Respuesta de {ia_name.upper()}:\n{textwrap.fill(response_text, width=80)}")
         print(f"Longitud: {len(response_text)} caracteres")
+
+        # Lo que se pasa a los pasos siguientes se ajusta al presupuesto de tokens del preset
+        passed_text = response_text
+        if step_config["id"] in upstream:
+            passed_text, compacted = await compact_context(response_text, step_config)
+            if compacted:
+                print(f"Contexto para el siguiente paso compactado ({compacted}): {len(passed_text)} caracteres")
         print("-" * 40)
 
         full_conversation_log.append({
+            "step": step_config["step"],
             "ia_name": ia_name,
             "prompt_sent": prompt_for_current_ia,
             "response_text": response_text
         })
-        current_context = response_text
-
-        if i == len(chain_definition) - 1:
-            print("\n--- Todas las IAs de la cadena definida han respondido. Finalizando cadena. ---")
-            break
+        return passed_text
+
+    _, failed = await run_workflow(chain_definition, run_step)
+    full_conversation_log.sort(key=lambda entry: entry["step"])
+    logged_steps = {entry["step"] for entry in full_conversation_log}
+    blocked = [step for step in chain_definition if step["id"] in failed and step["step"] not in logged_steps]
+    for step in blocked:
+        print(f"\nPaso {step['step']} ({step['ia_name'].upper()}) no ejecutado: depende de un paso que falló.")
+    # En la sesión queda como respuesta la de los pasos finales (los que no alimentan a ningún otro) que respondieron
+    final_steps = {step["step"] for step in chain_definition if step["id"] not in upstream}
+    final_answer = "\n\n".join(entry["response_text"] for entry in full_conversation_log
+                                 if entry["step"] in final_steps and not entry.get("error"))
+    session_store.append(session_id, initial_prompt, [(None, final_answer)] if final_answer else [])
+    if failed:
+        print("\n--- La cadena terminó con pasos fallidos o no ejecutados. ---")
+    else:
+        print("\n--- Todas las IAs de la cadena definida han respondido. Finalizando cadena. ---")
 
     print("\n--- Conversación Encadenada Finalizada ---")
-    log_conversation(initial_prompt, full_conversation_log, mode="encadenada")
+    log_conversation(initial_prompt, full_conversation_log, mode="encadenada", session_id=session_id)
     print("Volviendo al menú principal.")
 
 
-# --- 7. Función Principal de Ejecución (Asíncrona) ---
+# --- 5. Función para el Modo Carrera ---
+async def run_race_conversation(session_id):
+    print("\n--- Modo Carrera ---")
+    user_prompt = input("Tu pregunta para las IAs (Modo Carrera): ")
+    if user_prompt.lower() == 'salir':
+        return
+    strategy = input("¿Todas a la vez (1) o con petición de cobertura tras un umbral de latencia (2)? [1]: ").strip()
+    strategy = "hedged" if strategy == '2' else "all"
+
+    print("\n--- Esperando la primera respuesta válida ---")
+    # run_race_mode registra la conversación (modo "carrera") por sí mismo
+    result = await run_race_mode(user_prompt, strategy=strategy, session_id=session_id)
+    for ia_name, response_text in result.items():
+        if ia_name.startswith("_"):
+            continue  # metadatos ("_usage"), no respuestas
+        print(f"\n--- {ia_name} ---")
+        print(textwrap.fill(response_text, width=80))
+        print(f"Longitud: {len(response_text)} caracteres")
+        print("-" * 30)
+
+
+# --- 5b. Función para el Modo Automático ---
+async def run_auto_conversation(session_id):
+    print("\n--- Modo Automático ---")
+    user_prompt = input("Tu pregunta (la responderá la IA sana más rápida): ")
+    if user_prompt.lower() == 'salir':
+        return
+
+    # run_auto_mode elige el proveedor según su latencia y errores recientes y registra la conversación
+    result = await run_auto_mode(user_prompt, session_id=session_id)
+    for ia_name, response_text in result.items():
+        if ia_name.startswith("_"):
+            continue  # metadatos ("_usage"), no respuestas
+        print(f"\n--- {ia_name} ---")
+        print(textwrap.fill(response_text, width=80))
+        print(f"Longitud: {len(response_text)} caracteres")
+        print("-" * 30)
+
+
+# --- 6. Función Principal de Ejecución (Asíncrona) ---
 async def main():
     print("===================================")
     print("  Bienvenido a tu Multi-AI Communicator  ")
     print("===================================")
     print("Escribe 'salir' para terminar en cualquier momento.")
 
+    # Solo se comprueban las claves: la conexión real se hace en la primera consulta
     print("\n--- Estado de Configuración ---")
-    if gemini_model:
-        print(f"✔️ Gemini: Listo (Modelo: {gemini_model.model_name})")
-    else:
-        print("❌ Gemini: No disponible")
-
-    if openai_client:
-        print("✔️ OpenAI: Listo (Modelo: gpt-3.5-turbo)")
-    else:
-        print("❌ OpenAI: No disponible")
-
-    if claude_client:
-        print("✔️ Claude: Listo")
-    else:
-        print("❌ Claude: No disponible (API Key no encontrada o error de configuración)")
-
-    if deepseek_client:
-        print("✔️ DeepSeek: Listo")
-    else:
-        print("❌ DeepSeek: No disponible (API Key no encontrada o error de configuración)")
+    if CASSETTE_MODE == "replay":
+        print(f"Reproduciendo respuestas grabadas de {CASSETTE_PATH}")
+    elif CASSETTE_MODE == "record":
+        print(f"Grabando las respuestas en {CASSETTE_PATH}")
+    for provider in PROVIDERS.values():
+        if provider.has_key:
+            model = provider.model_name or read_model_cache(provider.name) or 'se elegirá en la primera consulta'
+            print(f"✔️ {provider.label}: Listo (Modelo: {model})")
+        else:
+            print(f"❌ {provider.label}: No disponible ({'sin grabaciones' if CASSETTE_MODE == 'replay' else 'API Key no encontrada'})")
     print("===================================")
 
+    session_id = os.getenv("CLI_SESSION_ID") or uuid.uuid4().hex
+    print(f"Sesión: {session_id}")
 
     while True:
         print("\nElige un modo:")
         print("1. Modo de Comparación Directa (Mismo Prompt a todas las IA)")
         print("2. Modo de Conversación Encadenada (IA se pasan la respuesta)")
+        print("3. Modo Carrera (la primera respuesta válida gana, el resto se cancela)")
+        print("4. Modo Automático (responde la IA sana más rápida)")
+        print("5. Nueva conversación (las IAs olvidan las preguntas anteriores)")
         print("   (Escribe 'salir' para terminar)")
 
-        mode_choice = input("Selecciona un modo (1 o 2): ").strip()
+        mode_choice = input("Selecciona un modo (1, 2, 3, 4 o 5): ").strip()
         if mode_choice.lower() == 'salir':
             print("¡Hasta luego!")
             break
@@ -393,19 +331,22 @@ async def main():
 
             print("\n--- Obteniendo respuestas (Modo Comparación) ---")
 
-            gemini_task = asyncio.create_task(get_gemini_response(user_prompt))
-            openai_task = asyncio.create_task(get_openai_response(user_prompt))
-            # claud_task = asyncio.create_task(get_claude_response(user_prompt))
-            # deepseek_task = asyncio.create_task(get_deepseek_response(user_prompt))
-
-            responses_list = await asyncio.gather(gemini_task, openai_task)
-
-            all_responses = {
-                "Gemini": responses_list[0],
-                "OpenAI (ChatGPT)": responses_list[1],
-                # "Anthropic (Claude)": responses_list[2],
-                # "DeepSeek": responses_list[3],
-            }
+            providers = active_providers()
+            if not providers:
+                print("Ninguna IA está configurada.")
+                continue
+            # Cada IA recibe la pregunta precedida de sus turnos recientes en la sesión
+            async def ask(provider):
+                try:
+                    return await call_provider(provider, session_store.build_prompt(session_id, provider.name, user_prompt)), False
+                except Exception as e:
+                    return format_error(provider, e), True
+
+            responses_list = await asyncio.gather(*(ask(p) for p in providers))
+            all_responses = {p.label: text for p, (text, _) in zip(providers, responses_list)}
+            # Los errores se muestran, pero no entran en la sesión como respuestas de las IAs
+            session_store.append(session_id, user_prompt,
+                                 [(p.name, text) for p, (text, failed) in zip(providers, responses_list) if not failed])
 
             print("\n================================")
             print("  Respuestas Recibidas (Modo Comparación) ")
@@ -416,17 +357,28 @@ async def main():
                 print(f"Longitud: {len(response_text)} caracteres")
                 print("-" * 30)
 
-            log_conversation(user_prompt, all_responses, mode="comparacion")
+            log_conversation(user_prompt, all_responses, mode="comparacion", session_id=session_id)
             print("\n==============================")
             print("  Comparación Finalizada  ")
             print("==============================")
 
         elif mode_choice == '2':
-            await run_chained_conversation()
+            await run_chained_conversation(session_id)
+
+        elif mode_choice == '3':
+            await run_race_conversation(session_id)
+
+        elif mode_choice == '4':
+            await run_auto_conversation(session_id)
+
+        elif mode_choice == '5':
+            session_store.delete(session_id)
+            session_id = uuid.uuid4().hex
+            print(f"Nueva sesión: {session_id}")
 
         else:
-            print("Opción no válida. Por favor, elige '1', '2' o 'salir'.")
+            print("Opción no válida. Por favor, elige '1', '2', '3', '4', '5' o 'salir'.")
 
-# --- 8. Punto de entrada del script (Ejecución Asíncrona) ---
+# --- 7. Punto de entrada del script (Ejecución Asíncrona) ---
 if __name__ == "__main__":
     asyncio.run(main())
\ No newline at end of file
@@ -0,0 +1,390 @@
+# metrics.py
+# Métricas del proceso en formato de texto de Prometheus (lo sirve la ruta /metrics de app.py) y
+# ganchos opcionales de trazas alrededor de cada llamada a un proveedor.
+#
+# Sin dependencias: contadores e histogramas propios, protegidos por un lock porque se actualizan
+# desde el bucle de ai_core y se leen desde los hilos de Flask. Las métricas que ya llevan otros
+# componentes (caché, planificador...) se exponen con callbacks que las leen al renderizar.
+#
+# Varios procesos: con METRICS_MULTIPROC_DIR (lo fija gunicorn.conf.py) cada worker vuelca sus
+# valores cada METRICS_FLUSH_INTERVAL segundos en <dir>/<pid>.json y /metrics, lo atienda el worker
+# que lo atienda, los combina según el multiprocess_mode de cada métrica: "sum" (contadores e
+# histogramas), "max" / "min", o "pid" (una serie por worker, con la etiqueta pid; por defecto en los
+# gauges, porque sumar latencias medias o estados no tiene sentido). Los contadores de un worker que
+# termina pasan a dead.json para no perderse; sus métricas de callback (colas en vuelo, etc.) se descartan.
+# El volcado no empieza al importar (el maestro de gunicorn importa la app y no debe aparecer como un
+# worker más): lo arranca cada proceso que atiende tráfico (ai_core, al crear su bucle) con store.start().
+#
+# Trazas: add_span_hook(hook) registra una función hook(nombre, atributos) que devuelve un gestor
+# de contexto; con OpenTelemetry basta con
+#   add_span_hook(lambda name, attrs: tracer.start_as_current_span(name, attributes=attrs))
+
+import os
+import json
+import glob
+import atexit
+import logging
+import threading
+from contextlib import contextmanager, ExitStack
+
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)  # segundos
+METRICS_MULTIPROC_DIR = os.getenv("METRICS_MULTIPROC_DIR")
+METRICS_FLUSH_INTERVAL = float(os.getenv("METRICS_FLUSH_INTERVAL", 1.0))  # segundos
+MULTIPROCESS_MODES = ("sum", "max", "min", "pid")
+
+logger = logging.getLogger(__name__)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values)) + (list(extra.items()) if extra else [])
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    type = "counter"
+    multiprocess_mode = "sum"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels.get(label, "")) for label in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(tuple(str(labels.get(label, "")) for label in self.labels), 0)
+
+    def samples(self):
+        with self._lock:
+            return dict(self._values)
+
+    def reset(self):
+        with self._lock:
+            self._values = {}
+
+    @staticmethod
+    def merge(total, value):
+        return total + value
+
+    def render(self, samples=None):
+        values = self.samples() if samples is None else samples
+        return [f"{self.name}{_format_labels(self.labels, key)} {_format_value(v)}" for key, v in sorted(values.items())]
+
+
+class Histogram:
+    type = "histogram"
+    multiprocess_mode = "sum"
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        self._series = {}  # etiquetas -> [cuentas por cubo..., suma, total]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(label, "")) for label in self.labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+                    break
+            series[-2] += value
+            series[-1] += 1
+
+    def samples(self):
+        with self._lock:
+            return {key: list(values) for key, values in self._series.items()}
+
+    def reset(self):
+        with self._lock:
+            self._series = {}
+
+    @staticmethod
+    def merge(total, values):
+        return [a + b for a, b in zip(total, values)]
+
+    def render(self, samples=None):
+        series = self.samples() if samples is None else samples
+        lines = []
+        for key, values in sorted(series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, values):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, {'le': _format_value(bound)})} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {_format_value(round(values[-2], 6))}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {values[-1]}")
+        return lines
+
+
+class CallbackMetric:
+    """Métrica leída en el momento de renderizar: fn() devuelve una lista de (dict de etiquetas, valor)."""
+
+    def __init__(self, name, help, type, fn, multiprocess_mode=None):
+        if multiprocess_mode not in (None, *MULTIPROCESS_MODES):
+            raise ValueError(f"multiprocess_mode no válido: {multiprocess_mode}")
+        self.name = name
+        self.help = help
+        self.type = type
+        self.fn = fn
+        self.multiprocess_mode = multiprocess_mode or ("sum" if type == "counter" else "pid")
+
+    def samples(self):
+        return {tuple(labels.items()): value for labels, value in self.fn()}
+
+    def reset(self):
+        pass  # los valores los lleva el componente que se lee
+
+    def merge(self, total, value):
+        if self.multiprocess_mode == "max":
+            return max(total, value)
+        if self.multiprocess_mode == "min":
+            return min(total, value)
+        return total + value  # "sum" ("pid" no llega a combinar: cada worker tiene su serie)
+
+    def render(self, samples=None):
+        if samples is None:
+            try:
+                samples = self.samples()
+            except Exception as e:
+                return [f"# error al leer {self.name}: {_escape(e)}"]
+        return [f"{self.name}{_format_labels([k for k, _ in key], [v for _, v in key])} {_format_value(value)}"
+                for key, value in samples.items()]
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+        self.store = None  # MultiProcessStore, si hay varios procesos
+
+    def _register(self, metric):
+        with self._lock:
+            # Registrar dos veces el mismo nombre devuelve la métrica existente (p. ej. al recargar módulos)
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, help, labels=()):
+        return self._register(Counter(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, help, labels, buckets))
+
+    def callback(self, name, help, type, fn, multiprocess_mode=None):
+        return self._register(CallbackMetric(name, help, type, fn, multiprocess_mode))
+
+    def snapshot(self):
+        """Valores de todas las métricas del proceso: nombre -> {etiquetas: valor}."""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        snapshot = {}
+        for metric in metrics:
+            try:
+                snapshot[metric.name] = metric.samples()
+            except Exception as e:
+                logger.warning("No se pudo leer la métrica %s: %s", metric.name, e)
+        return snapshot
+
+    def reset(self):
+        """Pone a cero contadores e histogramas (en un worker recién creado, que los hereda del padre)."""
+        with self._lock:
+            for metric in self._metrics.values():
+                metric.reset()
+
+    def enable_multiprocess(self, directory, flush_interval=METRICS_FLUSH_INTERVAL):
+        self.store = MultiProcessStore(self, directory, flush_interval)
+        return self.store
+
+    def render(self):
+        """Todas las métricas en el formato de exposición de texto de Prometheus (0.0.4)."""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        merged = self.store.collect() if self.store else None
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(metric.render(merged.get(metric.name, {}) if merged is not None else None))
+        return "\n".join(lines) + "\n"
+
+
+def _encode(snapshot):
+    return {name: [[list(key), value] for key, value in samples.items()] for name, samples in snapshot.items()}
+
+def _decode(data):
+    # Las etiquetas de los callbacks son pares (nombre, valor): listas anidadas en el JSON
+    return {name: {tuple(tuple(part) if isinstance(part, list) else part for part in key): value for key, value in samples}
+            for name, samples in data.items()}
+
+
+class MultiProcessStore:
+    """Métricas compartidas entre procesos a través de un directorio (un archivo JSON por proceso)."""
+
+    DEAD_FILE = "dead.json"
+
+    def __init__(self, registry, directory, flush_interval=METRICS_FLUSH_INTERVAL):
+        self.registry = registry
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, pid):
+        return os.path.join(self.directory, f"{pid}.json")
+
+    def start(self):
+        # Un hilo por proceso: tras un fork el del padre no existe en el hijo
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread is None or self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, name="metrics-flusher", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        stop = threading.Event()
+        while not stop.wait(self.flush_interval):
+            self.flush()
+
+    def flush_on_exit(self):
+        # Solo si este proceso llegó a volcar: el maestro no deja un <pid>.json al salir
+        if self._pid == os.getpid():
+            self.flush()
+
+    def flush(self):
+        """Escribe los valores de este proceso (escritura atómica: otros procesos leen a la vez)."""
+        path = self._path(os.getpid())
+        try:
+            _write_json(path, _encode(self.registry.snapshot()))
+        except OSError as e:
+            logger.warning("No se pudieron guardar las métricas: %s", e)
+
+    def _read(self, path):
+        try:
+            with open(path, encoding="utf-8") as f:
+                return _decode(json.load(f))
+        except (OSError, ValueError):
+            return {}
+
+    def collect(self):
+        """Valores de todos los procesos combinados según el multiprocess_mode de cada métrica: los de
+        este, en vivo; los demás, de sus archivos."""
+        self.start()
+        own = self._path(os.getpid())
+        snapshots = [(str(os.getpid()), self.registry.snapshot())]
+        for path in glob.glob(os.path.join(self.directory, "*.json")):
+            if path != own:
+                snapshots.append((os.path.basename(path)[:-len(".json")], self._read(path)))
+        merged = {}
+        for pid, snapshot in snapshots:
+            for name, samples in snapshot.items():
+                metric = self.registry._metrics.get(name)
+                if metric is None:
+                    continue
+                total = merged.setdefault(name, {})
+                for key, value in samples.items():
+                    if metric.multiprocess_mode == "pid":
+                        key = key + (("pid", pid),)
+                    total[key] = metric.merge(total[key], value) if key in total else value
+        return merged
+
+    def mark_process_dead(self, pid):
+        """Acumula en dead.json los contadores e histogramas de un proceso terminado y borra su archivo.
+        Lo llama un único proceso (el maestro de gunicorn, en child_exit)."""
+        path = self._path(pid)
+        samples = self._read(path)
+        if not samples:
+            return
+        dead_path = os.path.join(self.directory, self.DEAD_FILE)
+        dead = self._read(dead_path)
+        for name, values in samples.items():
+            metric = self.registry._metrics.get(name)
+            if metric is None or isinstance(metric, CallbackMetric):
+                continue
+            total = dead.setdefault(name, {})
+            for key, value in values.items():
+                total[key] = metric.merge(total[key], value) if key in total else value
+        try:
+            _write_json(dead_path, _encode(dead))
+            os.remove(path)
+        except OSError as e:
+            logger.warning("No se pudieron archivar las métricas del proceso %s: %s", pid, e)
+
+
+def _write_json(path, data):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+def clear_multiprocess_dir(directory):
+    """Borra los archivos de una ejecución anterior (se llama una vez, al arrancar el servidor)."""
+    for path in glob.glob(os.path.join(directory, "*.json")):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+registry = MetricsRegistry()
+
+if METRICS_MULTIPROC_DIR:
+    registry.enable_multiprocess(METRICS_MULTIPROC_DIR)
+    atexit.register(registry.store.flush_on_exit)
+
+def _after_fork():
+    # Un lock tomado por un hilo del padre (p. ej. el que vuelca las métricas) quedaría tomado para siempre
+    registry._lock = threading.Lock()
+    for metric in registry._metrics.values():
+        if hasattr(metric, "_lock"):
+            metric._lock = threading.Lock()
+    # El hijo hereda los valores del padre, que ya cuentan en el archivo del padre: empieza de cero
+    if registry.store:
+        registry.store._lock = threading.Lock()
+        registry.reset()
+
+os.register_at_fork(after_in_child=_after_fork)
+
+
+# --- Trazas ---
+_span_hooks = []
+
+def add_span_hook(hook):
+    _span_hooks.append(hook)
+    return hook
+
+def remove_span_hook(hook):
+    if hook in _span_hooks:
+        _span_hooks.remove(hook)
+
+@contextmanager
+def span(name, **attributes):
+    """Abre un span en cada gancho registrado. Sin ganchos no cuesta nada."""
+    if not _span_hooks:
+        yield
+        return
+    with ExitStack() as stack:
+        for hook in list(_span_hooks):
+            stack.enter_context(hook(name, attributes))
+        yield
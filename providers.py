@@ -0,0 +1,621 @@
+# providers.py
+# Registro de proveedores de IA. Cada proveedor implementa la misma interfaz (ProviderAdapter)
+# y se registra con register_provider(); tanto ai_core.py (Flask) como main.py (CLI) los
+# resuelven por nombre ("gemini", "openai", ...), así que añadir un modelo nuevo es añadir
+# una clase aquí.
+#
+# Los SDK se importan y los clientes se crean en el primer uso (importar este módulo no
+# toca la red). Los clientes HTTP de OpenAI, DeepSeek y Anthropic comparten un único pool
+# de conexiones keep-alive, de modo que las llamadas reutilizan las conexiones TLS abiertas.
+#
+# La instrucción de sistema (fija en cada paso de un preset) va siempre como primer bloque y
+# sin modificar, para que el proveedor pueda reutilizar el prefijo ya procesado: Gemini la recibe
+# como system_instruction (o como caché de contexto explícita si es lo bastante larga), Claude
+# con cache_control y OpenAI con prompt_cache_key.
+#
+# complete() y stream() aceptan un límite de tokens de salida (max_tokens) que se traduce al
+# parámetro de cada API, y un dict "usage" que el adaptador rellena con los tokens que informa el
+# proveedor: input_tokens, output_tokens y cached_tokens (los del prompt leídos de su caché).
+#
+# Con un servidor que hace fork (gunicorn con preload_app, ver gunicorn.conf.py) el proceso padre
+# solo lee la configuración (prepare_providers: claves y modelos del entorno o de la caché en disco),
+# sin crear clientes: un canal gRPC abierto antes del fork no es seguro en los hijos. Cada hijo crea
+# los suyos (y descubre el modelo si hace falta) al calentarse, y descarta por si acaso los clientes
+# y el pool HTTP heredados.
+
+import os
+import json
+import time
+import asyncio
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from dotenv import load_dotenv
+
+from compaction import count_tokens
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# --- 1. CACHÉ EN DISCO DEL MODELO ELEGIDO ---
+# Evita repetir genai.list_models() en cada arranque
+MODEL_CACHE_PATH = os.getenv("MODEL_CACHE_PATH", ".model_cache.json")
+MODEL_CACHE_TTL = int(os.getenv("MODEL_CACHE_TTL", 24 * 3600))  # segundos
+
+def read_model_cache(provider):
+    """Devuelve el modelo guardado para el proveedor, o None si no hay caché o ha caducado."""
+    try:
+        with open(MODEL_CACHE_PATH, encoding="utf-8") as f:
+            entry = json.load(f).get(provider)
+    except (OSError, ValueError):
+        return None
+    if not entry or time.time() - entry.get("resolved_at", 0) > MODEL_CACHE_TTL:
+        return None
+    return entry.get("model")
+
+def write_model_cache(provider, model_name):
+    try:
+        with open(MODEL_CACHE_PATH, encoding="utf-8") as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        cache = {}
+    cache[provider] = {"model": model_name, "resolved_at": time.time()}
+    # Escritura atómica: varios procesos pueden arrancar a la vez
+    tmp_path = f"{MODEL_CACHE_PATH}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(cache, f)
+        os.replace(tmp_path, MODEL_CACHE_PATH)
+    except OSError as e:
+        logger.warning("No se pudo guardar la caché de modelos: %s", e)
+
+
+# --- 2. POOL HTTP COMPARTIDO ---
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", 200))
+HTTP_MAX_KEEPALIVE = int(os.getenv("HTTP_MAX_KEEPALIVE", 50))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", 120))  # segundos
+
+_http_client = None
+_http_lock = threading.Lock()
+
+def get_shared_http_client():
+    """httpx.AsyncClient único del proceso; lo comparten todos los adaptadores basados en HTTP."""
+    global _http_client
+    with _http_lock:
+        if _http_client is None:
+            import httpx
+            _http_client = httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=HTTP_MAX_CONNECTIONS,
+                    max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+                    keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+                ),
+                timeout=httpx.Timeout(600.0, connect=10.0),
+            )
+        return _http_client
+
+
+# --- 3. CACHÉ DE PREFIJOS EN EL PROVEEDOR ---
+# Handles de cachés de contexto creadas en el proveedor (p. ej. CachedContent de Gemini), con
+# su caducidad. El proveedor las borra solo al expirar; aquí se recuerda cuáles siguen vivas
+# para no crear otra en cada llamada y se renuevan un poco antes de que caduquen.
+PREFIX_CACHE_MAX_ENTRIES = int(os.getenv("PREFIX_CACHE_MAX_ENTRIES", 256))
+PREFIX_CACHE_RENEW_MARGIN = 60    # segundos antes de caducar en los que ya no se usa un handle
+PREFIX_CACHE_RETRY_AFTER = 600    # segundos sin reintentar tras no poder crear una caché
+
+def prefix_key(*parts):
+    return hashlib.sha256("\x00".join(str(p) for p in parts).encode("utf-8")).hexdigest()
+
+class PrefixCacheRegistry:
+    def __init__(self, max_entries=PREFIX_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # clave -> (handle o None si falló, caduca_en)
+        self._creating = {}            # clave -> futuro, para no crear dos veces la misma caché
+        self.counters = {"hits": 0, "creates": 0, "expired": 0, "errors": 0}
+
+    async def get_or_create(self, key, create, ttl):
+        """Devuelve el handle vigente para 'key' o lo crea con 'await create()'. None si no se pudo crear."""
+        entry = self._entries.get(key)
+        now = time.time()
+        if entry and entry[1] - PREFIX_CACHE_RENEW_MARGIN > now:
+            self._entries.move_to_end(key)
+            if entry[0] is not None:
+                self.counters["hits"] += 1
+            return entry[0]
+        if entry:
+            self.counters["expired"] += 1
+            del self._entries[key]
+        if key in self._creating:
+            return await asyncio.shield(self._creating[key])
+
+        future = asyncio.get_running_loop().create_future()
+        self._creating[key] = future
+        try:
+            handle = await create()
+            self.counters["creates"] += 1
+            self._entries[key] = (handle, now + ttl)
+        except Exception as e:
+            # Prefijo demasiado corto, modelo sin soporte... se usa la vía normal un tiempo
+            logger.warning("No se pudo crear la caché de contexto: %s", e)
+            self.counters["errors"] += 1
+            handle = None
+            self._entries[key] = (None, now + PREFIX_CACHE_RETRY_AFTER)
+        finally:
+            del self._creating[key]
+            # También si cancelan a quien la creaba (plazo agotado, cliente desconectado): los que
+            # esperan reciben None y siguen por la vía normal en lugar de quedarse esperando para siempre
+            future.set_result(self._entries[key][0] if key in self._entries else None)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return handle
+
+    def stats(self):
+        return {**self.counters, "handles": sum(1 for handle, _ in self._entries.values() if handle is not None)}
+
+    def reset(self):
+        """Olvida los handles (y las creaciones en curso, ligadas al bucle del padre) tras un fork."""
+        self._entries = OrderedDict()
+        self._creating = {}
+
+prefix_cache = PrefixCacheRegistry()
+
+
+# --- 4. INTERFAZ COMÚN ---
+class ProviderResponseError(Exception):
+    """El proveedor respondió, pero sin texto utilizable (contenido bloqueado, sin candidatos...).
+    No se reintenta ni cuenta contra la salud del proveedor: repetir la petición no lo arregla."""
+
+def empty_response_error(reason=None):
+    """ProviderResponseError para una respuesta sin texto; reason es el motivo que dio el proveedor, si lo dio."""
+    message = "No se pudo obtener una respuesta textual (posiblemente contenido bloqueado o vacío)"
+    return ProviderResponseError(f"{message}: {reason}" if reason else f"{message}.")
+
+def fill_usage(usage, input_tokens, output_tokens, cached_tokens=0):
+    """Copia en 'usage' (si se pasó) los tokens informados por el proveedor."""
+    if usage is not None:
+        usage.update(input_tokens=input_tokens or 0, output_tokens=output_tokens or 0, cached_tokens=cached_tokens or 0)
+
+def mark_truncated(usage, truncated):
+    """Marca en 'usage' que la respuesta se cortó al llegar al límite de tokens de salida."""
+    if usage is not None and truncated:
+        usage["truncated"] = True
+
+class ProviderAdapter:
+    """Interfaz de un proveedor. Las subclases implementan _create_client(), complete() y stream().
+
+    complete() y stream() lanzan excepciones ante cualquier error; convertirlas en un
+    mensaje para el usuario es cosa de quien llama (ver ai_core.get_response)."""
+
+    name = None            # clave usada en los presets ("gemini", "openai", ...)
+    label = None           # nombre para mostrar ("Gemini", "OpenAI (ChatGPT)", ...)
+    short_name = None      # nombre corto para mensajes ("Gemini", "OpenAI", ...)
+    api_key_envs = ()      # variables de entorno donde buscar la API key, en orden
+    model_envs = ()        # ídem para el modelo; por defecto, <NAME>_MODEL
+    default_model = None   # modelo si no se indica ninguno (Gemini lo descubre: ver resolve_model_name)
+
+    def __init__(self):
+        envs = self.model_envs or (f"{self.name.upper()}_MODEL",)
+        self.model = next((os.getenv(env) for env in envs if os.getenv(env)), self.default_model)
+        self._client = None
+        self._configured = False
+        self._lock = threading.Lock()
+
+    @property
+    def api_key(self):
+        return next((os.getenv(env) for env in self.api_key_envs if os.getenv(env)), None)
+
+    @property
+    def has_key(self):
+        """Comprobación barata (sin red ni SDK) de si el proveedor puede usarse."""
+        return bool(self.api_key)
+
+    @property
+    def not_configured_message(self):
+        return f"{self.short_name} no configurado."
+
+    def get_client(self):
+        """Cliente del SDK, creado en el primer uso. None si el proveedor no está disponible."""
+        if self._configured:
+            return self._client
+        with self._lock:
+            if not self._configured:
+                if self.has_key:
+                    try:
+                        self._client = self._create_client()
+                        logger.info("%s configurado con éxito usando: %s", self.label, self.model_name)
+                    except Exception as e:
+                        logger.error("Error al configurar %s: %s", self.label, e)
+                else:
+                    logger.warning("%s no encontrada.", self.api_key_envs[0])
+                self._configured = True
+        return self._client
+
+    @property
+    def active(self):
+        return self.get_client() is not None
+
+    @property
+    def model_name(self):
+        return self.model
+
+    def reset_client(self):
+        """Descarta el cliente del SDK, que se vuelve a crear en el siguiente uso. El modelo ya resuelto
+        se conserva, así que no se repite el descubrimiento."""
+        self._client = None
+        self._configured = False
+        self._lock = threading.Lock()
+
+    async def warm_up(self, system_prompts=()):
+        """Prepara el adaptador antes de recibir tráfico (sin llamar al proveedor). True si está activo."""
+        return self.active
+
+    def _create_client(self):
+        raise NotImplementedError
+
+    async def complete(self, prompt, system_prompt=None, max_tokens=None, usage=None):
+        raise NotImplementedError
+
+    async def stream(self, prompt, system_prompt=None, max_tokens=None, usage=None):
+        raise NotImplementedError
+        yield  # pragma: no cover  (convierte el método en generador asíncrono)
+
+
+# --- 5. ADAPTADORES ---
+class GeminiAdapter(ProviderAdapter):
+    name = "gemini"
+    label = "Gemini"
+    short_name = "Gemini"
+    api_key_envs = ("GEMINI_API_KEY",)
+    # Lista de modelos preferidos en orden de preferencia
+    preferred_models = ['models/gemini-2.5-flash-lite']
+    # Caché de contexto explícita: solo para instrucciones de sistema de al menos este tamaño
+    # (la API rechaza prefijos más cortos; por debajo, Gemini aplica su caché implícita)
+    context_cache = os.getenv("GEMINI_CONTEXT_CACHE", "1") != "0"
+    context_cache_min_tokens = int(os.getenv("GEMINI_CONTEXT_CACHE_MIN_TOKENS", 1024))
+    context_cache_ttl = int(os.getenv("GEMINI_CONTEXT_CACHE_TTL", 3600))  # segundos
+    max_models = 64  # GenerativeModel por instrucción de sistema que se conservan
+
+    def __init__(self):
+        super().__init__()
+        self._genai = None
+        self._models = OrderedDict()  # instrucción de sistema -> GenerativeModel
+
+    @property
+    def not_configured_message(self):
+        return "Gemini no configurado o modelo no disponible."
+
+    def resolve_model_name(self, genai):
+        """Elige un modelo de Gemini disponible (usa la caché en disco si está vigente)."""
+        if self.model:
+            return self.model
+        cached = read_model_cache("gemini")
+        if cached:
+            return cached
+        # list_models() ya indica los métodos soportados: no hace falta un get_model() por candidato
+        available_models = [m.name for m in genai.list_models() if 'generateContent' in m.supported_generation_methods]
+        model_to_use = next((m for m in self.preferred_models if m in available_models), None)
+        if not model_to_use:
+            # Usar el primer Gemini disponible como último recurso
+            model_to_use = next((m for m in available_models if 'gemini' in m.lower()), None)
+        if model_to_use:
+            write_model_cache("gemini", model_to_use)
+        return model_to_use
+
+    def _create_client(self):
+        import google.generativeai as genai
+        genai.configure(api_key=self.api_key)
+        model_to_use = self.resolve_model_name(genai)
+        if not model_to_use:
+            raise RuntimeError("No se encontró ningún modelo de Gemini compatible.")
+        self.model = model_to_use
+        self._genai = genai
+        # El GenerativeModel mantiene su canal gRPC abierto y se reutiliza en todas las llamadas
+        return genai.GenerativeModel(model_to_use)
+
+    def reset_client(self):
+        super().reset_client()
+        self._genai = None
+        self._models = OrderedDict()
+
+    async def warm_up(self, system_prompts=()):
+        # Deja creados los GenerativeModel de las instrucciones de sistema conocidas (los de los presets)
+        if not self.active:
+            return False
+        for system_prompt in system_prompts:
+            if system_prompt not in self._models and len(self._models) < self.max_models:
+                self._models[system_prompt] = self._genai.GenerativeModel(self.model, system_instruction=system_prompt)
+        return True
+
+    async def _model_for(self, system_prompt):
+        """GenerativeModel con la instrucción de sistema como prefijo fijo (o su caché de contexto)."""
+        client = self.get_client()
+        if not system_prompt or self._genai is None:
+            return client
+        model = self._models.get(system_prompt)
+        if model is not None:
+            self._models.move_to_end(system_prompt)
+        if self.context_cache and count_tokens(system_prompt) >= self.context_cache_min_tokens:
+            cached_model = await prefix_cache.get_or_create(
+                prefix_key(self.name, self.model, system_prompt), lambda: self._create_context_cache(system_prompt),
+                self.context_cache_ttl)
+            if cached_model is not None:
+                return cached_model
+        if model is None:
+            model = self._models[system_prompt] = self._genai.GenerativeModel(self.model, system_instruction=system_prompt)
+            while len(self._models) > self.max_models:
+                self._models.popitem(last=False)
+        return model
+
+    async def _create_context_cache(self, system_prompt):
+        """Crea la caché de contexto en Gemini y devuelve un GenerativeModel ligado a ella."""
+        import datetime
+        from google.generativeai import caching
+        # El SDK solo ofrece la creación síncrona; es una llamada por prefijo y TTL
+        cached_content = await asyncio.to_thread(
+            caching.CachedContent.create, model=self.model, system_instruction=system_prompt,
+            ttl=datetime.timedelta(seconds=self.context_cache_ttl))
+        return self._genai.GenerativeModel.from_cached_content(cached_content=cached_content)
+
+    @staticmethod
+    def _generation_config(max_tokens):
+        return {"generation_config": {"max_output_tokens": max_tokens}} if max_tokens else {}
+
+    @staticmethod
+    def _fill_usage(usage, response):
+        metadata = getattr(response, "usage_metadata", None)
+        if metadata is not None:
+            fill_usage(usage, metadata.prompt_token_count, metadata.candidates_token_count,
+                       getattr(metadata, "cached_content_token_count", 0))
+
+    @staticmethod
+    def _chunk_text(response):
+        # response.text lanza ValueError si no hay partes de texto (contenido bloqueado o vacío)
+        candidates = getattr(response, "candidates", None)
+        if not candidates or not candidates[0].content.parts:
+            return ""
+        return "".join(getattr(part, "text", "") for part in candidates[0].content.parts)
+
+    @staticmethod
+    def _finish_reason(response):
+        candidates = getattr(response, "candidates", None)
+        reason = getattr(candidates[0], "finish_reason", None) if candidates else None
+        return getattr(reason, "name", reason)
+
+    @classmethod
+    def _empty_response_error(cls, response):
+        feedback = getattr(response, "prompt_feedback", None)
+        reason = getattr(feedback, "block_reason", None) if feedback is not None else None
+        return empty_response_error(getattr(reason, "name", reason) or cls._finish_reason(response))
+
+    async def complete(self, prompt, system_prompt=None, max_tokens=None, usage=None):
+        model = await self._model_for(system_prompt)
+        response = await model.generate_content_async(prompt, **self._generation_config(max_tokens))
+        self._fill_usage(usage, response)
+        text = self._chunk_text(response)
+        if not text:
+            raise self._empty_response_error(response)
+        mark_truncated(usage, self._finish_reason(response) == "MAX_TOKENS")
+        return text
+
+    async def stream(self, prompt, system_prompt=None, max_tokens=None, usage=None):
+        model = await self._model_for(system_prompt)
+        response = await model.generate_content_async(prompt, stream=True, **self._generation_config(max_tokens))
+        received = False
+        async for chunk in response:
+            text = self._chunk_text(chunk)
+            if text:
+                received = True
+                yield text
+        if not received:
+            raise self._empty_response_error(response)
+        # Los totales y el motivo de fin llegan en el último fragmento
+        self._fill_usage(usage, response)
+        mark_truncated(usage, self._finish_reason(response) == "MAX_TOKENS")
+
+
+class OpenAIAdapter(ProviderAdapter):
+    name = "openai"
+    label = "OpenAI (ChatGPT)"
+    short_name = "OpenAI"
+    api_key_envs = ("OPENAI_API_KEY",)
+    default_model = "o4-mini-2025-04-16"
+    base_url = None  # None = API oficial de OpenAI
+    # La caché de prefijos de OpenAI es automática; prompt_cache_key agrupa en el mismo servidor
+    # las peticiones que comparten instrucción de sistema
+    supports_prompt_cache_key = True
+    # Los modelos de razonamiento solo aceptan max_completion_tokens, que incluye los tokens de
+    # razonamiento (ocultos): con un límite corto pueden agotarlo entero y devolver un texto vacío
+    max_tokens_param = "max_completion_tokens"
+
+    def _create_client(self):
+        from openai import AsyncOpenAI
+        # Cliente asíncrono nativo sobre el pool HTTP compartido. Los reintentos los gestiona
+        # el planificador de ai_core (max_retries=0 evita reintentar dos veces)
+        return AsyncOpenAI(api_key=self.api_key, base_url=self.base_url, http_client=get_shared_http_client(), max_retries=0)
+
+    @staticmethod
+    def build_messages(prompt, system_prompt=None):
+        messages = []
+        if system_prompt:
+            messages.append({"role": "system", "content": system_prompt})
+        messages.append({"role": "user", "content": prompt})
+        return messages
+
+    def _options(self, system_prompt, max_tokens):
+        options = {}
+        if self.supports_prompt_cache_key and system_prompt:
+            options["prompt_cache_key"] = prefix_key(self.name, system_prompt)[:32]
+        if max_tokens:
+            options[self.max_tokens_param] = max_tokens
+        return options
+
+    @staticmethod
+    def _fill_usage(usage, response_usage):
+        if response_usage is not None:
+            details = getattr(response_usage, "prompt_tokens_details", None)
+            fill_usage(usage, response_usage.prompt_tokens, response_usage.completion_tokens,
+                       getattr(details, "cached_tokens", 0) if details else 0)
+
+    @staticmethod
+    def _empty_reason(finish_reason, refusal):
+        if refusal:
+            return f"rechazo: {refusal}"
+        if finish_reason == "length":
+            return "length (se agotó el límite de tokens de salida, razonamiento incluido)"
+        return finish_reason
+
+    async def complete(self, prompt, system_prompt=None, max_tokens=None, usage=None):
+        response = await self.get_client().chat.completions.create(
+            model=self.model,
+            messages=self.build_messages(prompt, system_prompt),
+            **self._options(system_prompt, max_tokens)
+        )
+        self._fill_usage(usage, response.usage)
+        choice = response.choices[0] if response.choices else None
+        if choice is None or not choice.message.content:
+            # content es None si el modelo se niega a responder (refusal) o solo devuelve llamadas a herramientas
+            refusal = getattr(choice.message, "refusal", None) if choice else None
+            raise empty_response_error(self._empty_reason(getattr(choice, "finish_reason", None), refusal))
+        mark_truncated(usage, choice.finish_reason == "length")
+        return choice.message.content
+
+    async def stream(self, prompt, system_prompt=None, max_tokens=None, usage=None):
+        response = await self.get_client().chat.completions.create(
+            model=self.model,
+            messages=self.build_messages(prompt, system_prompt),
+            stream=True,
+            # El uso llega en un fragmento final sin "choices"
+            stream_options={"include_usage": True},
+            **self._options(system_prompt, max_tokens)
+        )
+        received, refusal, finish_reason = False, "", None
+        async for chunk in response:
+            if chunk.choices:
+                choice = chunk.choices[0]
+                if choice.delta.content:
+                    received = True
+                    yield choice.delta.content
+                refusal += getattr(choice.delta, "refusal", None) or ""
+                finish_reason = choice.finish_reason or finish_reason
+            if getattr(chunk, "usage", None):
+                self._fill_usage(usage, chunk.usage)
+        if not received:
+            raise empty_response_error(self._empty_reason(finish_reason, refusal))
+        mark_truncated(usage, finish_reason == "length")
+
+
+class DeepSeekAdapter(OpenAIAdapter):
+    """DeepSeek expone una API compatible con la de OpenAI: solo cambian la URL y el modelo."""
+    name = "deepseek"
+    label = "DeepSeek"
+    short_name = "DeepSeek"
+    api_key_envs = ("DEEPSEEK_API_KEY",)
+    default_model = "deepseek-chat"
+    base_url = os.getenv("DEEPSEEK_BASE_URL", "https://api.deepseek.com/v1")
+    supports_prompt_cache_key = False  # DeepSeek cachea prefijos en disco sin necesidad de clave
+    max_tokens_param = "max_tokens"
+
+
+class AnthropicAdapter(ProviderAdapter):
+    name = "claude"
+    label = "Anthropic (Claude)"
+    short_name = "Claude"
+    api_key_envs = ("CLAUDE_API_KEY", "ANTHROPIC_API_KEY")
+    model_envs = ("CLAUDE_MODEL", "ANTHROPIC_MODEL")
+    default_model = "claude-sonnet-4-5"  # alias: apunta siempre a la última instantánea de Sonnet 4.5
+    max_tokens = int(os.getenv("CLAUDE_MAX_TOKENS", 1024))  # la API de Anthropic lo exige: valor por defecto
+    # Marca la instrucción de sistema como prefijo cacheable (caché efímera de ~5 minutos).
+    # Por debajo del mínimo del modelo (1024 tokens en la mayoría) la API simplemente no la cachea
+    prompt_cache = os.getenv("CLAUDE_PROMPT_CACHE", "1") != "0"
+
+    def _create_client(self):
+        from anthropic import AsyncAnthropic
+        return AsyncAnthropic(api_key=self.api_key, http_client=get_shared_http_client(), max_retries=0)
+
+    def _request(self, prompt, system_prompt=None, max_tokens=None):
+        request = {
+            "model": self.model,
+            "max_tokens": max_tokens or self.max_tokens,
+            "messages": [{"role": "user", "content": prompt}],
+        }
+        if system_prompt and self.prompt_cache:
+            request["system"] = [{"type": "text", "text": system_prompt, "cache_control": {"type": "ephemeral"}}]
+        elif system_prompt:
+            request["system"] = system_prompt
+        return request
+
+    @staticmethod
+    def _fill_usage(usage, message):
+        # input_tokens no incluye lo leído ni lo escrito en la caché de prompts: se suma aparte
+        cached = getattr(message.usage, "cache_read_input_tokens", 0) or 0
+        created = getattr(message.usage, "cache_creation_input_tokens", 0) or 0
+        fill_usage(usage, message.usage.input_tokens + cached + created, message.usage.output_tokens, cached)
+
+    async def complete(self, prompt, system_prompt=None, max_tokens=None, usage=None):
+        response = await self.get_client().messages.create(**self._request(prompt, system_prompt, max_tokens))
+        self._fill_usage(usage, response)
+        text = "".join(block.text for block in response.content if block.type == "text")
+        if not text:
+            raise empty_response_error(response.stop_reason)
+        mark_truncated(usage, response.stop_reason == "max_tokens")
+        return text
+
+    async def stream(self, prompt, system_prompt=None, max_tokens=None, usage=None):
+        received = False
+        async with self.get_client().messages.stream(**self._request(prompt, system_prompt, max_tokens)) as stream:
+            async for text in stream.text_stream:
+                if text:
+                    received = True
+                    yield text
+            message = await stream.get_final_message()
+            self._fill_usage(usage, message)
+        if not received:
+            raise empty_response_error(message.stop_reason)
+        mark_truncated(usage, message.stop_reason == "max_tokens")
+
+
+# --- 6. REGISTRO ---
+PROVIDERS = {}  # nombre -> adaptador, en orden de registro
+
+def register_provider(adapter):
+    PROVIDERS[adapter.name] = adapter
+    return adapter
+
+def get_provider(name):
+    return PROVIDERS.get(name)
+
+def active_providers():
+    """Proveedores con API key y cliente creado correctamente, en orden de registro."""
+    return [provider for provider in PROVIDERS.values() if provider.active]
+
+register_provider(GeminiAdapter())
+register_provider(OpenAIAdapter())
+register_provider(AnthropicAdapter())
+register_provider(DeepSeekAdapter())
+
+
+# --- 7. PROCESOS HIJOS (FORK) ---
+def prepare_providers():
+    """Configuración única en el proceso padre, antes de crear los workers: comprueba las claves y toma
+    el modelo de cada proveedor del entorno o de la caché en disco. No crea clientes ni llama a la red
+    (el descubrimiento de modelos, si hace falta, lo hace cada worker al calentarse).
+    Devuelve los proveedores con clave."""
+    providers = [provider for provider in PROVIDERS.values() if provider.has_key]
+    for provider in providers:
+        if not provider.model:
+            provider.model = read_model_cache(provider.name)
+    return providers
+
+def _reset_after_fork():
+    # El pool HTTP está ligado al bucle y a los sockets del padre; los clientes de los SDK, a ese pool
+    # (o a canales gRPC, en Gemini). Se recrean en el hijo en el primer uso.
+    global _http_client, _http_lock
+    _http_client = None
+    _http_lock = threading.Lock()
+    prefix_cache.reset()
+    for provider in PROVIDERS.values():
+        provider.reset_client()
+
+os.register_at_fork(after_in_child=_reset_after_fork)
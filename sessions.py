@@ -0,0 +1,230 @@
+# sessions.py
+# Sesiones de varios turnos. Cada sesión es una lista de turnos que solo crece (pregunta del
+# usuario y respuesta de cada proveedor); en cada consulta se envía al proveedor solo una ventana
+# deslizante con los turnos más recientes que caben en SESSION_WINDOW_TURNS / SESSION_WINDOW_TOKENS,
+# en lugar de que el usuario tenga que pegar otra vez todo el contexto.
+#
+# Cada proveedor ve sus propias respuestas anteriores (en modo comparación cada uno lleva su hilo)
+# y las respuestas compartidas (el ganador de una carrera, el resultado final de una cadena).
+#
+# Memoria acotada: si el total supera SESSION_MAX_BYTES se expulsan las sesiones usadas hace más
+# tiempo. Con SESSION_SPILL_DIR, antes de expulsarlas se vuelcan a disco (un JSONL por sesión al
+# que solo se añaden los turnos nuevos) y se recuperan de ahí en el siguiente uso.
+
+import os
+import re
+import json
+import logging
+import time
+import threading
+from collections import OrderedDict
+
+from compaction import count_tokens, truncate_tokens
+
+logger = logging.getLogger(__name__)
+
+SESSION_MAX_BYTES = int(os.getenv("SESSION_MAX_BYTES", 16 * 1024 * 1024))
+SESSION_TTL = int(os.getenv("SESSION_TTL", 24 * 3600))              # segundos sin uso
+SESSION_WINDOW_TURNS = int(os.getenv("SESSION_WINDOW_TURNS", 8))     # turnos enviados como máximo
+SESSION_WINDOW_TOKENS = int(os.getenv("SESSION_WINDOW_TOKENS", 2000))
+SESSION_SPILL_DIR = os.getenv("SESSION_SPILL_DIR", "")               # vacío = sin volcado a disco
+
+_SESSION_ID = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+_TURN_OVERHEAD = 100  # bytes aproximados de un turno aparte de su texto
+
+
+class SessionError(ValueError):
+    """Id de sesión no válido."""
+
+
+class Turn:
+    __slots__ = ("role", "provider", "text", "timestamp")
+
+    def __init__(self, role, provider, text, timestamp):
+        self.role = role          # "user" o "assistant"
+        self.provider = provider  # proveedor que respondió; None si la ven todos
+        self.text = text
+        self.timestamp = timestamp
+
+    def size(self):
+        return len(self.text) + _TURN_OVERHEAD
+
+    def to_dict(self):
+        return {"role": self.role, "provider": self.provider, "text": self.text, "timestamp": self.timestamp}
+
+
+class Session:
+    __slots__ = ("id", "turns", "size", "last_access", "spilled")
+
+    def __init__(self, session_id, turns=()):
+        self.id = session_id
+        self.turns = list(turns)
+        self.size = sum(turn.size() for turn in self.turns)
+        self.last_access = time.time()
+        self.spilled = len(self.turns)  # turnos que ya están en el archivo de volcado
+
+
+def validate_session_id(session_id):
+    if not isinstance(session_id, str) or not _SESSION_ID.match(session_id):
+        raise SessionError("Id de sesión no válido (1-64 caracteres: letras, dígitos, '-' o '_').")
+    return session_id
+
+
+class SessionStore:
+    def __init__(self, max_bytes=SESSION_MAX_BYTES, ttl=SESSION_TTL, window_turns=SESSION_WINDOW_TURNS,
+                 window_tokens=SESSION_WINDOW_TOKENS, spill_dir=SESSION_SPILL_DIR):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.window_turns = window_turns
+        self.window_tokens = window_tokens
+        self.spill_dir = spill_dir
+        self._sessions = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.counters = {"evicted": 0, "spilled": 0, "loaded": 0, "expired": 0}
+
+    def _spill_path(self, session_id):
+        return os.path.join(self.spill_dir, f"{session_id}.jsonl")
+
+    def _load(self, session_id):
+        if not self.spill_dir:
+            return None
+        try:
+            with open(self._spill_path(session_id), encoding="utf-8") as f:
+                turns = [Turn(**json.loads(line)) for line in f if line.strip()]
+        except (OSError, ValueError, TypeError):
+            return None
+        if turns and time.time() - turns[-1].timestamp > self.ttl:
+            self.counters["expired"] += 1
+            return None
+        self.counters["loaded"] += 1
+        return Session(session_id, turns)
+
+    def _spill(self, session):
+        # Solo se añaden los turnos que aún no están en el archivo
+        new_turns = session.turns[session.spilled:]
+        if not new_turns:
+            return
+        try:
+            os.makedirs(self.spill_dir, exist_ok=True)
+            with open(self._spill_path(session.id), "a", encoding="utf-8") as f:
+                f.write("".join(json.dumps(turn.to_dict(), ensure_ascii=False) + "\n" for turn in new_turns))
+            session.spilled = len(session.turns)
+            self.counters["spilled"] += 1
+        except OSError as e:
+            logger.warning("No se pudo volcar la sesión %s a disco: %s", session.id, e)
+
+    def _get(self, session_id, create):
+        session = self._sessions.get(session_id)
+        now = time.time()
+        if session is not None and now - session.last_access > self.ttl:
+            self._drop(session_id)
+            self.counters["expired"] += 1
+            session = None
+        if session is None:
+            session = self._load(session_id)
+            if session is None:
+                if not create:
+                    return None
+                session = Session(session_id)
+            self._sessions[session_id] = session
+            self._bytes += session.size
+        session.last_access = now
+        self._sessions.move_to_end(session_id)
+        return session
+
+    def _drop(self, session_id):
+        session = self._sessions.pop(session_id)
+        self._bytes -= session.size
+        return session
+
+    def _evict(self, keep):
+        # Las menos usadas primero; la sesión que se acaba de usar nunca se expulsa
+        for session_id in list(self._sessions):
+            if self._bytes <= self.max_bytes:
+                break
+            if session_id == keep:
+                continue
+            session = self._drop(session_id)
+            if self.spill_dir:
+                self._spill(session)
+            self.counters["evicted"] += 1
+
+    def append(self, session_id, prompt, answers):
+        """Añade la pregunta y sus respuestas: answers es una lista de (proveedor o None, texto)."""
+        validate_session_id(session_id)
+        now = time.time()
+        with self._lock:
+            session = self._get(session_id, create=True)
+            turns = [Turn("user", None, prompt, now)] + [Turn("assistant", provider, text, now) for provider, text in answers]
+            session.turns.extend(turns)
+            added = sum(turn.size() for turn in turns)
+            session.size += added
+            self._bytes += added
+            self._evict(keep=session_id)
+
+    def window(self, session_id, provider=None):
+        """Turnos recientes que ve 'provider', del más antiguo al más reciente, dentro de la ventana."""
+        validate_session_id(session_id)
+        with self._lock:
+            session = self._get(session_id, create=False)
+            if session is None:
+                return []
+            visible = [turn for turn in session.turns
+                       if turn.role == "user" or turn.provider is None or turn.provider == provider]
+        # Un turno muy largo cuenta (y se envía) como mucho con la mitad del presupuesto
+        selected, tokens = [], 0
+        for turn in reversed(visible):
+            tokens += min(count_tokens(turn.text), self._turn_budget())
+            if len(selected) >= self.window_turns or (selected and tokens > self.window_tokens):
+                break
+            selected.append(turn)
+        # Nunca se empieza la ventana con una respuesta sin la pregunta que la originó
+        while selected and selected[-1].role != "user":
+            selected.pop()
+        return selected[::-1]
+
+    def _turn_budget(self):
+        return max(1, self.window_tokens // 2)
+
+    def build_prompt(self, session_id, provider, prompt):
+        """Prompt con el historial reciente delante; sin historial, el prompt tal cual."""
+        turns = self.window(session_id, provider)
+        if not turns:
+            return prompt
+        history = "\n\n".join(f"{'Usuario' if turn.role == 'user' else 'Asistente'}: {truncate_tokens(turn.text, self._turn_budget())}"
+                              for turn in turns)
+        return f"HISTORIAL DE LA CONVERSACIÓN:\n{history}\n\nPREGUNTA ACTUAL: {prompt}"
+
+    def has_history(self, session_id):
+        with self._lock:
+            session = self._get(validate_session_id(session_id), create=False)
+            return bool(session and session.turns)
+
+    def get(self, session_id):
+        with self._lock:
+            session = self._get(validate_session_id(session_id), create=False)
+            if session is None:
+                return None
+            return {"id": session.id, "turns": [turn.to_dict() for turn in session.turns], "bytes": session.size}
+
+    def delete(self, session_id):
+        validate_session_id(session_id)
+        with self._lock:
+            found = session_id in self._sessions
+            if found:
+                self._drop(session_id)
+            if self.spill_dir:
+                try:
+                    os.remove(self._spill_path(session_id))
+                    found = True
+                except OSError:
+                    pass
+            return found
+
+    def stats(self):
+        with self._lock:
+            return {**self.counters, "sessions": len(self._sessions), "bytes": self._bytes, "max_bytes": self.max_bytes}
+
+
+session_store = SessionStore()
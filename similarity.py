@@ -0,0 +1,158 @@
+# similarity.py
+# Reutilización de respuestas para preguntas casi idénticas ("¿cuál es la capital de Francia?" /
+# "cual es la capital de francia"). Cada prompt se normaliza (minúsculas, sin tildes ni signos),
+# se trocea en n-gramas de caracteres y se resume en una firma MinHash; un índice LSH por bandas
+# da los candidatos en tiempo constante y se acepta el más parecido si su similitud de Jaccard
+# estimada supera el umbral. Todo es local: sin servicios de embeddings ni llamadas de red.
+#
+# Las entradas se agrupan por ámbito (modo y preset): una respuesta de comparación nunca se
+# reutiliza para una cadena, ni la de un preset para otro. La memoria está acotada: como mucho
+# SIMILARITY_CACHE_MAX_ENTRIES entradas, expulsando las menos usadas, y cada una caduca a los
+# SIMILARITY_CACHE_TTL segundos.
+
+import os
+import re
+import time
+import random
+import hashlib
+import threading
+import unicodedata
+from collections import OrderedDict
+
+SIMILARITY_CACHE_ENABLED = os.getenv("SIMILARITY_CACHE_ENABLED", "0") == "1"
+SIMILARITY_THRESHOLD = float(os.getenv("SIMILARITY_THRESHOLD", 0.8))        # Jaccard estimada mínima
+SIMILARITY_CACHE_MAX_ENTRIES = int(os.getenv("SIMILARITY_CACHE_MAX_ENTRIES", 5000))
+SIMILARITY_CACHE_TTL = int(os.getenv("SIMILARITY_CACHE_TTL", 24 * 3600))    # segundos
+SIMILARITY_SHINGLE_SIZE = int(os.getenv("SIMILARITY_SHINGLE_SIZE", 4))      # caracteres por n-grama
+SIMILARITY_NUM_PERM = 64
+SIMILARITY_BANDS = 16  # 16 bandas de 4 filas: candidatos a partir de ~0.5 de similitud
+
+_MERSENNE = (1 << 61) - 1
+_NUMBERS = re.compile(r"\d+")
+
+
+def normalize(text):
+    """Minúsculas, sin tildes y solo letras, dígitos y espacios simples."""
+    text = unicodedata.normalize("NFKD", text.lower())
+    text = "".join(ch for ch in text if not unicodedata.combining(ch))
+    return " ".join(re.findall(r"\w+", text))
+
+
+def shingles(text, size=SIMILARITY_SHINGLE_SIZE):
+    if len(text) <= size:
+        return {text}
+    return {text[i:i + size] for i in range(len(text) - size + 1)}
+
+
+class MinHasher:
+    def __init__(self, num_perm=SIMILARITY_NUM_PERM, seed=1):
+        rng = random.Random(seed)
+        self.num_perm = num_perm
+        self._perms = [(rng.randrange(1, _MERSENNE), rng.randrange(0, _MERSENNE)) for _ in range(num_perm)]
+
+    def signature(self, items):
+        hashes = [int.from_bytes(hashlib.blake2b(item.encode("utf-8"), digest_size=8).digest(), "little") for item in items]
+        return tuple(min((a * h + b) % _MERSENNE for h in hashes) for a, b in self._perms)
+
+    @staticmethod
+    def similarity(sig_a, sig_b):
+        """Jaccard estimada: fracción de posiciones en las que coinciden las dos firmas."""
+        return sum(1 for a, b in zip(sig_a, sig_b) if a == b) / len(sig_a)
+
+
+class SimilarityCache:
+    """Índice MinHash + LSH acotado en memoria. Lo usa el bucle de ai_core; stats() se lee desde Flask."""
+
+    def __init__(self, threshold=SIMILARITY_THRESHOLD, max_entries=SIMILARITY_CACHE_MAX_ENTRIES,
+                 ttl=SIMILARITY_CACHE_TTL, num_perm=SIMILARITY_NUM_PERM, bands=SIMILARITY_BANDS):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.hasher = MinHasher(num_perm)
+        self._entries = OrderedDict()  # id -> (ámbito, firma, números, expira_en, valor, metadatos)
+        self._buckets = {}             # (ámbito, banda, valores de la banda) -> ids
+        self._next_id = 0
+        self._lock = threading.Lock()
+        self.counters = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+
+    def _fingerprint(self, prompt):
+        text = normalize(prompt)
+        # Los números tienen que coincidir exactamente: "2 + 2" y "2 + 3" se parecen pero no son la misma pregunta
+        return self.hasher.signature(shingles(text)), tuple(_NUMBERS.findall(text))
+
+    def _band_keys(self, scope, signature):
+        return [(scope, band, signature[band * self.rows:(band + 1) * self.rows]) for band in range(self.bands)]
+
+    def _remove(self, entry_id):
+        scope, signature = self._entries.pop(entry_id)[:2]
+        for key in self._band_keys(scope, signature):
+            ids = self._buckets.get(key)
+            if ids is not None:
+                ids.discard(entry_id)
+                if not ids:
+                    del self._buckets[key]
+
+    def lookup(self, prompt, scope):
+        """Valor guardado para el prompt más parecido del mismo ámbito, como
+        (valor, {"similarity", "prompt", "stored_at"}), o None si ninguno supera el umbral."""
+        signature, numbers = self._fingerprint(prompt)
+        now = time.time()
+        with self._lock:
+            candidates = set()
+            for key in self._band_keys(scope, signature):
+                candidates.update(self._buckets.get(key, ()))
+            best, best_score = None, 0.0
+            for entry_id in candidates:
+                entry = self._entries[entry_id]
+                if entry[3] <= now:
+                    self._remove(entry_id)
+                    self.counters["evictions"] += 1
+                    continue
+                if entry[2] != numbers:
+                    continue
+                score = self.hasher.similarity(signature, entry[1])
+                if score >= self.threshold and score > best_score:
+                    best, best_score = entry_id, score
+            if best is None:
+                self.counters["misses"] += 1
+                return None
+            self._entries.move_to_end(best)
+            self.counters["hits"] += 1
+            entry = self._entries[best]
+            return entry[4], dict(entry[5], similarity=round(best_score, 3))
+
+    def store(self, prompt, scope, value):
+        signature, numbers = self._fingerprint(prompt)
+        now = time.time()
+        with self._lock:
+            entry_id = self._next_id
+            self._next_id += 1
+            meta = {"prompt": prompt, "stored_at": round(now, 3)}
+            self._entries[entry_id] = (scope, signature, numbers, now + self.ttl, value, meta)
+            for key in self._band_keys(scope, signature):
+                self._buckets.setdefault(key, set()).add(entry_id)
+            self.counters["stores"] += 1
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+                self.counters["evictions"] += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.counters["hits"] + self.counters["misses"]
+            return {
+                **self.counters,
+                "hit_ratio": self.counters["hits"] / lookups if lookups else 0.0,
+                "entries": len(self._entries),
+                "buckets": len(self._buckets),
+                "threshold": self.threshold,
+            }
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._buckets.clear()
+
+
+similarity_cache = SimilarityCache()
@@ -0,0 +1,38 @@
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Los módulos leen las rutas de sus archivos al importarse: los tests escriben en un directorio temporal
+_tmp = tempfile.mkdtemp(prefix="ai-tests-")
+for env, filename in {"RESPONSE_CACHE_PATH": "response_cache.sqlite3", "HISTORY_PATH": "history.sqlite3",
+                      "CHAIN_CHECKPOINT_PATH": "chain_checkpoints.sqlite3", "CONVERSATION_LOG_PATH": "conversation_log.jsonl",
+                      "MODEL_CACHE_PATH": "model_cache.json", "CASSETTE_PATH": "cassettes/providers.jsonl"}.items():
+    os.environ[env] = os.path.join(_tmp, filename)
+
+
+import pytest
+
+
+@pytest.fixture
+def fakes(monkeypatch):
+    """Instala proveedores falsos (bench/fake_providers.py) sin latencia ni reintentos, con un enrutador
+    limpio; al terminar restaura el registro de proveedores. Devuelve {nombre: adaptador}."""
+    import ai_core
+    from bench.fake_providers import install
+    from providers import PROVIDERS
+
+    saved = dict(PROVIDERS)
+    monkeypatch.setattr(ai_core, "router", ai_core.ProviderRouter())
+    monkeypatch.setattr(ai_core, "_schedulers", {})
+
+    def _install(names=("gemini", "openai"), **options):
+        installed = install(names, **dict({"latency": 0}, **options))
+        for provider in installed:
+            ai_core._schedulers[provider.name] = ai_core.ProviderScheduler(provider.name, 8, max_retries=0)
+        return {provider.name: provider for provider in installed}
+
+    yield _install
+    PROVIDERS.clear()
+    PROVIDERS.update(saved)
@@ -0,0 +1,29 @@
+import pytest
+
+from app import app
+
+
+@pytest.fixture
+def client():
+    return app.test_client()
+
+
+@pytest.mark.parametrize("path", ["/api/query", "/api/stream", "/api/jobs"])
+@pytest.mark.parametrize("body", [b"no es json", b"[1, 2]", b'"hola"'])
+def test_non_object_body_is_a_json_400(client, path, body):
+    response = client.post(path, data=body, content_type="application/json")
+    assert response.status_code == 400
+    assert "error" in response.get_json()
+
+
+def test_missing_content_type_is_a_json_400(client):
+    response = client.post("/api/query", data='{"prompt": "hola", "mode": "comparison"}')
+    assert response.status_code == 400
+    assert "error" in response.get_json()
+
+
+@pytest.mark.parametrize("path", ["/api/query", "/api/stream"])
+def test_unknown_mode_is_rejected(client, path):
+    response = client.post(path, json={"prompt": "hola", "mode": "inventado"})
+    assert response.status_code == 400
+    assert response.get_json() == {"error": "Modo no válido: inventado"}
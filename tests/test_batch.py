@@ -0,0 +1,77 @@
+import asyncio
+import json
+import threading
+import time
+
+import batch
+
+
+def _write_input(path, n):
+    with open(path, "w", encoding="utf-8") as f:
+        for i in range(n):
+            f.write(json.dumps({"id": i, "prompt": f"pregunta {i}"}) + "\n")
+        f.write("esto no es json\n")
+
+
+def test_results_and_checkpoint_are_written_off_the_event_loop(tmp_path, monkeypatch):
+    async def fake_run_prompt(item, mode, preset, use_cache):
+        await asyncio.sleep(0.001)
+        return {"respuesta": item["prompt"].upper()}
+
+    writer_threads = set()
+    original = batch.BatchRunner._write_result
+
+    def spy(out, line):
+        writer_threads.add(threading.current_thread().name)
+        original(out, line)
+
+    monkeypatch.setattr(batch, "run_prompt", fake_run_prompt)
+    monkeypatch.setattr(batch.BatchRunner, "_write_result", staticmethod(spy))
+    input_path, output_path = tmp_path / "in.jsonl", tmp_path / "out.jsonl"
+    _write_input(input_path, 20)
+
+    runner = batch.BatchRunner(str(input_path), str(output_path), concurrency=4)
+    progress = asyncio.run(runner.run())
+
+    assert progress["processed"] == 20 and progress["skipped"] == 1 and progress["status"] == "completado"
+    lines = [json.loads(line) for line in output_path.read_text(encoding="utf-8").splitlines()]
+    assert sorted(line["id"] for line in lines) == list(range(20))
+    assert writer_threads and all(name.startswith("batch-io") for name in writer_threads)
+    checkpoint = json.loads((tmp_path / "out.jsonl.checkpoint").read_text())
+    assert checkpoint["line"] == 21 and checkpoint["done"] == []
+
+
+def test_resume_skips_finished_lines(tmp_path, monkeypatch):
+    seen = []
+
+    async def fake_run_prompt(item, mode, preset, use_cache):
+        seen.append(item["id"])
+        return {}
+
+    monkeypatch.setattr(batch, "run_prompt", fake_run_prompt)
+    input_path, output_path = tmp_path / "in.jsonl", tmp_path / "out.jsonl"
+    _write_input(input_path, 6)
+    with open(input_path, "rb") as f:
+        offset = sum(len(f.readline()) for _ in range(3))
+    (tmp_path / "out.jsonl.checkpoint").write_text(json.dumps({"line": 3, "offset": offset, "done": [4]}))
+
+    asyncio.run(batch.BatchRunner(str(input_path), str(output_path), concurrency=2).run())
+    assert sorted(seen) == [3, 5]
+
+
+def test_finished_batches_are_evicted(monkeypatch):
+    monkeypatch.setattr(batch, "_batches", batch.OrderedDict())
+    monkeypatch.setattr(batch, "BATCH_TTL", 60)
+    monkeypatch.setattr(batch, "BATCH_MAX", 2)
+
+    def runner(status, finished_ago=None):
+        r = batch.BatchRunner("in.jsonl", "out.jsonl")
+        r.status = status
+        r.finished_at = time.time() - finished_ago if finished_ago is not None else None
+        return r
+
+    batch._batches.update(viejo=runner("completado", 120), corriendo=runner("en curso"),
+                          reciente=runner("error", 1), otro=runner("cancelado", 2))
+    batch._evict_batches()
+    # El caducado se olvida; de los demás, el terminado más antiguo; el que está en curso nunca
+    assert list(batch._batches) == ["corriendo", "otro"]
@@ -0,0 +1,85 @@
+import asyncio
+import time
+
+import pytest
+
+from bench.fake_providers import FakeProviderAdapter
+from cassettes import Cassette, CassetteMissError, RecordingAdapter, ReplayAdapter, ReplayedError
+
+
+def _fake(name="gemini", **options):
+    return FakeProviderAdapter(name, name.capitalize(), **dict({"latency": 0, "output_tokens": 6, "chunk_size": 2}, **options))
+
+
+async def _collect(stream):
+    return [chunk async for chunk in stream]
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "cassettes" / "providers.jsonl")
+
+
+def test_round_trip_replays_text_chunks_and_usage(path):
+    recorder = RecordingAdapter(_fake(), Cassette(path))
+    usage = {}
+    text = asyncio.run(recorder.complete("hola", "sistema", 100, usage))
+    chunks = asyncio.run(_collect(recorder.stream("hola", "sistema")))
+    recorder.cassette.save_index()
+
+    replay = ReplayAdapter(_fake(), Cassette(path), latency=0)
+    replayed_usage = {}
+    assert asyncio.run(replay.complete("hola", "sistema", 100, replayed_usage)) == text
+    assert replayed_usage == usage and usage["output_tokens"] == 6
+    assert asyncio.run(_collect(replay.stream("hola", "sistema"))) == chunks and len(chunks) == 3
+    # Una respuesta grabada completa también se puede pedir en streaming: llega de una vez
+    assert asyncio.run(_collect(replay.stream("hola", "sistema", 100))) == [text]
+    assert replay.model_name == "fake-gemini"
+
+
+def test_requests_must_match_exactly(path):
+    asyncio.run(RecordingAdapter(_fake(), Cassette(path)).complete("hola"))
+    replay = ReplayAdapter(_fake(), Cassette(path), latency=0)
+    for prompt, system_prompt, max_tokens in [("hola ", None, None), ("hola", "sistema", None), ("hola", None, 50)]:
+        with pytest.raises(CassetteMissError):
+            asyncio.run(replay.complete(prompt, system_prompt, max_tokens))
+    assert replay.cassette.counters == {"hits": 0, "misses": 3, "recorded": 0}
+    assert not ReplayAdapter(_fake("openai"), replay.cassette).has_key
+
+
+def test_repeated_requests_are_replayed_in_turn(path):
+    cassette = Cassette(path)
+    for tokens in (2, 3):
+        asyncio.run(RecordingAdapter(_fake(output_tokens=tokens), cassette).complete("hola"))
+    replay = ReplayAdapter(_fake(), Cassette(path), latency=0)
+    assert [len(asyncio.run(replay.complete("hola")).split()) for _ in range(3)] == [2, 3, 2]
+
+
+def test_errors_are_replayed_with_their_type_and_status(path):
+    with pytest.raises(Exception) as recorded:
+        asyncio.run(RecordingAdapter(_fake(error_rate=1.0), Cassette(path)).complete("hola"))
+    with pytest.raises(ReplayedError) as replayed:
+        asyncio.run(ReplayAdapter(_fake(), Cassette(path), latency=0).complete("hola"))
+    assert type(replayed.value).__name__ == type(recorded.value).__name__ == "FakeProviderError"
+    assert replayed.value.status_code == 503 and str(replayed.value) == str(recorded.value)
+
+
+def test_index_only_adds_what_was_appended_since_it_was_saved(path):
+    first = Cassette(path)
+    asyncio.run(RecordingAdapter(_fake(), first).complete("uno"))
+    first.save_index()
+    # Otro proceso añade una grabación sin actualizar el índice guardado
+    asyncio.run(RecordingAdapter(_fake("openai"), Cassette(path)).complete("dos"))
+
+    cassette = Cassette(path)
+    assert cassette.providers() == {"gemini": "fake-gemini", "openai": "fake-openai"}
+    assert asyncio.run(ReplayAdapter(_fake("openai"), cassette, latency=0).complete("dos"))
+    assert cassette.stats()["entries"] == 2
+
+
+def test_recorded_latency_is_scaled(path):
+    asyncio.run(RecordingAdapter(_fake(latency=0.1), Cassette(path)).complete("hola"))
+    replay = ReplayAdapter(_fake(), Cassette(path), latency=0.5)
+    start = time.perf_counter()
+    asyncio.run(replay.complete("hola"))
+    assert 0.04 <= time.perf_counter() - start < 0.1
@@ -0,0 +1,24 @@
+from ai_core import build_step_prompt
+
+DRAFT = {"id": "borrador", "ia_name": "gemini", "task_description": "Escribe un borrador."}
+
+
+def test_first_step_gets_the_question():
+    prompt = build_step_prompt("¿Qué es HTTP/3?", DRAFT, [])
+    assert prompt.startswith("TU TAREA ES: Escribe un borrador.")
+    assert "¿Qué es HTTP/3?" in prompt
+
+
+def test_later_steps_get_the_question_only_with_include_prompt():
+    review = {"id": "critica", "ia_name": "claude", "task_description": "Critica el borrador."}
+    inputs = [(DRAFT, "texto del borrador")]
+    assert "¿Qué es HTTP/3?" not in build_step_prompt("¿Qué es HTTP/3?", review, inputs)
+    with_prompt = build_step_prompt("¿Qué es HTTP/3?", dict(review, include_prompt=True), inputs)
+    assert "PREGUNTA INICIAL: ¿Qué es HTTP/3?" in with_prompt and "texto del borrador" in with_prompt
+
+
+def test_several_inputs_are_labelled_by_step():
+    final = {"id": "sintesis", "ia_name": "gemini", "task_description": "Integra."}
+    review = {"id": "critica", "ia_name": "claude"}
+    prompt = build_step_prompt("pregunta", final, [(DRAFT, "uno"), (review, "dos")])
+    assert "[borrador - GEMINI]\nuno" in prompt and "[critica - CLAUDE]\ndos" in prompt
@@ -0,0 +1,73 @@
+import pytest
+
+import ai_core
+from checkpoints import CheckpointStore, step_hash
+
+
+@pytest.fixture
+def store(tmp_path):
+    return CheckpointStore(str(tmp_path / "checkpoints.sqlite3"), ttl=60)
+
+
+def test_checkpoint_is_restored_only_with_the_same_inputs(store):
+    store.save("run", "paso_1", "hash", {"response": "hola"}, "hola compactado")
+    assert store.load("run", "paso_1", "hash") == ({"response": "hola"}, "hola compactado")
+    assert store.load("run", "paso_1", "otro hash") is None
+    assert store.load("otra ejecución", "paso_1", "hash") is None
+    assert store.counters == {"restored": 1, "saved": 1, "stale": 1}
+
+
+def test_checkpoints_expire(store, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr("checkpoints.time.time", lambda: now[0])
+    store.save("run", "paso_1", "hash", {}, "texto")
+    now[0] += 61
+    assert store.load("run", "paso_1", "hash") is None
+
+
+def test_step_hash_covers_node_model_prompt_and_system_prompt():
+    node = {"id": "paso_1", "task_description": "Resume."}
+    base = step_hash(node, "modelo", "prompt", "sistema")
+    assert base == step_hash(dict(node), "modelo", "prompt", "sistema")
+    assert len({base, step_hash(dict(node, task_description="Traduce."), "modelo", "prompt", "sistema"),
+                step_hash(node, "otro modelo", "prompt", "sistema"), step_hash(node, "modelo", "otro", "sistema"),
+                step_hash(node, "modelo", "prompt", None)}) == 5
+
+
+@pytest.fixture
+def chain(fakes, store, monkeypatch):
+    providers = fakes(("gemini", "openai"), output_tokens=3)
+    monkeypatch.setattr(ai_core, "checkpoint_store", store)
+    monkeypatch.setattr(ai_core, "RESPONSE_CACHE_ENABLED", False)
+    steps = [{"ia_name": name, "system_instruction": "Eres útil.", "task_description": f"Tarea {i}."}
+             for i, name in enumerate(("gemini", "openai", "gemini"), start=1)]
+    monkeypatch.setitem(ai_core.WORKFLOW_GRAPHS, "prueba", ai_core.compile_preset({"chain": steps}))
+    return providers
+
+
+def test_chain_resumes_from_the_failed_step(chain):
+    chain["openai"].error_rate = 1.0
+    first = ai_core.run_sync(ai_core.run_chain_mode("pregunta", "prueba", run_id="ejecucion-1"))
+    assert [entry.get("error", False) for entry in first] == [False, True]
+    assert chain["gemini"].calls == 1
+
+    chain["openai"].error_rate = 0.0
+    second = ai_core.run_sync(ai_core.run_chain_mode("pregunta", "prueba", run_id="ejecucion-1"))
+    assert [entry.get("checkpoint", False) for entry in second] == [True, False, False]
+    assert second[0]["response"] == first[0]["response"]
+    assert chain["gemini"].calls == 2 and chain["openai"].calls == 2  # solo se repiten los pasos 2 y 3
+
+    third = ai_core.run_sync(ai_core.run_chain_mode("pregunta", "prueba", run_id="ejecucion-1"))
+    assert all(entry.get("checkpoint") for entry in third)
+    assert chain["gemini"].calls == 2 and chain["openai"].calls == 2
+
+
+def test_without_run_id_or_with_other_inputs_nothing_is_restored(chain):
+    ai_core.run_sync(ai_core.run_chain_mode("pregunta", "prueba"))
+    rerun = ai_core.run_sync(ai_core.run_chain_mode("pregunta", "prueba"))
+    assert not any(entry.get("checkpoint") for entry in rerun)
+
+    ai_core.run_sync(ai_core.run_chain_mode("pregunta", "prueba", run_id="ejecucion-2"))
+    changed = ai_core.run_sync(ai_core.run_chain_mode("otra pregunta", "prueba", run_id="ejecucion-2"))
+    # El paso 1 ve otra pregunta y se repite; los siguientes reciben el mismo texto que antes
+    assert [entry.get("checkpoint", False) for entry in changed] == [False, True, True]
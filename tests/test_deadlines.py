@@ -0,0 +1,59 @@
+import asyncio
+import time
+
+import pytest
+
+import ai_core
+from ai_core import DeadlineExceededError, ProviderTimeoutError, StepError, _await_within, make_deadline, step_deadline
+
+
+def test_remaining_time_is_split_between_the_steps_left(monkeypatch):
+    monkeypatch.setattr("ai_core.time.monotonic", lambda: 100.0)
+    assert step_deadline(None, 3) is None
+    assert step_deadline(109.0, 3) == 103.0
+    assert step_deadline(109.0, 1) == 109.0  # el último paso dispone de todo lo que quede
+    assert step_deadline(95.0, 2) == 100.0   # plazo ya vencido: ninguno más
+    assert make_deadline(None) is None and make_deadline(0) is None
+    assert make_deadline(2.5) == 102.5
+
+
+def test_expired_deadline_fails_without_starting_the_call():
+    async def call():
+        raise AssertionError("no debería ejecutarse")
+
+    coro = call()
+    with pytest.raises(DeadlineExceededError):
+        asyncio.run(_await_within(coro, 10, time.monotonic() - 1))
+    assert coro.cr_frame is None  # cerrada, sin avisos de corrutina nunca esperada
+
+
+def test_provider_timeout_and_deadline_are_told_apart():
+    with pytest.raises(ProviderTimeoutError):
+        asyncio.run(_await_within(asyncio.sleep(1), 0.01, time.monotonic() + 10))
+    with pytest.raises(DeadlineExceededError):
+        asyncio.run(_await_within(asyncio.sleep(1), 10, time.monotonic() + 0.01))
+
+
+def test_no_fallback_is_tried_once_the_deadline_has_passed(fakes):
+    providers = fakes(("gemini", "claude"))
+    providers["gemini"].latency = 1
+    node = {"id": "paso", "ia_name": "gemini"}
+    with pytest.raises(StepError) as caught:
+        ai_core.run_sync(ai_core.call_step(node, "hola", use_cache=False, deadline=time.monotonic() + 0.05,
+                                           candidates=[providers["gemini"], providers["claude"]]))
+    assert isinstance(caught.value.error, DeadlineExceededError)
+    assert providers["claude"].calls == 0
+
+
+def test_a_slow_step_only_uses_its_share_of_the_chain_deadline(fakes, monkeypatch):
+    providers = fakes(("gemini", "openai"), output_tokens=3)
+    providers["gemini"].latency = 5
+    steps = [{"ia_name": name, "system_instruction": "", "task_description": "Responde."} for name in ("gemini", "openai")]
+    monkeypatch.setitem(ai_core.WORKFLOW_GRAPHS, "plazo", ai_core.compile_preset({"chain": steps}))
+
+    start = time.monotonic()
+    log = ai_core.run_sync(ai_core.run_chain_mode("pregunta", "plazo", use_cache=False, deadline=start + 0.4))
+    # El primer paso de dos tiene la mitad del plazo: se corta y el segundo no llega a ejecutarse
+    assert 0.15 <= time.monotonic() - start < 0.35
+    assert log[0]["timed_out"] and log[0]["error"]
+    assert len(log) == 1 and providers["openai"].calls == 0
@@ -0,0 +1,76 @@
+import pytest
+
+from history import HistoryError, HistoryStore
+
+
+def _record(i, prompt, responses=None, mode="comparacion", timestamp=None):
+    return {"timestamp": timestamp or f"2025-07-{1 + i // 10:02d}T10:00:{i % 10:02d}", "mode": mode,
+            "prompt": prompt, "responses": responses or {"gemini": f"respuesta {i}"}}
+
+
+@pytest.fixture
+def store(tmp_path):
+    return HistoryStore(str(tmp_path / "history.sqlite3"))
+
+
+def _pages(store, **filters):
+    pages, cursor = [], None
+    while True:
+        page = store.search(cursor=cursor, **filters)
+        pages.append([item["prompt"] for item in page["items"]])
+        cursor = page["next_cursor"]
+        if not cursor:
+            return pages
+
+
+def test_pages_cover_every_conversation_newest_first(store):
+    # Varias conversaciones con la misma marca de tiempo: el cursor desempata por id
+    records = [_record(i, f"pregunta {i}") for i in range(23)]
+    records += [_record(0, f"mismo segundo {i}", timestamp="2025-08-01T00:00:00") for i in range(3)]
+    assert store.add_records(records) == 26
+    assert store.add_records(records) == 0  # ya guardados
+
+    pages = _pages(store, limit=5)
+    assert [len(page) for page in pages] == [5, 5, 5, 5, 5, 1]
+    prompts = [prompt for page in pages for prompt in page]
+    assert prompts[:3] == ["mismo segundo 2", "mismo segundo 1", "mismo segundo 0"]
+    assert prompts[3:] == [f"pregunta {i}" for i in reversed(range(23))]
+
+
+def test_full_text_search_matches_prompts_and_responses(store):
+    store.add_records([
+        _record(1, "¿Cómo funciona QUIC?", {"gemini": "Sobre UDP."}),
+        _record(2, "Receta de paella", {"openai": "Arroz, azafrán y caldo."}),
+        _record(3, "Otra pregunta sobre quic", mode="encadenada",
+                responses=[{"ia_name": "CLAUDE", "task": "Borrador", "response": "Multiplexa flujos."}]),
+    ])
+    if not store.fts:
+        pytest.skip("SQLite sin FTS5")
+    assert [item["prompt"] for item in store.search(q="quic")["items"]] == ["Otra pregunta sobre quic", "¿Cómo funciona QUIC?"]
+    assert [item["prompt"] for item in store.search(q="azafrán")["items"]] == ["Receta de paella"]
+    # La sintaxis de FTS5 no llega del usuario: se busca como texto
+    assert [item["prompt"] for item in store.search(q='quic" OR paella*')["items"]] == []
+    with pytest.raises(HistoryError):
+        store.search(q="?!")
+
+
+def test_filters_combine_with_pagination(store):
+    store.add_records([_record(i, f"p{i}", mode="encadenada" if i % 2 else "comparacion") for i in range(10)])
+    pages = _pages(store, mode="chained", limit=2)
+    assert [prompt for page in pages for prompt in page] == ["p9", "p7", "p5", "p3", "p1"]
+    assert [item["prompt"] for item in store.search(since="2025-07-01T10:00:07", until="2025-07-01T10:00:08")["items"]] == ["p8", "p7"]
+    assert [item["prompt"] for item in store.search(provider="GEMINI", limit=1)["items"]] == ["p9"]
+    assert store.search(provider="openai")["items"] == []
+
+
+@pytest.mark.parametrize("filters", [{"cursor": "no-es-un-cursor"}, {"since": "ayer"}])
+def test_invalid_cursor_or_date_is_an_error(store, filters):
+    with pytest.raises(HistoryError):
+        store.search(**filters)
+
+
+def test_get_returns_the_stored_record(store):
+    store.add_records([_record(1, "hola")])
+    item = store.search()["items"][0]
+    assert store.get(item["id"])["prompt"] == "hola"
+    assert store.get(item["id"] + 1) is None
@@ -0,0 +1,134 @@
+import asyncio
+import time
+
+import pytest
+
+from ai_core import run_sync
+from jobs import JobManager, QueueFullError
+
+
+def _stop_workers(manager):
+    async def stop():
+        for task in manager._worker_tasks:
+            task.cancel()
+        await asyncio.gather(*manager._worker_tasks, return_exceptions=True)
+    run_sync(stop())
+
+
+@pytest.fixture
+def manager():
+    manager = JobManager(workers=1, queue_size=1, ttl=60, max_jobs=10)
+    yield manager
+    _stop_workers(manager)
+
+
+def _wait_for(job, *statuses, timeout=5):
+    end = time.monotonic() + timeout
+    while job.status not in statuses:
+        assert time.monotonic() < end, f"el trabajo sigue {job.status}"
+        time.sleep(0.005)
+
+
+def _comparison(prompt="hola"):
+    return {"prompt": prompt, "mode": "comparison", "cache": False}
+
+
+def test_job_runs_to_completion(fakes, manager):
+    fakes(("gemini", "openai"), output_tokens=5)
+    job = manager.submit(_comparison())
+    assert manager.get(job.id) is job
+    _wait_for(job, "completado")
+
+    state = job.to_dict()
+    assert state["steps_done"] == 2 and state["error"] is None
+    assert state["results"]["Gemini (falso)"].split() == [f"gemini{i}" for i in range(5)]
+    assert state["started_at"] <= state["finished_at"]
+    assert manager.stats()["jobs"] == {"completado": 1}
+
+
+def test_running_job_can_be_cancelled(fakes, manager):
+    providers = fakes(("gemini",))
+    providers["gemini"].latency = 10
+    job = manager.submit(_comparison())
+    _wait_for(job, "en curso")
+    manager.cancel(job.id)
+    _wait_for(job, "cancelado")
+    assert job.finished_at is not None
+
+    # El worker sigue disponible para el siguiente trabajo
+    providers["gemini"].latency = 0
+    following = manager.submit(_comparison("otra"))
+    _wait_for(following, "completado")
+
+
+def test_pending_job_is_cancelled_without_running(fakes, manager):
+    providers = fakes(("gemini",))
+    providers["gemini"].latency = 10
+    running = manager.submit(_comparison())
+    _wait_for(running, "en curso")
+    pending = manager.submit(_comparison("después"))
+    manager.cancel(pending.id)
+    _wait_for(pending, "cancelado")
+    manager.cancel(running.id)
+    _wait_for(running, "cancelado")
+    assert pending.started_at is None
+    assert providers["gemini"].calls == 1
+
+
+def test_stopping_the_workers_cancels_the_running_job(fakes, manager):
+    providers = fakes(("gemini",))
+    providers["gemini"].latency = 10
+    job = manager.submit(_comparison())
+    _wait_for(job, "en curso")
+    _stop_workers(manager)
+    _wait_for(job, "cancelado")
+    assert all(task.done() for task in manager._worker_tasks)
+
+
+def test_full_queue_rejects_and_forgets_the_job(fakes, manager):
+    providers = fakes(("gemini",))
+    providers["gemini"].latency = 10
+    running = manager.submit(_comparison())
+    _wait_for(running, "en curso")
+    manager.submit(_comparison("en cola"))
+    with pytest.raises(QueueFullError):
+        manager.submit(_comparison("sobra"))
+    assert sum(manager.stats()["jobs"].values()) == 2
+    for job_id in list(manager._jobs):
+        manager.cancel(job_id)
+
+
+def test_failed_job_reports_the_error(manager, monkeypatch):
+    async def broken_stream(prompt, **options):
+        raise RuntimeError("sin proveedores")
+        yield
+
+    monkeypatch.setattr("jobs.stream_comparison_mode", broken_stream)
+    job = manager.submit(_comparison())
+    _wait_for(job, "error")
+    assert job.to_dict()["error"] == "sin proveedores"
+
+
+def test_finished_jobs_are_evicted_by_age_and_count(manager):
+    manager.max_jobs = 2
+    now = time.time()
+    for job_id, status, finished_ago in [("viejo", "completado", 120), ("corriendo", "en curso", None),
+                                         ("reciente", "error", 1), ("otro", "cancelado", 2)]:
+        job = type("J", (), {})()
+        job.status, job.finished_at = status, now - finished_ago if finished_ago is not None else None
+        manager._jobs[job_id] = job
+    manager._evict()
+    assert list(manager._jobs) == ["corriendo", "otro"]
+
+
+@pytest.mark.parametrize("data, error", [
+    ([], "objeto JSON"),
+    ({"prompt": "hola"}, "Faltan"),
+    ({"prompt": "hola", "mode": "inventado"}, "Modo no válido"),
+    ({"prompt": "hola", "mode": "chained"}, "Falta 'preset'"),
+    ({"prompt": "hola", "mode": "race", "strategy": "todas"}, "Estrategia no válida"),
+    ({"prompt": "hola", "mode": "race", "timeout": True}, "'timeout' no válido"),
+    ({"prompt": "hola", "mode": "race", "timeout": -1}, "'timeout' no válido"),
+])
+def test_invalid_requests_are_rejected(data, error):
+    assert error in JobManager.validate(data)
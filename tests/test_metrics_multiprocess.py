@@ -0,0 +1,58 @@
+import json
+import os
+
+from metrics import MetricsRegistry, MultiProcessStore
+
+
+def _write(directory, pid, data):
+    (directory / f"{pid}.json").write_text(json.dumps(data))
+
+
+def _registry():
+    registry = MetricsRegistry()
+    registry.counter("requests_total", "Peticiones.", ["provider"])
+    registry.callback("latency_ewma_ms", "Latencia EWMA.", "gauge", lambda: [])
+    registry.callback("circuit_open", "Circuito abierto.", "gauge", lambda: [], multiprocess_mode="max")
+    return registry
+
+
+def test_collect_combines_by_multiprocess_mode(tmp_path):
+    registry = _registry()
+    store = MultiProcessStore(registry, str(tmp_path), flush_interval=3600)
+    _write(tmp_path, 101, {
+        "requests_total": [[["gemini"], 3]],
+        "latency_ewma_ms": [[[["provider", "gemini"]], 200.0]],
+        "circuit_open": [[[["provider", "gemini"]], 0]],
+    })
+    _write(tmp_path, 102, {
+        "requests_total": [[["gemini"], 4]],
+        "latency_ewma_ms": [[[["provider", "gemini"]], 300.0]],
+        "circuit_open": [[[["provider", "gemini"]], 1]],
+    })
+
+    merged = store.collect()
+
+    # Contadores: suma; gauges por defecto: una serie por worker; circuito: máximo
+    assert merged["requests_total"] == {("gemini",): 7}
+    assert merged["latency_ewma_ms"] == {
+        (("provider", "gemini"), ("pid", "101")): 200.0,
+        (("provider", "gemini"), ("pid", "102")): 300.0,
+    }
+    assert merged["circuit_open"] == {(("provider", "gemini"),): 1}
+
+    registry.store = store
+    text = registry.render()
+    assert 'latency_ewma_ms{provider="gemini",pid="101"} 200.0' in text
+    assert 'circuit_open{provider="gemini"} 1' in text
+
+
+def test_store_does_not_flush_until_started(tmp_path):
+    registry = _registry()
+    store = registry.enable_multiprocess(str(tmp_path), flush_interval=3600)
+    # Como en el maestro de gunicorn: importar y salir no deja un <pid>.json fantasma
+    store.flush_on_exit()
+    assert list(tmp_path.glob("*.json")) == []
+
+    store.start()
+    store.flush_on_exit()
+    assert [p.name for p in tmp_path.glob("*.json")] == [f"{os.getpid()}.json"]
@@ -0,0 +1,32 @@
+import logging
+
+from ai_core import CHAIN_STEP_FALLBACKS, CONTEXT_SUMMARY_FAILURES, call_step, compact_context, run_sync
+
+
+def test_step_fallback_is_counted_and_logged(fakes, caplog):
+    providers = fakes(("gemini", "claude"))
+    providers["gemini"].error_rate = 1.0
+    node = {"id": "borrador", "ia_name": "gemini", "fallback": ["claude"]}
+    before = CHAIN_STEP_FALLBACKS.value(step="borrador", provider="gemini", fallback="claude")
+
+    with caplog.at_level(logging.WARNING, logger="ai_core"):
+        provider, text = run_sync(call_step(node, "hola", use_cache=False,
+                                            candidates=[providers["gemini"], providers["claude"]]))
+
+    assert provider.name == "claude" and text.startswith("claude0")
+    assert CHAIN_STEP_FALLBACKS.value(step="borrador", provider="gemini", fallback="claude") == before + 1
+    assert "Paso 'borrador'" in caplog.text and "Claude (falso)" in caplog.text
+
+
+def test_failed_summary_is_counted_and_falls_back_to_truncation(fakes, caplog):
+    providers = fakes(("gemini",))
+    providers["gemini"].error_rate = 1.0
+    node = {"id": "borrador", "context_budget": 20, "compaction": "summary", "summary_provider": "gemini"}
+    before = CONTEXT_SUMMARY_FAILURES.value(provider="gemini")
+
+    with caplog.at_level(logging.WARNING, logger="ai_core"):
+        text, strategy = run_sync(compact_context("palabra " * 500, node, use_cache=False))
+
+    assert strategy == "head" and len(text) < len("palabra " * 500)
+    assert CONTEXT_SUMMARY_FAILURES.value(provider="gemini") == before + 1
+    assert "No se pudo resumir el contexto" in caplog.text
@@ -0,0 +1,41 @@
+import asyncio
+
+from providers import PrefixCacheRegistry
+
+
+def test_cancelled_creator_releases_waiters():
+    async def scenario():
+        registry = PrefixCacheRegistry()
+        started = asyncio.Event()
+
+        async def slow_create():
+            started.set()
+            await asyncio.sleep(3600)
+
+        creator = asyncio.create_task(registry.get_or_create("k", slow_create, ttl=60))
+        await started.wait()
+        waiter = asyncio.create_task(registry.get_or_create("k", slow_create, ttl=60))
+        await asyncio.sleep(0)
+        creator.cancel()
+        # Sin el arreglo, el segundo llamador se quedaba esperando para siempre
+        assert await asyncio.wait_for(waiter, 1) is None
+        assert registry._creating == {}
+
+    asyncio.run(scenario())
+
+
+def test_waiters_share_created_handle():
+    async def scenario():
+        registry = PrefixCacheRegistry()
+        calls = []
+
+        async def create():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return "handle"
+
+        results = await asyncio.gather(*(registry.get_or_create("k", create, ttl=3600) for _ in range(3)))
+        assert results == ["handle"] * 3
+        assert len(calls) == 1
+
+    asyncio.run(scenario())
@@ -0,0 +1,126 @@
+import asyncio
+from types import SimpleNamespace as NS
+
+import pytest
+
+from providers import AnthropicAdapter, DeepSeekAdapter, OpenAIAdapter, ProviderResponseError
+
+
+class _Stream:
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self._chunks)
+        except StopIteration:
+            raise StopAsyncIteration
+
+
+def _openai(adapter_class, response):
+    adapter = adapter_class()
+
+    async def create(**kwargs):
+        return response
+
+    adapter.get_client = lambda: NS(chat=NS(completions=NS(create=create)))
+    return adapter
+
+
+def _openai_response(content, finish_reason="stop", refusal=None):
+    message = NS(content=content, refusal=refusal)
+    return NS(choices=[NS(message=message, finish_reason=finish_reason)], usage=None)
+
+
+async def _collect(agen):
+    return [text async for text in agen]
+
+
+@pytest.mark.parametrize("adapter_class", [OpenAIAdapter, DeepSeekAdapter])
+def test_openai_refusal_raises(adapter_class):
+    adapter = _openai(adapter_class, _openai_response(None, refusal="No puedo ayudar con eso."))
+    with pytest.raises(ProviderResponseError, match="rechazo: No puedo ayudar"):
+        asyncio.run(adapter.complete("hola"))
+
+
+def test_openai_tool_only_reply_raises():
+    adapter = _openai(OpenAIAdapter, _openai_response(None, finish_reason="tool_calls"))
+    with pytest.raises(ProviderResponseError, match="tool_calls"):
+        asyncio.run(adapter.complete("hola"))
+
+
+def test_openai_text_is_returned():
+    adapter = _openai(OpenAIAdapter, _openai_response("respuesta"))
+    assert asyncio.run(adapter.complete("hola")) == "respuesta"
+
+
+def test_openai_empty_stream_raises():
+    chunk = NS(choices=[NS(delta=NS(content=None, refusal=None), finish_reason="content_filter")], usage=None)
+    adapter = _openai(OpenAIAdapter, _Stream([chunk]))
+    with pytest.raises(ProviderResponseError, match="content_filter"):
+        asyncio.run(_collect(adapter.stream("hola")))
+
+
+def _anthropic(message, chunks=()):
+    adapter = AnthropicAdapter()
+
+    async def create(**kwargs):
+        return message
+
+    class MessageStream:
+        text_stream = _Stream(list(chunks))
+
+        async def __aenter__(self):
+            return self
+
+        async def __aexit__(self, *exc):
+            return False
+
+        async def get_final_message(self):
+            return message
+
+    adapter.get_client = lambda: NS(messages=NS(create=create, stream=lambda **kwargs: MessageStream()))
+    return adapter
+
+
+def _anthropic_message(blocks, stop_reason="end_turn"):
+    usage = NS(input_tokens=5, output_tokens=0, cache_read_input_tokens=0, cache_creation_input_tokens=0)
+    return NS(content=blocks, stop_reason=stop_reason, usage=usage)
+
+
+def test_anthropic_without_text_blocks_raises():
+    adapter = _anthropic(_anthropic_message([NS(type="tool_use")], stop_reason="tool_use"))
+    with pytest.raises(ProviderResponseError, match="tool_use"):
+        asyncio.run(adapter.complete("hola"))
+
+
+def test_anthropic_empty_stream_raises():
+    adapter = _anthropic(_anthropic_message([], stop_reason="refusal"))
+    with pytest.raises(ProviderResponseError, match="refusal"):
+        asyncio.run(_collect(adapter.stream("hola")))
+
+
+def test_anthropic_text_is_returned():
+    adapter = _anthropic(_anthropic_message([NS(type="text", text="hola "), NS(type="text", text="mundo")]))
+    assert asyncio.run(adapter.complete("hola")) == "hola mundo"
+
+
+def test_openai_reasoning_budget_exhausted_raises():
+    adapter = _openai(OpenAIAdapter, _openai_response("", finish_reason="length"))
+    with pytest.raises(ProviderResponseError, match="razonamiento incluido"):
+        asyncio.run(adapter.complete("hola", max_tokens=800))
+
+
+def test_truncated_reply_is_marked_in_usage():
+    usage = {}
+    adapter = _openai(OpenAIAdapter, _openai_response("respuesta a medi", finish_reason="length"))
+    assert asyncio.run(adapter.complete("hola", usage=usage)) == "respuesta a medi"
+    assert usage["truncated"] is True
+
+    usage = {}
+    adapter = _anthropic(_anthropic_message([NS(type="text", text="corta")], stop_reason="max_tokens"))
+    asyncio.run(adapter.complete("hola", usage=usage))
+    assert usage["truncated"] is True
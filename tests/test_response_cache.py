@@ -0,0 +1,81 @@
+import pytest
+
+from ai_core import ResponseCache
+
+
+class Clock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr("ai_core.time.time", clock)
+    return clock
+
+
+def _cache(tmp_path, ttl=60, max_memory_items=2, max_disk_bytes=10_000):
+    return ResponseCache(str(tmp_path / "cache.sqlite3"), ttl, max_memory_items, max_disk_bytes)
+
+
+def test_memory_is_a_bounded_lru_backed_by_disk(tmp_path, clock):
+    cache = _cache(tmp_path)
+    for key in ("a", "b", "c"):
+        cache.set(key, key.upper())
+    assert cache.stats()["memory_items"] == 2
+    # "a" salió de memoria, pero sigue en disco y vuelve a memoria al leerla
+    assert cache.get("a") == "A"
+    assert cache.counters["disk_hits"] == 1
+    assert cache.get("a") == "A"
+    assert cache.counters["memory_hits"] == 1
+
+
+def test_entries_expire_after_the_ttl(tmp_path, clock):
+    cache = _cache(tmp_path, ttl=60)
+    cache.set("a", "A")
+    clock.now += 59
+    assert cache.get("a") == "A"
+    clock.now += 2
+    assert cache.get("a") is None
+    # Tampoco se sirve del disco con una caché nueva
+    assert _cache(tmp_path, ttl=60).get("a") is None
+
+
+def test_disk_evicts_least_recently_used_first(tmp_path, clock):
+    cache = _cache(tmp_path, max_memory_items=1, max_disk_bytes=300)
+    cache.set("viejo", "x" * 100)
+    clock.now += 1
+    cache.set("usado", "y" * 100)
+    clock.now += 1
+    cache.get("viejo")  # desde disco: pasa a ser el usado más recientemente
+    clock.now += 1
+    cache.set("nuevo", "z" * 150)
+
+    fresh = _cache(tmp_path, max_memory_items=1, max_disk_bytes=300)
+    assert fresh.get("usado") is None
+    assert fresh.get("viejo") == "x" * 100 and fresh.get("nuevo") == "z" * 150
+    assert cache.counters["evictions"] == 1
+    assert cache.stats()["disk_bytes"] <= 300 * 0.9
+
+
+def test_expired_entries_are_evicted_before_live_ones(tmp_path, clock):
+    cache = _cache(tmp_path, ttl=10, max_memory_items=1, max_disk_bytes=300)
+    cache.set("caducado", "x" * 100)
+    clock.now += 11
+    cache.set("vivo", "y" * 100)
+    cache.set("otro", "z" * 120)
+    assert cache.counters["evictions"] == 1
+    fresh = _cache(tmp_path, ttl=10, max_memory_items=1, max_disk_bytes=300)
+    assert fresh.get("vivo") == "y" * 100 and fresh.get("otro") == "z" * 120
+
+
+def test_key_depends_on_every_input():
+    base = ResponseCache.make_key("gemini", "m", "sys", "hola")
+    assert base == ResponseCache.make_key("gemini", "m", "sys", "hola")
+    assert base == ResponseCache.make_key("gemini", "m", "sys", "hola", None)
+    assert len({base, ResponseCache.make_key("openai", "m", "sys", "hola"), ResponseCache.make_key("gemini", "m2", "sys", "hola"),
+                ResponseCache.make_key("gemini", "m", None, "hola"), ResponseCache.make_key("gemini", "m", "sys", "hola", 100)}) == 5
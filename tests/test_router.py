@@ -0,0 +1,85 @@
+import asyncio
+from types import SimpleNamespace as NS
+
+import pytest
+
+from ai_core import CircuitOpenError, ProviderRouter, is_health_failure
+from cassettes import CassetteMissError
+from providers import ProviderResponseError
+
+
+class HTTPError(Exception):
+    def __init__(self, status_code):
+        super().__init__(f"HTTP {status_code}")
+        self.status_code = status_code
+
+
+def _provider(name="fake"):
+    return NS(name=name, model_name=f"{name}-model")
+
+
+def _trip(router, provider):
+    for _ in range(router.failures):
+        router.acquire(provider)
+        router.record(provider, 10.0, HTTPError(503))
+
+
+def test_consecutive_failures_open_the_circuit():
+    router = ProviderRouter(failures=3, cooldown=60)
+    provider = _provider()
+    _trip(router, provider)
+    assert not router.available(provider)
+    with pytest.raises(CircuitOpenError):
+        router.acquire(provider)
+    assert router.counters["opened"] == 1 and router.counters["rejected"] == 1
+
+
+def test_half_open_probe_closes_on_success(monkeypatch):
+    router = ProviderRouter(failures=2, cooldown=30)
+    provider = _provider()
+    _trip(router, provider)
+    now = router._breaker(provider.name).opened_at
+    monkeypatch.setattr("ai_core.time.monotonic", lambda: now + 31)
+
+    assert router.acquire(provider) is True  # la llamada de prueba
+    with pytest.raises(CircuitOpenError):
+        router.acquire(provider)  # solo una prueba a la vez
+    router.record(provider, 10.0, probe=True)
+    assert router.stats()["providers"]["fake"]["circuit"] == "closed"
+    assert router.acquire(provider) is False
+
+
+def test_failed_probe_reopens(monkeypatch):
+    router = ProviderRouter(failures=2, cooldown=30)
+    provider = _provider()
+    _trip(router, provider)
+    now = router._breaker(provider.name).opened_at
+    monkeypatch.setattr("ai_core.time.monotonic", lambda: now + 31)
+
+    assert router.acquire(provider) is True
+    router.record(provider, 10.0, HTTPError(503), probe=True)
+    assert router._breaker(provider.name).state == "open"
+    assert router.counters["opened"] == 2
+
+
+@pytest.mark.parametrize("error", [
+    HTTPError(400), ProviderResponseError("vacía"), CassetteMissError("sin grabar"), asyncio.CancelledError(),
+])
+def test_errors_that_say_nothing_about_health_never_open_the_circuit(error):
+    router = ProviderRouter(failures=2, cooldown=60)
+    provider = _provider()
+    for _ in range(5):
+        router.acquire(provider)
+        router.record(provider, 10.0, error)
+    assert router.available(provider)
+    assert not is_health_failure(error)
+
+
+def test_rank_prefers_lower_latency_and_skips_open_circuits(monkeypatch):
+    monkeypatch.setattr("ai_core.ROUTER_EXPLORE_RATE", 0)
+    router = ProviderRouter(failures=1, cooldown=60)
+    fast, slow, broken, unknown = (_provider(n) for n in ("fast", "slow", "broken", "unknown"))
+    router.record(fast, 50.0)
+    router.record(slow, 500.0)
+    router.record(broken, 10.0, HTTPError(503))
+    assert router.rank([unknown, slow, broken, fast]) == [fast, slow, unknown]
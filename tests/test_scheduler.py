@@ -0,0 +1,107 @@
+import asyncio
+import email.utils
+import time
+from types import SimpleNamespace as NS
+
+import pytest
+
+from ai_core import ProviderScheduler, retry_after_seconds
+
+
+class HTTPError(Exception):
+    def __init__(self, status_code, headers=None):
+        super().__init__(f"HTTP {status_code}")
+        self.status_code = status_code
+        self.response = NS(headers=headers or {})
+
+
+def test_retry_after_in_seconds_and_milliseconds():
+    assert retry_after_seconds(HTTPError(429, {"retry-after": "3"})) == 3.0
+    assert retry_after_seconds(HTTPError(429, {"retry-after-ms": "1500", "retry-after": "9"})) == 1.5
+    assert retry_after_seconds(HTTPError(429)) is None
+    assert retry_after_seconds(RuntimeError("sin respuesta")) is None
+
+
+def test_retry_after_http_date():
+    when = email.utils.formatdate(time.time() + 10, usegmt=True)
+    assert 8 <= retry_after_seconds(HTTPError(429, {"retry-after": when})) <= 10
+
+
+@pytest.mark.parametrize("value", ["pronto", "Mon, 99 Foo 2024 25:61:00 GMT", "1.2.3"])
+def test_malformed_retry_after_falls_back_to_backoff(value):
+    assert retry_after_seconds(HTTPError(429, {"retry-after": value})) is None
+
+
+def _run(scheduler, call):
+    return asyncio.run(scheduler.run(call))
+
+
+def test_transient_errors_are_retried(monkeypatch):
+    monkeypatch.setattr("ai_core.PROVIDER_BACKOFF_BASE", 0)
+    attempts = []
+
+    async def call():
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise HTTPError(503)
+        return "ok"
+
+    scheduler = ProviderScheduler("fake", max_in_flight=2, max_retries=4)
+    assert _run(scheduler, call) == "ok"
+    assert len(attempts) == 3
+    assert scheduler.counters["retries"] == 2 and scheduler.counters["failures"] == 0
+
+
+def test_client_errors_are_not_retried():
+    attempts = []
+
+    async def call():
+        attempts.append(1)
+        raise HTTPError(400)
+
+    scheduler = ProviderScheduler("fake", max_in_flight=2, max_retries=4)
+    with pytest.raises(HTTPError):
+        _run(scheduler, call)
+    assert len(attempts) == 1 and scheduler.counters["failures"] == 1
+
+
+def test_rate_limit_waits_retry_after():
+    attempts = []
+
+    async def call():
+        attempts.append(time.perf_counter())
+        if len(attempts) == 1:
+            raise HTTPError(429, {"retry-after-ms": "50"})
+        return "ok"
+
+    scheduler = ProviderScheduler("fake", max_in_flight=1, max_retries=2)
+    assert _run(scheduler, call) == "ok"
+    assert attempts[1] - attempts[0] >= 0.05
+    assert scheduler.counters["rate_limited"] == 1
+
+
+def test_malformed_retry_after_keeps_original_error(monkeypatch):
+    monkeypatch.setattr("ai_core.PROVIDER_BACKOFF_BASE", 0)
+    attempts = []
+
+    async def call():
+        attempts.append(1)
+        raise HTTPError(429, {"retry-after": "pronto"})
+
+    scheduler = ProviderScheduler("fake", max_in_flight=1, max_retries=2)
+    with pytest.raises(HTTPError):
+        _run(scheduler, call)
+    assert len(attempts) == 3
+
+
+def test_no_retry_past_the_deadline():
+    attempts = []
+
+    async def call():
+        attempts.append(1)
+        raise HTTPError(429, {"retry-after": "5"})
+
+    scheduler = ProviderScheduler("fake", max_in_flight=1, max_retries=4)
+    with pytest.raises(HTTPError):
+        asyncio.run(scheduler.run(call, deadline=time.monotonic() + 1))
+    assert len(attempts) == 1
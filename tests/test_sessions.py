@@ -0,0 +1,85 @@
+import json
+
+import pytest
+
+from sessions import SessionError, SessionStore
+
+
+def _texts(turns):
+    return [turn.text for turn in turns]
+
+
+def test_window_keeps_the_most_recent_turns():
+    store = SessionStore(window_turns=4, window_tokens=10_000)
+    for i in range(5):
+        store.append("s", f"pregunta {i}", [(None, f"respuesta {i}")])
+    assert _texts(store.window("s")) == ["pregunta 3", "respuesta 3", "pregunta 4", "respuesta 4"]
+
+
+def test_each_provider_sees_its_own_answers_and_the_shared_ones():
+    store = SessionStore(window_turns=10, window_tokens=10_000)
+    store.append("s", "hola", [("gemini", "hola desde gemini"), ("openai", "hola desde openai")])
+    store.append("s", "¿y ahora?", [(None, "respuesta compartida")])
+    assert _texts(store.window("s", "gemini")) == ["hola", "hola desde gemini", "¿y ahora?", "respuesta compartida"]
+    assert "hola desde gemini" not in store.build_prompt("s", "openai", "siguiente")
+
+
+def test_token_budget_limits_the_window():
+    store = SessionStore(window_turns=10, window_tokens=40)
+    store.append("s", "pregunta " * 30, [(None, "respuesta " * 30)])
+    store.append("s", "segunda", [(None, "corta")])
+    # Cada turno largo cuenta como mucho medio presupuesto: cabe la respuesta larga pero no su
+    # pregunta, y la respuesta no se envía sin ella
+    assert _texts(store.window("s")) == ["segunda", "corta"]
+
+
+def test_window_never_starts_with_an_orphan_answer():
+    store = SessionStore(window_turns=3, window_tokens=10_000)
+    store.append("s", "primera", [(None, "uno")])
+    store.append("s", "segunda", [(None, "dos")])
+    assert _texts(store.window("s")) == ["segunda", "dos"]
+
+
+def test_prompt_carries_the_history():
+    store = SessionStore()
+    assert store.build_prompt("s", "gemini", "hola") == "hola"
+    store.append("s", "hola", [(None, "buenas")])
+    assert store.build_prompt("s", "gemini", "¿qué tal?") == (
+        "HISTORIAL DE LA CONVERSACIÓN:\nUsuario: hola\n\nAsistente: buenas\n\nPREGUNTA ACTUAL: ¿qué tal?")
+
+
+def test_least_recently_used_sessions_spill_to_disk_and_come_back(tmp_path):
+    store = SessionStore(max_bytes=600, spill_dir=str(tmp_path))
+    store.append("a", "pregunta a", [(None, "respuesta a")])
+    store.append("b", "pregunta b", [(None, "respuesta b")])
+    store.window("a")  # "b" pasa a ser la menos usada
+    store.append("c", "pregunta c", [(None, "respuesta c")])
+    assert store.counters["evicted"] == 1 and store.stats()["bytes"] <= 600
+    assert (tmp_path / "b.jsonl").exists() and not (tmp_path / "a.jsonl").exists()
+
+    # Al volver, la sesión se recupera del disco y solo se vuelcan los turnos nuevos
+    store.append("b", "otra b", [(None, "otra respuesta b")])
+    assert store.counters["loaded"] == 1
+    assert _texts(store.window("b")) == ["pregunta b", "respuesta b", "otra b", "otra respuesta b"]
+    store.append("a", "más a", [])
+    store.append("c", "más c", [])
+    lines = [json.loads(line)["text"] for line in (tmp_path / "b.jsonl").read_text(encoding="utf-8").splitlines()]
+    assert lines == ["pregunta b", "respuesta b", "otra b", "otra respuesta b"]
+
+    assert store.delete("b") and not (tmp_path / "b.jsonl").exists()
+
+
+def test_sessions_expire(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr("sessions.time.time", lambda: now[0])
+    store = SessionStore(ttl=60)
+    store.append("s", "hola", [])
+    now[0] += 61
+    assert store.window("s") == [] and not store.has_history("s")
+    assert store.counters["expired"] == 1
+
+
+@pytest.mark.parametrize("session_id", ["", "con espacios", "x" * 65, "../etc", 123])
+def test_invalid_session_ids_are_rejected(session_id):
+    with pytest.raises(SessionError):
+        SessionStore().append(session_id, "hola", [])
@@ -0,0 +1,63 @@
+import pytest
+
+from similarity import SimilarityCache, normalize
+
+CAPITAL = "¿Cuál es la capital de Francia?"
+
+
+@pytest.fixture
+def cache():
+    return SimilarityCache(threshold=0.8, max_entries=3, ttl=60)
+
+
+def test_normalize_drops_case_accents_and_punctuation():
+    assert normalize(CAPITAL) == "cual es la capital de francia"
+    assert normalize("  Hola,   MUNDO!! ") == "hola mundo"
+
+
+def test_near_duplicates_reuse_the_stored_value(cache):
+    cache.store(CAPITAL, ("comparacion", None), {"gemini": "París"})
+    value, meta = cache.lookup("cual es la capital de francia", ("comparacion", None))
+    assert value == {"gemini": "París"}
+    assert meta["prompt"] == CAPITAL and meta["similarity"] == 1.0
+
+
+def test_different_questions_and_scopes_miss(cache):
+    cache.store(CAPITAL, ("comparacion", None), "París")
+    assert cache.lookup("¿Cuál es la capital de Alemania?", ("comparacion", None)) is None
+    assert cache.lookup(CAPITAL, ("encadenada", "1")) is None
+    assert cache.counters["misses"] == 2
+
+
+def test_numbers_must_match_exactly(cache):
+    cache.store("¿Cuánto es 2 + 2?", ("comparacion", None), "4")
+    assert cache.lookup("cuanto es 2 + 2", ("comparacion", None))[0] == "4"
+    assert cache.lookup("¿Cuánto es 2 + 3?", ("comparacion", None)) is None
+    assert cache.lookup("¿Cuánto es 2 + 22?", ("comparacion", None)) is None
+
+
+def test_threshold_decides_how_similar_is_similar_enough():
+    question = "Explica en detalle cómo funciona el protocolo de transporte QUIC sobre UDP"
+    variant = "Explica en detalle cómo funciona el protocolo de transporte QUIC sobre UDP, por favor"
+    strict, loose = SimilarityCache(threshold=0.99), SimilarityCache(threshold=0.5)
+    for cache in (strict, loose):
+        cache.store(question, "ámbito", "respuesta")
+    assert strict.lookup(variant, "ámbito") is None
+    value, meta = loose.lookup(variant, "ámbito")
+    assert value == "respuesta" and 0.5 <= meta["similarity"] < 1.0
+
+
+def test_entries_expire_and_the_least_used_is_evicted(cache, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr("similarity.time.time", lambda: now[0])
+    for i, country in enumerate(("Francia", "Italia", "Portugal")):
+        cache.store(f"¿Cuál es la capital de {country}?", "ámbito", i)
+    cache.lookup("¿Cuál es la capital de Francia?", "ámbito")  # Francia pasa a ser la más usada
+    cache.store("¿Cuál es la capital de Grecia?", "ámbito", 3)
+    assert cache.lookup("¿Cuál es la capital de Italia?", "ámbito") is None
+    assert cache.stats()["entries"] == 3 and cache.counters["evictions"] == 1
+
+    now[0] += 61
+    assert cache.lookup("¿Cuál es la capital de Francia?", "ámbito") is None
+    # Los caducados que salen como candidatos se eliminan del índice al encontrarlos
+    assert cache.counters["evictions"] >= 2 and cache.stats()["entries"] < 3
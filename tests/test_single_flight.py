@@ -0,0 +1,144 @@
+import asyncio
+
+import pytest
+
+from ai_core import SingleFlight
+
+
+class Fetch:
+    """fetch() que cuenta sus llamadas y espera a que el test la deje terminar."""
+
+    def __init__(self, result="ok", error=None, ready=False):
+        self.result = result
+        self.error = error
+        self.ready = ready
+        self.calls = 0
+        self.cancelled = False
+        self.release = None
+
+    async def __call__(self):
+        self.calls += 1
+        if self.release is None:
+            self.release = asyncio.Event()
+            if self.ready:
+                self.release.set()
+        try:
+            await self.release.wait()
+        except asyncio.CancelledError:
+            self.cancelled = True
+            raise
+        if self.error:
+            raise self.error
+        return self.result
+
+
+async def _settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def test_identical_calls_share_one_fetch():
+    async def main():
+        flights, fetch = SingleFlight(), Fetch()
+        callers = [asyncio.create_task(flights.call("clave", fetch)) for _ in range(3)]
+        await _settle()
+        fetch.release.set()
+        results = await asyncio.gather(*callers)
+        assert results == ["ok"] * 3 and fetch.calls == 1
+        assert flights.counters == {"leaders": 1, "coalesced": 2, "cancelled": 0}
+        assert flights.stats()["in_flight"] == 0
+    asyncio.run(main())
+
+
+def test_error_reaches_every_waiter_and_is_not_reused():
+    async def main():
+        flights, fetch = SingleFlight(), Fetch(error=RuntimeError("503"))
+        callers = [asyncio.create_task(flights.call("clave", fetch)) for _ in range(3)]
+        await _settle()
+        fetch.release.set()
+        results = await asyncio.gather(*callers, return_exceptions=True)
+        assert [str(r) for r in results] == ["503"] * 3 and all(isinstance(r, RuntimeError) for r in results)
+
+        retry = Fetch(ready=True)
+        assert await flights.call("clave", retry) == "ok" and retry.calls == 1
+    asyncio.run(main())
+
+
+def test_cancelled_caller_detaches_without_cancelling_the_others():
+    async def main():
+        flights, fetch = SingleFlight(), Fetch()
+        first = asyncio.create_task(flights.call("clave", fetch))
+        second = asyncio.create_task(flights.call("clave", fetch))
+        await _settle()
+        first.cancel()
+        await _settle()
+        assert not fetch.cancelled
+        fetch.release.set()
+        assert await second == "ok"
+        with pytest.raises(asyncio.CancelledError):
+            await first
+    asyncio.run(main())
+
+
+def test_fetch_is_cancelled_when_nobody_waits():
+    async def main():
+        flights, fetch = SingleFlight(), Fetch()
+        callers = [asyncio.create_task(flights.call("clave", fetch)) for _ in range(2)]
+        await _settle()
+        for caller in callers:
+            caller.cancel()
+        await asyncio.gather(*callers, return_exceptions=True)
+        await _settle()
+        assert fetch.cancelled and flights.counters["cancelled"] == 1
+        assert flights.stats()["in_flight"] == 0
+    asyncio.run(main())
+
+
+def test_late_stream_subscriber_gets_the_chunks_already_sent():
+    async def main():
+        flights = SingleFlight()
+        first_chunk, release = asyncio.Event(), asyncio.Event()
+        streams = []
+
+        async def make_stream():
+            streams.append(1)
+            yield "uno "
+            first_chunk.set()
+            await release.wait()
+            yield "dos"
+
+        async def consume():
+            return [chunk async for chunk in flights.stream("clave", make_stream)]
+
+        early = asyncio.create_task(consume())
+        await first_chunk.wait()
+        late = asyncio.create_task(consume())
+        await _settle()
+        release.set()
+        assert await early == await late == ["uno ", "dos"]
+        assert len(streams) == 1
+    asyncio.run(main())
+
+
+def test_stream_error_reaches_every_subscriber():
+    async def main():
+        flights = SingleFlight()
+        release = asyncio.Event()
+
+        async def make_stream():
+            yield "parcial"
+            await release.wait()
+            raise RuntimeError("cortado")
+
+        async def consume():
+            chunks = []
+            with pytest.raises(RuntimeError, match="cortado"):
+                async for chunk in flights.stream("clave", make_stream):
+                    chunks.append(chunk)
+            return chunks
+
+        subscribers = [asyncio.create_task(consume()) for _ in range(2)]
+        await _settle()
+        release.set()
+        assert await asyncio.gather(*subscribers) == [["parcial"], ["parcial"]]
+    asyncio.run(main())
@@ -0,0 +1,115 @@
+import asyncio
+
+import pytest
+
+from workflow import SKIPPED, WorkflowError, compile_workflow, critical_path, run_workflow, steps_to_end
+
+
+def _ids(nodes):
+    return [node["id"] for node in nodes]
+
+
+def test_linear_chain_depends_on_the_previous_step():
+    nodes = compile_workflow({"chain": [{"ia_name": "gemini"}, {"ia_name": "openai"}, {"ia_name": "claude"}]})
+    assert _ids(nodes) == ["paso_1", "paso_2", "paso_3"]
+    assert [node["depends_on"] for node in nodes] == [[], ["paso_1"], ["paso_2"]]
+    assert [node["step"] for node in nodes] == [1, 2, 3]
+
+
+def test_steps_are_sorted_topologically_keeping_the_declared_order():
+    nodes = compile_workflow({"steps": [
+        {"id": "final", "depends_on": ["a", "b"]},
+        {"id": "b", "depends_on": ["raiz"]},
+        {"id": "a", "depends_on": ["raiz"]},
+        {"id": "raiz"},
+    ]})
+    assert _ids(nodes) == ["raiz", "b", "a", "final"]
+    assert nodes[-1]["step"] == 1  # el número de paso sigue siendo el declarado
+    assert steps_to_end(nodes) == {"raiz": 3, "b": 2, "a": 2, "final": 1}
+    assert critical_path(nodes, {"raiz": 10, "a": 50, "b": 20, "final": 5}) == 65
+
+
+@pytest.mark.parametrize("steps, message", [
+    ([{"id": "a"}, {"id": "a"}], "repetido"),
+    ([{"id": "a", "depends_on": ["fantasma"]}], "inexistente"),
+    ([{"id": "a", "depends_on": ["c"]}, {"id": "b", "depends_on": ["a"]}, {"id": "c", "depends_on": ["b"]}, {"id": "d"}],
+     "circulares entre los pasos: a, b, c"),
+])
+def test_malformed_presets_are_rejected(steps, message):
+    with pytest.raises(WorkflowError, match=message):
+        compile_workflow({"steps": steps})
+
+
+def _diamond():
+    return compile_workflow({"steps": [
+        {"id": "borrador"},
+        {"id": "critica_1", "depends_on": ["borrador"]},
+        {"id": "critica_2", "depends_on": ["borrador"]},
+        {"id": "sintesis", "depends_on": ["critica_1", "critica_2"]},
+    ]})
+
+
+def test_independent_steps_run_concurrently_and_receive_only_their_inputs():
+    running, peak, received = set(), [0], {}
+
+    async def run_node(node, inputs):
+        received[node["id"]] = [(dep["id"], text) for dep, text in inputs]
+        running.add(node["id"])
+        peak[0] = max(peak[0], len(running))
+        await asyncio.sleep(0.01)
+        running.discard(node["id"])
+        return node["id"].upper()
+
+    outputs, failed = asyncio.run(run_workflow(_diamond(), run_node))
+    assert not failed and outputs["sintesis"] == "SINTESIS"
+    assert peak[0] == 2
+    assert received["critica_1"] == [("borrador", "BORRADOR")]
+    assert received["sintesis"] == [("critica_1", "CRITICA_1"), ("critica_2", "CRITICA_2")]
+
+
+def test_dependents_of_a_failed_step_are_skipped():
+    ran = []
+
+    async def run_node(node, inputs):
+        ran.append(node["id"])
+        if node["id"] == "critica_1":
+            raise RuntimeError("falla")
+        return "ok"
+
+    outputs, failed = asyncio.run(run_workflow(_diamond(), run_node))
+    assert failed == {"critica_1", "sintesis"}
+    assert "sintesis" not in ran and "critica_2" in outputs
+
+
+def test_skipped_steps_pass_their_inputs_through():
+    nodes = compile_workflow({"chain": [{}, {}, {}]})
+    received = {}
+
+    async def run_node(node, inputs):
+        received[node["id"]] = [dep["id"] for dep, _ in inputs]
+        return SKIPPED if node["id"] == "paso_2" else "texto"
+
+    outputs, failed = asyncio.run(run_workflow(nodes, run_node))
+    assert not failed and outputs["paso_2"] is SKIPPED
+    assert received["paso_3"] == ["paso_1"]
+
+
+def test_cancellation_cancels_running_steps():
+    cancelled = []
+
+    async def run_node(node, inputs):
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.append(node["id"])
+            raise
+
+    async def main():
+        task = asyncio.create_task(run_workflow(_diamond(), run_node))
+        await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(main())
+    assert cancelled == ["borrador"]
@@ -0,0 +1,131 @@
+# workflow.py
+# Presets como grafos de dependencias. Cada paso declara de qué pasos depende ("depends_on") y
+# el ejecutor lanza a la vez todos los pasos cuyas dependencias ya han terminado: varias IAs
+# pueden criticar el mismo borrador en paralelo y un paso final fusionar sus críticas. El tiempo
+# total es el del camino crítico, no la suma de todos los pasos.
+#
+# Los presets lineales de siempre ("chain": [...]) se convierten en un grafo en el que cada paso
+# depende del anterior, así que se ejecutan exactamente igual que antes.
+#
+# Este módulo no sabe nada de proveedores: quien lo usa (ai_core.py, main.py) pasa una corrutina
+# run_node(node, inputs) que ejecuta un paso y devuelve su texto.
+
+import asyncio
+
+SKIPPED = object()  # valor que devuelve run_node para un paso que no se ha ejecutado (IA no configurada)
+
+
+class WorkflowError(ValueError):
+    """Preset mal definido: ids repetidos, dependencias desconocidas o ciclos."""
+
+
+def compile_workflow(preset):
+    """Devuelve los pasos del preset normalizados y en orden topológico (estable respecto al declarado).
+
+    Cada paso queda como un dict con "id", "step" (número 1, 2, ... según el orden declarado),
+    "depends_on" y el resto de campos del preset (ia_name, system_instruction, task_description...)."""
+    if "steps" in preset:
+        declared = [dict(step) for step in preset["steps"]]
+        for i, step in enumerate(declared, start=1):
+            step.setdefault("id", f"paso_{i}")
+            step["depends_on"] = list(step.get("depends_on", []))
+    else:
+        declared = [dict(step, id=f"paso_{i}", depends_on=[f"paso_{i - 1}"] if i > 1 else [])
+                    for i, step in enumerate(preset["chain"], start=1)]
+    for i, step in enumerate(declared, start=1):
+        step["step"] = i
+
+    by_id = {}
+    for step in declared:
+        if step["id"] in by_id:
+            raise WorkflowError(f"Paso repetido: {step['id']}")
+        by_id[step["id"]] = step
+    for step in declared:
+        for dep in step["depends_on"]:
+            if dep not in by_id:
+                raise WorkflowError(f"El paso '{step['id']}' depende de un paso inexistente: {dep}")
+
+    ordered, placed = [], set()
+    while len(ordered) < len(declared):
+        ready = [s for s in declared if s["id"] not in placed and all(d in placed for d in s["depends_on"])]
+        if not ready:
+            cycle = [s["id"] for s in declared if s["id"] not in placed]
+            raise WorkflowError(f"Dependencias circulares entre los pasos: {', '.join(cycle)}")
+        ordered.extend(ready)
+        placed.update(s["id"] for s in ready)
+    return ordered
+
+
+def critical_path(nodes, timings):
+    """Milisegundos del camino más largo del grafo según los tiempos medidos por paso (id -> ms)."""
+    finish = {}
+    for node in nodes:  # ya en orden topológico
+        start = max((finish.get(dep, 0.0) for dep in node["depends_on"]), default=0.0)
+        finish[node["id"]] = start + timings.get(node["id"], 0.0)
+    return round(max(finish.values(), default=0.0), 1)
+
+
+def steps_to_end(nodes):
+    """Id -> número de pasos del camino más largo desde ese paso (incluido) hasta el final del grafo.
+    Sirve para repartir el plazo que queda entre los pasos que aún tienen que ejecutarse uno tras otro."""
+    left = {}
+    for node in reversed(nodes):  # orden topológico inverso: los dependientes ya están calculados
+        left[node["id"]] = 1 + max((left[n["id"]] for n in nodes if node["id"] in n["depends_on"]), default=0)
+    return left
+
+
+async def run_workflow(nodes, run_node):
+    """Ejecuta el grafo lanzando cada paso en cuanto sus dependencias terminan.
+
+    run_node(node, inputs) recibe solo las salidas de las dependencias declaradas, como lista de
+    (paso, texto). Un paso saltado (run_node devolvió SKIPPED) es transparente: sus dependientes
+    reciben en su lugar las entradas que él habría recibido. Si run_node lanza una excepción, el
+    paso cuenta como fallido y ninguno de sus dependientes se ejecuta (el error nunca se pasa como
+    contexto); las ramas independientes siguen adelante.
+
+    Devuelve (outputs, failed): outputs es id -> texto o SKIPPED; failed, los ids fallidos o
+    bloqueados por un fallo previo."""
+    by_id = {node["id"]: node for node in nodes}
+    outputs = {}
+    failed = set()
+    waiting = list(nodes)
+    running = {}
+
+    def inputs_for(node):
+        inputs, seen = [], set()
+        def collect(dep_ids):
+            for dep in dep_ids:
+                if dep in seen:
+                    continue
+                seen.add(dep)
+                if outputs[dep] is SKIPPED:
+                    collect(by_id[dep]["depends_on"])
+                else:
+                    inputs.append((by_id[dep], outputs[dep]))
+        collect(node["depends_on"])
+        return inputs
+
+    try:
+        while waiting or running:
+            for node in list(waiting):
+                if any(dep in failed for dep in node["depends_on"]):
+                    waiting.remove(node)
+                    failed.add(node["id"])
+                elif all(dep in outputs for dep in node["depends_on"]):
+                    waiting.remove(node)
+                    running[asyncio.create_task(run_node(node, inputs_for(node)))] = node
+            if not running:
+                break
+            done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                node = running.pop(task)
+                if task.exception() is not None:
+                    failed.add(node["id"])
+                else:
+                    outputs[node["id"]] = task.result()
+    finally:
+        # Si nos cancelan (cliente desconectado), no dejamos pasos huérfanos consumiendo cuota
+        for task in running:
+            task.cancel()
+        await asyncio.gather(*running, return_exceptions=True)
+    return outputs, failed